@@ -0,0 +1,186 @@
+import asyncio
+import ssl
+import struct
+import sys
+from protocol import ConnectionStatus, PROTO_INIT_CMD, PROTO_SYNC_CMDS
+from protocol import escape_init_option
+
+
+class AsyncNetwork():
+    """Manage network connection using asyncio streams. Does not depend on
+    GTK or GLib: frames and status changes are passed to the on_frame and
+    on_status callbacks, called from the event loop running the connection.
+    """
+
+    def __init__(self, config, on_frame=None, on_status=None):
+        self.config = config
+        self.on_frame = on_frame if on_frame else lambda frame: None
+        self.on_status = on_status if on_status else lambda status: None
+        self.connection_status = ConnectionStatus.NOT_CONNECTED
+        self.host = None
+        self.port = None
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+
+    def _set_status(self, status):
+        self.connection_status = status
+        self.on_status(status)
+
+    def check_settings(self):
+        """ Returns True if settings required to connect are filled in. """
+        return self.config.get("relay", "server") != ""\
+            and self.config.get("relay", "port") != ""
+
+    def _ssl_context(self):
+        if self.config.get("relay", "ssl") != "on":
+            return None
+        # Like the Gio backend, accept self-signed certificates for any
+        # host name, as created by the instructions in the README.
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+
+    async def connect_weechat(self):
+        """Connects to the WeeChat relay. Returns True on success."""
+        if not self.check_settings():
+            return False
+        self.host = self.config.get("relay", "server")
+        port_str = self.config.get("relay", "port")
+        try:
+            self.port = int(port_str)
+        except ValueError:
+            print("Invalid port, must be an integer.")
+            return False
+        if self.connection_status is not ConnectionStatus.RECONNECTING:
+            self._set_status(ConnectionStatus.CONNECTING)
+        try:
+            (self.reader, self.writer) = await asyncio.open_connection(
+                self.host, self.port, ssl=self._ssl_context())
+        except OSError as err:
+            print("Connection failed:\n{}".format(err))
+            if self.connection_status is not ConnectionStatus.RECONNECTING:
+                self.connection_status = ConnectionStatus.NOT_CONNECTED
+            self.on_status(self.connection_status)
+            return False
+        print("Connected")
+        self._set_status(ConnectionStatus.CONNECTED)
+        self.send_to_weechat(PROTO_INIT_CMD.format(
+            password=escape_init_option(
+                self.config.get("relay", "password")),
+            compression="on")
+            + "\n")
+        self.send_to_weechat(PROTO_SYNC_CMDS.format(
+            lines=self.config.get("relay", "lines"))
+            + "\n")
+        self.read_task = asyncio.ensure_future(self._read_frames())
+        self.read_task.add_done_callback(self._read_done)
+        return True
+
+    async def _read_frames(self):
+        """Reads WeeChat messages and passes them on to on_frame."""
+        reader = self.reader
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                length = struct.unpack('>i', header)[0]
+                if length < 4:
+                    raise ValueError("invalid message length {}".format(
+                        length))
+                self.on_frame(header + await reader.readexactly(length-4))
+        except asyncio.IncompleteReadError:
+            print("Server has closed the connection.")
+            self._connection_lost(ConnectionStatus.CONNECTION_LOST)
+        except (ConnectionResetError, BrokenPipeError):
+            print("Broken pipe, connection lost.")
+            self._connection_lost(ConnectionStatus.RECONNECTING)
+        except TimeoutError:
+            print("Connection timed out.")
+            self._connection_lost(ConnectionStatus.RECONNECTING)
+        except (OSError, ValueError) as err:
+            print("Connection lost:\n{}".format(err))
+            self._connection_lost(ConnectionStatus.RECONNECTING)
+
+    def _read_done(self, task):
+        """Retrieves the result of a finished read task, so that an
+        unexpected error is reported instead of being left unretrieved."""
+        current = task is self.read_task
+        if current:
+            self.read_task = None
+        if task.cancelled() or task.exception() is None:
+            return
+        print("Error reading from WeeChat:\n{}".format(task.exception()))
+        if current:
+            self._connection_lost(ConnectionStatus.RECONNECTING)
+
+    def _connection_lost(self, status):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.reader = None
+        if self.read_task is not None:
+            if self.read_task is not asyncio.current_task():
+                self.read_task.cancel()
+            self.read_task = None
+        self._set_status(status)
+
+    def disconnect_weechat(self):
+        """Disconnect from WeeChat."""
+        if self.writer is None:
+            return
+        self.send_to_weechat("quit\n")
+        self.writer.close()
+        self.writer = None
+        self.reader = None
+        if self.read_task is not None:
+            self.read_task.cancel()
+            self.read_task = None
+        self._set_status(ConnectionStatus.NOT_CONNECTED)
+
+    def send_to_weechat(self, message):
+        """Send a message to WeeChat."""
+        if self.writer is None:
+            return
+        self.writer.write(message.encode("utf-8"))
+
+    def desync_weechat(self):
+        """Desynchronize from WeeChat."""
+        self.send_to_weechat("desync\n")
+
+    def sync_weechat(self):
+        """Synchronize with WeeChat."""
+        self.send_to_weechat(PROTO_SYNC_CMDS.format(
+            lines=self.config.get("relay", "lines")))
+
+
+def main():
+    """Connects with the settings of the given configuration file and
+    prints a summary of every message received, without any GUI."""
+    # pylint: disable=import-outside-toplevel
+    from config import GTKWeechatConfig
+    import protocol
+    if len(sys.argv) != 2:
+        sys.exit("Usage: {} CONFIG_FILE".format(sys.argv[0]))
+
+    def on_frame(frame):
+        message = protocol.Protocol().decode(frame)
+        print("{}: {} bytes, {} objects".format(
+            message.msgid, message.size, len(message.objects)))
+
+    async def run():
+        done = asyncio.get_running_loop().create_future()
+
+        def on_status(status):
+            if status not in (ConnectionStatus.CONNECTING,
+                              ConnectionStatus.CONNECTED) and not done.done():
+                done.set_result(status)
+        net = AsyncNetwork(GTKWeechatConfig(sys.argv[1]), on_frame, on_status)
+        if await net.connect_weechat():
+            await done
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Time to create the buffers listed by WeeChat, each with a few backlog
+lines, with their widgets built on first show only and with all widgets
+built up front as before.
+
+Usage: python3 bench/buffer_startup.py [BUFFERS]
+Needs a display.
+"""
+
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+from config import GTKWeechatConfig
+from buffer import Buffer
+import traffic
+
+LINES = 50
+
+
+def process_events():
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+
+def run(config, count, lines, build):
+    start = time.perf_counter()
+    buffers = []
+    for number in range(count):
+        buf = Buffer(config, {"__path": ["0x{}".format(number)],
+                              "full_name": "irc.bench.#channel{}".format(number),
+                              "short_name": "#channel{}".format(number),
+                              "title": "",
+                              "local_variables": {"type": "channel"}})
+        if build:
+            buf.build()
+        for line in lines:
+            buf.defer_line(*line)
+        buffers.append(buf)
+    process_events()
+    elapsed = time.perf_counter() - start
+    for buf in buffers:
+        buf.destroy()
+    process_events()
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 800
+    lines = traffic.channel_lines(LINES)
+    config = GTKWeechatConfig(os.path.join(tempfile.mkdtemp(), "bench.conf"))
+    for (name, build) in (("on show", False), ("up front", True)):
+        elapsed = run(config, count, lines, build)
+        print("{:>8}: {} buffers in {:.0f} ms".format(name, count,
+                                                      elapsed*1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Micro-benchmark of color parsing: the conversion of color codes to the
+\x01(...) mini-language re-parsed by splitting on \x01, as chat buffers did,
+against the single-pass Color.tokenize, with and without its cache. Checks
+that both give the same runs.
+
+Usage: python3 bench/color_tokenize.py [LINES]
+Runs without GTK.
+"""
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+import color
+import config
+import traffic
+
+
+def parse_converted(string):
+    """Splits a string converted by Color.convert into (text, (foreground,
+    background, attrs)) runs, as chat buffers did before Color.tokenize."""
+    items = string.split('\x01')
+    foreground = None
+    background = None
+    attrs = set()
+    runs = []
+    if len(items[0]) > 0:
+        runs.append((items[0], None))
+    for item in items[1:]:
+        if item.startswith('('):
+            pos = item.find(')')
+            if pos >= 2:
+                action = item[1]
+                code = item[2:pos]
+                if action == '+':
+                    if code[0] in ('*', '!', '/', '_'):
+                        attrs.add(code[0])
+                elif action == '-':
+                    attrs.discard(code[0])
+                elif code == 'r':
+                    foreground = None
+                    background = None
+                    attrs = set()
+                else:
+                    while code.startswith(('*', '!', '/', '_', '|', 'r')):
+                        if code[0] == 'r':
+                            foreground = None
+                            background = None
+                            attrs = set()
+                        elif code[0] in ('*', '!', '/', '_'):
+                            attrs.add(code[0])
+                        code = code[1:]
+                    if code and code != "$":
+                        if action == "F":
+                            foreground = code
+                            background = None
+                        elif action == "B":
+                            background = code
+                item = item[pos+1:]
+        if len(item) > 0:
+            runs.append((item, (foreground, background, frozenset(attrs))))
+    return runs
+
+
+def old_runs(converter, text):
+    return parse_converted(converter.convert(text))
+
+
+def new_runs(converter, text):
+    return converter.tokenize(text)
+
+
+def uncached_runs(converter, text):
+    # pylint: disable=protected-access
+    return converter._tokenize(text)
+
+
+def normalized(converter, runs, tokenized):
+    """Returns runs with styles as RGB strings, default styles as None, and
+    consecutive runs of the same style merged."""
+    result = []
+    for (text, style) in runs:
+        if style is not None and tokenized:
+            style = (None if style.foreground is None else
+                     converter.rgb(style.foreground),
+                     None if style.background is None else
+                     converter.rgb(style.background), style.attrs)
+        if style == (None, None, frozenset()):
+            style = None
+        if result and result[-1][1] == style:
+            result[-1] = (result[-1][0] + text, style)
+        else:
+            result.append((text, style))
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    options = [option[1] for option in config.CONFIG_DEFAULT_COLOR_OPTIONS]
+    strings = [string for line in traffic.channel_lines(count)
+               for string in line[1:3]]
+    converter = color.Color(options)
+    for string in strings:
+        if normalized(converter, old_runs(converter, string), False) != \
+                normalized(converter, new_runs(converter, string), True):
+            sys.exit("Different runs for {!r}".format(string))
+    for (name, function) in (("convert + split", old_runs),
+                             ("tokenize, no cache", uncached_runs),
+                             ("tokenize", new_runs)):
+        converter = color.Color(options)
+        color.runs_cache.clear()
+        color.runs_cache.hits = color.runs_cache.misses = 0
+        start = time.perf_counter()
+        for string in strings:
+            function(converter, string)
+        elapsed = time.perf_counter() - start
+        print("{:>18}: {:.0f} strings/s".format(name, len(strings)/elapsed))
+    print("Cache: {}".format(color.runs_cache.info()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Lines written per second to the history cache, and time to load it at
+startup, for channel traffic spread across 200 buffers.
+
+Usage: python3 bench/history.py [LINES]
+"""
+
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+from history import HistoryCache
+import traffic
+
+BUFFERS = 200
+MAX_LINES = 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    lines = traffic.channel_lines(count)
+    path = os.path.join(tempfile.mkdtemp(), "history.sqlite3")
+    cache = HistoryCache(path, MAX_LINES)
+    cache.set_buffers([{"__path": ["0x{}".format(number)],
+                        "full_name": "irc.bench.#channel{}".format(number),
+                        "short_name": "#channel{}".format(number),
+                        "title": "", "local_variables": {"type": "channel"}}
+                       for number in range(BUFFERS)])
+    start = time.perf_counter()
+    for (number, line) in enumerate(lines):
+        cache.add_line("irc.bench.#channel{}".format(number % BUFFERS), line)
+    queued = time.perf_counter() - start
+    cache.close()
+    elapsed = time.perf_counter() - start
+    print("writing: {:.0f} lines/s queued, {:.0f} lines/s written, "
+          "{:.1f} MB".format(count/queued, count/elapsed,
+                             os.path.getsize(path)/1e6))
+    cache = HistoryCache(path, MAX_LINES)
+    start = time.perf_counter()
+    buffers = cache.load()
+    elapsed = time.perf_counter() - start
+    cache.close()
+    print("loading: {} buffers, {} lines in {:.0f} ms".format(
+        len(buffers), sum(len(lines) for (_, lines) in buffers),
+        elapsed*1000))
+
+
+if __name__ == "__main__":
+    main()
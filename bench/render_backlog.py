@@ -0,0 +1,71 @@
+"""Time to render a backlog of 10k lines into a visible chat buffer, line by
+line as _buffer_line_added lines are rendered, and in bulk as the backlog.
+
+Usage: python3 bench/render_backlog.py [LINES]
+Needs a display.
+"""
+
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+from config import GTKWeechatConfig
+from buffer import Buffer
+import traffic
+
+
+def process_events():
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+
+def new_buffer(config):
+    buf = Buffer(config, {"__path": ["0x1"], "full_name": "irc.bench.#channel",
+                          "short_name": "#channel", "title": "",
+                          "local_variables": {"type": "channel"}})
+    buf.build()
+    window = Gtk.Window()
+    window.set_default_size(950, 700)
+    window.add(buf)
+    window.show_all()
+    buf.active = True
+    process_events()
+    return (window, buf)
+
+
+def run(config, lines, bulk):
+    (window, buf) = new_buffer(config)
+    start = time.perf_counter()
+    if bulk:
+        buf.display_bulk(lines)
+        buf.scrollbottom()
+    else:
+        for line in lines:
+            buf.display_line(*line)
+            buf.scrollbottom()
+    # Until the view has laid out and drawn the result
+    process_events()
+    elapsed = time.perf_counter() - start
+    window.destroy()
+    process_events()
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    config = GTKWeechatConfig(os.path.join(tempfile.mkdtemp(), "bench.conf"))
+    config.set("look", "max_lines", "0")
+    lines = traffic.channel_lines(count)
+    for (name, bulk) in (("line by line", False), ("bulk", True)):
+        elapsed = run(config, lines, bulk)
+        print("{:>12}: {} lines in {:.2f} s ({:.0f} lines/s)".format(
+            name, count, elapsed, count/elapsed))
+
+
+if __name__ == "__main__":
+    main()
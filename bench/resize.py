@@ -0,0 +1,72 @@
+"""Worst frame while resizing a window showing a chat buffer of 10k lines,
+with the text view and with the virtual chat view, as reported by the
+buffer once the width has settled.
+
+Usage: python3 bench/resize.py [LINES]
+Needs a display.
+"""
+
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+from config import GTKWeechatConfig
+from buffer import Buffer, RESIZE_SETTLE_MS
+import traffic
+
+# Window widths of a drag-resize, one per frame
+WIDTHS = list(range(950, 550, -20)) + list(range(550, 950, 20))
+
+
+def process_events():
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+
+def run(config, lines):
+    buf = Buffer(config, {"__path": ["0x1"], "full_name": "irc.bench.#channel",
+                          "short_name": "#channel", "title": "",
+                          "local_variables": {"type": "channel"}})
+    buf.build()
+    window = Gtk.Window()
+    window.set_default_size(WIDTHS[0], 700)
+    window.add(buf)
+    window.show_all()
+    buf.active = True
+    buf.display_bulk(lines)
+    buf.scrollbottom()
+    process_events()
+    start = time.perf_counter()
+    for width in WIDTHS:
+        window.resize(width, 700)
+        process_events()
+        time.sleep(1/60)
+    elapsed = time.perf_counter() - start
+    while buf.worst_resize_frame is None:
+        time.sleep(RESIZE_SETTLE_MS / 1000)
+        process_events()
+    window.destroy()
+    process_events()
+    return (elapsed, buf.worst_resize_frame)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    lines = traffic.channel_lines(count)
+    for view in ("text", "virtual"):
+        config = GTKWeechatConfig(os.path.join(tempfile.mkdtemp(),
+                                               "bench.conf"))
+        config.set("look", "max_lines", "0")
+        config.set("look", "chat_view", view)
+        (elapsed, worst) = run(config, lines)
+        print("{:>8}: {} widths in {:.2f} s, worst frame {:.1f} ms".format(
+            view, len(WIDTHS), elapsed, worst))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Lines indexed per second by the search index, and time of queries by
+word, nick and buffer, over channel traffic spread across 50 buffers.
+
+Usage: python3 bench/search_index.py [LINES]
+"""
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+from search import SearchIndex
+import traffic
+
+BUFFERS = 50
+QUERIES = ("the", "build broken", "nick:user12", "nick:user12 segfault",
+           "https example", "unknown")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    lines = traffic.channel_lines(count)
+    index = SearchIndex()
+    start = time.perf_counter()
+    for (number, line) in enumerate(lines):
+        index.add("0x{}".format(number % BUFFERS), number // BUFFERS, line)
+    elapsed = time.perf_counter() - start
+    print("indexing: {:.0f} lines/s, {}".format(count/elapsed, index.info()))
+    for pointer in (None, "0x1"):
+        for query in QUERIES:
+            start = time.perf_counter()
+            found = index.search(query, pointer)
+            elapsed = time.perf_counter() - start
+            print("{:>22} in {}: {:>6} lines in {:.1f} ms".format(
+                repr(query), pointer or "all buffers", len(found),
+                elapsed*1000))
+
+
+if __name__ == "__main__":
+    main()
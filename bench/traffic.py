@@ -0,0 +1,71 @@
+"""Synthetic channel traffic for the benchmarks.
+
+Lines are (date, prefix, message, tags_array) tuples with WeeChat color
+codes, as received from the relay: mostly chat messages from a few hundred
+colored nicks, joins, parts and quits, some colors and URLs in messages.
+"""
+
+import random
+
+NICK_COLORS = ('@00034', '@00069', '@00136', '@00172', '@00202', '10', '12',
+               '13', '14', '06')
+WORDS = ('the', 'build', 'is', 'broken', 'again', 'works', 'for', 'me',
+         'did', 'you', 'try', 'rebasing', 'patch', 'looks', 'good', 'ship',
+         'it', 'lol', 'thanks', 'merged', 'release', 'tonight', 'maybe',
+         'tomorrow', 'segfault', 'in', 'parser', 'ok')
+URLS = ('https://example.org/issues/1234',
+        'http://paste.example.com/raw/abcdef',
+        'https://git.example.net/project/commit/0123456789abcdef')
+
+
+def _nick(rng):
+    return "user{}".format(rng.randrange(300))
+
+
+def _colored_nick(rng, nick):
+    # Like WeeChat, the color of a nick is derived from the nick
+    color = NICK_COLORS[sum(map(ord, nick)) % len(NICK_COLORS)]
+    return "\x19F{}{}".format(color, nick)
+
+
+def _message(rng, urls):
+    words = [rng.choice(WORDS) for _ in range(rng.randrange(3, 20))]
+    if rng.random() < urls:
+        words.insert(rng.randrange(len(words)), rng.choice(URLS))
+    if rng.random() < 0.05:
+        # colored or bold fragment
+        pos = rng.randrange(len(words))
+        words[pos] = "\x19F04\x1A\x01{}\x1B\x01\x1C".format(words[pos])
+    return " ".join(words)
+
+
+def channel_lines(count, urls=0.05, seed=0):
+    """Returns count lines of channel traffic. urls is the fraction of chat
+    messages containing a URL."""
+    rng = random.Random(seed)
+    date = 1600000000
+    lines = []
+    for _ in range(count):
+        date += rng.randrange(30)
+        nick = _nick(rng)
+        kind = rng.random()
+        if kind < 0.8:
+            lines.append((date, _colored_nick(rng, nick), _message(rng, urls),
+                          ("irc_privmsg", "notify_message", "nick_" + nick,
+                           "log1")))
+        elif kind < 0.9:
+            lines.append((date, "\x1907-->", "{} \x1928(\x1927~{}@host{}\x1928)"
+                          "\x1901 has joined \x1913#channel".format(
+                              _colored_nick(rng, nick), nick, rng.randrange(99)),
+                          ("irc_join", "nick_" + nick, "log4")))
+        elif kind < 0.95:
+            lines.append((date, "\x1908<--", "{} \x1928(\x1927~{}@host\x1928)"
+                          "\x1901 has left \x1913#channel".format(
+                              _colored_nick(rng, nick), nick),
+                          ("irc_part", "nick_" + nick, "log4")))
+        else:
+            lines.append((date, "\x1908<--", "{} \x1928(\x1927~{}@host\x1928)"
+                          "\x1901 has quit \x1928(\x1901Ping timeout\x1928)"
+                          .format(_colored_nick(rng, nick), nick),
+                          ("irc_quit", "nick_" + nick, "log4")))
+    return lines
@@ -0,0 +1,57 @@
+"""Throughput of chat lines with URLs: URL detection alone, with and without
+the '://' prefilter, then lines displayed per second in a chat text buffer
+for channels where none, half or all messages contain a URL.
+
+Usage: python3 bench/url_throughput.py [LINES]
+"""
+
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+import color
+from config import GTKWeechatConfig
+from buffer import ChatTextBuffer, URL_PATTERN
+import traffic
+
+
+def detect(messages, prefilter):
+    found = 0
+    for message in messages:
+        if prefilter and "://" not in message:
+            continue
+        found += sum(1 for _ in URL_PATTERN.finditer(message))
+    return found
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    config = GTKWeechatConfig(os.path.join(tempfile.mkdtemp(), "bench.conf"))
+    config.set("look", "max_lines", "0")
+    textview = Gtk.TextView()
+    for urls in (0, 0.5, 1):
+        lines = traffic.channel_lines(count, urls=urls)
+        messages = [color.remove(line[2]) for line in lines]
+        for prefilter in (False, True):
+            start = time.perf_counter()
+            found = detect(messages, prefilter)
+            elapsed = time.perf_counter() - start
+            print("{:>4.0%} URLs, detection{}: {} URLs, {:.0f} lines/s".format(
+                urls, " with prefilter" if prefilter else "", found,
+                count/elapsed))
+        chat = ChatTextBuffer(config, layout=textview.create_pango_layout())
+        start = time.perf_counter()
+        for line in lines:
+            chat.display(*line)
+        elapsed = time.perf_counter() - start
+        print("{:>4.0%} URLs, display: {:.0f} lines/s".format(
+            urls, count/elapsed))
+
+
+if __name__ == "__main__":
+    main()
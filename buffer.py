@@ -19,14 +19,281 @@
 #
 
 from enum import Enum
+import array
+import bisect
+import collections
+import colorsys
 import re
+import sys
 import datetime
-from gi.repository import Gtk, Gdk, GObject, Pango
+import time
+import weakref
+from gi.repository import Gtk, Gdk, GObject, GLib, Pango, PangoCairo
 import color
+from cache import LRUCache
+from linestore import LineStore
+from search import RE_WORD
 
 URL_PATTERN = re.compile(
     r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+")
 
+# Number of style tags below which the shared tag table is never compacted
+STYLE_TAGS_COMPACT_MIN = 256
+
+# Minimum number of lines for which display_bulk detaches the view
+BULK_DISPLAY_MIN = 32
+
+# Flags of ChatLine: preceded by a time stamp, extra space above the prefix
+LINE_TIME = 1
+LINE_SPACED = 2
+
+# Pixels above spaced prefixes, as set by ChatTextBuffer.get_margin_tag
+PREFIX_SPACING = 10
+
+# Pixels to which prefix widths are rounded by ChatTextBuffer.get_margin_tag,
+# so that prefixes of about the same width share a tag
+MARGIN_TAG_STEP = 4
+
+# Number of lines laid out by ChatView beyond each edge of the viewport
+VIEW_MARGIN_LINES = 10
+
+# Number of lines per block of summed heights, see LineHeights
+HEIGHT_BLOCK = 256
+
+# Milliseconds without width change after which a resize is over
+RESIZE_SETTLE_MS = 150
+
+# Number of line heights ChatView estimates again per idle iteration after
+# a resize
+RELAYOUT_CHUNK_LINES = 2000
+
+# Number of prefix widths remembered, see ChatTextBuffer.measure_text
+PREFIX_WIDTH_CACHE_SIZE = 4096
+
+# Tags of the server messages folded into summary lines, with the format of
+# their count in the summary, see Fold
+FOLDED_TAGS = (("irc_join", "+{} joined"), ("irc_part", "-{} left"),
+               ("irc_quit", "-{} quit"), ("irc_nick", "{} renamed"))
+
+# Prefix of the summary lines of folds
+FOLD_PREFIX = "--"
+
+# Foreground and background colors of the text found by the find bar
+FOUND_COLORS = ("#000000", "#fce94f")
+
+_shared_tag_table = None
+_shared_palette = None
+# Whether the palette is in its dark variant, see set_dark_colors
+_dark_colors = False
+
+# Pixel widths of prefixes, keyed by (font description, text, bold)
+_prefix_widths = LRUCache(PREFIX_WIDTH_CACHE_SIZE)
+
+
+def shared_tag_table():
+    """Returns the tag table shared by all chat buffers."""
+    global _shared_tag_table
+    if _shared_tag_table is None:
+        _shared_tag_table = StyleTagTable()
+    return _shared_tag_table
+
+
+def shared_palette(colors):
+    """Returns the palette shared by all chat buffers, for the color
+    references of colors, a color.Color."""
+    global _shared_palette
+    if _shared_palette is None or \
+            _shared_palette.version != colors.palette_version:
+        _shared_palette = Palette(colors, _dark_colors)
+    return _shared_palette
+
+
+def get_fold_kind(tags_array):
+    """Returns the index in FOLDED_TAGS of the kind of a line folded into
+    summary lines, or None if the line is not folded."""
+    for (kind, (tag, _)) in enumerate(FOLDED_TAGS):
+        if tag in tags_array:
+            return kind
+    return None
+
+
+def set_dark_colors(dark):
+    """Switches the palette to its dark or light variant. The text already
+    displayed is retinted."""
+    global _dark_colors
+    _dark_colors = dark
+    if _shared_palette is not None:
+        _shared_palette.dark = dark
+        shared_tag_table().retint(_shared_palette)
+
+
+class Palette():
+    """Colors of the color references of color.Style as ready-made
+    Gdk.RGBA, for the 256 terminal colors and the color options. The dark
+    variant mirrors the lightness of the light one, keeping the contrast
+    between foreground and background colors on a dark theme."""
+
+    def __init__(self, colors, dark=False):
+        self.version = colors.palette_version
+        self.dark = dark
+        self.light_colors = []
+        self.dark_colors = []
+        for rgb in colors.rgb_colors:
+            rgba = Gdk.RGBA()
+            if not rgba.parse(rgb):
+                # unknown color name, use the default color
+                rgba = None
+            self.light_colors.append(rgba)
+            self.dark_colors.append(None if rgba is None else
+                                    self._mirror_lightness(rgba))
+        self.hex_colors = {}
+
+    @staticmethod
+    def _mirror_lightness(rgba):
+        (hue, lightness, saturation) = colorsys.rgb_to_hls(
+            rgba.red, rgba.green, rgba.blue)
+        return Gdk.RGBA(*colorsys.hls_to_rgb(hue, 1 - lightness, saturation),
+                        rgba.alpha)
+
+    def get(self, ref):
+        """Returns the Gdk.RGBA of a color reference in the current variant,
+        or None for the default color."""
+        if self.dark:
+            return self.dark_colors[ref]
+        return self.light_colors[ref]
+
+    def hex(self, ref):
+        """Returns the #rrggbb string of a color reference in the current
+        variant, or None for the default color."""
+        key = (ref, self.dark)
+        value = self.hex_colors.get(key)
+        if value is None:
+            rgba = self.get(ref)
+            if rgba is not None:
+                value = "#{:02x}{:02x}{:02x}".format(
+                    int(rgba.red*255), int(rgba.green*255),
+                    int(rgba.blue*255))
+                self.hex_colors[key] = value
+        return value
+
+
+class StyleTagTable(Gtk.TextTagTable):
+    """Tag table shared by all chat buffers. Text styles are interned: there
+    is one tag per distinct (foreground, background, attributes), whatever
+    the number of lines and buffers using it. Style tags no longer used by
+    any buffer are removed when the number of styles has doubled since the
+    last compaction.
+    """
+
+    def __init__(self):
+        Gtk.TextTagTable.__init__(self)
+        self.styles = {}
+        self.buffers = weakref.WeakSet()
+        self.compact_threshold = STYLE_TAGS_COMPACT_MIN
+        self.compact_source = None
+        self.time_tag = Gtk.TextTag()
+        self.time_tag.props.justification = Gtk.Justification.RIGHT
+        self.time_tag.props.weight = Pango.Weight.BOLD
+        self.add(self.time_tag)
+        # A single tag marks the URLs of all buffers, the URL clicked is
+        # looked up by its offset, see ChatTextBuffer.get_url_at
+        self.url_tag = Gtk.TextTag()
+        self.url_tag.props.underline = Pango.Underline.SINGLE
+        self.url_tag.connect("event", self.on_url_event)
+        self.add(self.url_tag)
+        # Likewise for the summary lines of folds, see get_fold_at
+        self.fold_tag = Gtk.TextTag()
+        self.fold_tag.props.style = Pango.Style.ITALIC
+        self.fold_tag.connect("event", self.on_fold_event)
+        self.add(self.fold_tag)
+        # Text found by the find bar, only in the visible part of buffers
+        self.found_tag = Gtk.TextTag()
+        self.found_tag.props.foreground = FOUND_COLORS[0]
+        self.found_tag.props.background = FOUND_COLORS[1]
+        self.add(self.found_tag)
+
+    @staticmethod
+    def on_url_event(tag, source_object, event, text_iter):
+        """Callback for events on the URL tag, opens the URL clicked."""
+        if not event.type == Gdk.EventType.BUTTON_PRESS:
+            return
+        if not event.button.button == 1:
+            return
+        url = text_iter.get_buffer().get_url_at(text_iter.get_offset())
+        if url is not None:
+            Gtk.show_uri_on_window(None, url, Gdk.CURRENT_TIME)
+
+    @staticmethod
+    def on_fold_event(tag, source_object, event, text_iter):
+        """Callback for events on the fold tag, expands the fold clicked."""
+        if not event.type == Gdk.EventType.BUTTON_PRESS:
+            return
+        if not event.button.button == 1:
+            return
+        buf = text_iter.get_buffer()
+        fold = buf.get_fold_at(text_iter.get_offset())
+        if fold is not None:
+            buf.emit("fold-activated", fold)
+
+    def register_buffer(self, buf):
+        """Registers a buffer using the table, to be checked on compaction."""
+        self.buffers.add(buf)
+
+    def get_style_tag(self, style, palette):
+        """Returns the tag for a color.Style, with the colors of palette."""
+        tag = self.styles.get(style)
+        if tag is not None:
+            return tag
+        attrs = style.attrs
+        tag = Gtk.TextTag()
+        self._tint(tag, style, palette)
+        if "*" in attrs:
+            tag.props.weight = Pango.Weight.BOLD
+        if "_" in attrs:
+            tag.props.underline = Pango.Underline.SINGLE
+        if "/" in attrs:
+            tag.props.style = Pango.Style.ITALIC
+        # reverse video ("!") is not implemented
+        self.add(tag)
+        self.styles[style] = tag
+        if len(self.styles) > self.compact_threshold and \
+                self.compact_source is None:
+            self.compact_source = GLib.idle_add(self.compact)
+        return tag
+
+    @staticmethod
+    def _tint(tag, style, palette):
+        if style.foreground is not None:
+            rgba = palette.get(style.foreground)
+            if rgba is not None:
+                tag.props.foreground_rgba = rgba
+        if style.background is not None:
+            rgba = palette.get(style.background)
+            if rgba is not None:
+                tag.props.background_rgba = rgba
+
+    def retint(self, palette):
+        """Sets the colors of all style tags from palette, e.g. after it has
+        switched to its dark variant. Costs a property change per style, not
+        per line."""
+        for (style, tag) in self.styles.items():
+            self._tint(tag, style, palette)
+
+    def compact(self):
+        """Removes the style tags that are not used by any buffer."""
+        self.compact_source = None
+        for (key, tag) in list(self.styles.items()):
+            for buf in self.buffers:
+                start = buf.get_start_iter()
+                if start.has_tag(tag) or start.forward_to_tag_toggle(tag):
+                    break
+            else:
+                self.remove(tag)
+                del self.styles[key]
+        self.compact_threshold = max(STYLE_TAGS_COMPACT_MIN,
+                                     2*len(self.styles))
+        return False
+
 
 class MessageType(Enum):
     """Definition of message types."""
@@ -35,39 +302,289 @@ class MessageType(Enum):
     TIME_STAMP = 2
 
 
-class ChatTextBuffer(Gtk.TextBuffer):
+class ChatBase():
+    """Code shared by the models of the chat views, ChatTextBuffer and
+    ChatLines: message types and the alignment of text after prefixes.
+    Requires the layout, longest_prefix attributes and update_margins."""
+
+    def measure_text(self, text, bold=False):
+        """Returns the width of text in pixels, in the font of the buffer."""
+        font = self.layout.get_context().get_font_description()
+        key = (font.to_string() if font else "", text, bold)
+        width = _prefix_widths.get(key)
+        if width is not None:
+            return width
+        self.layout.set_text(text, -1)
+        self.layout.set_attributes(None)
+        if bold:
+            # workaround to get an attribute list in pygobject:
+            attr_list = Pango.parse_markup(
+                "<b>"+GLib.markup_escape_text(text)+"</b>", -1, "0")[1]
+            self.layout.set_attributes(attr_list)
+        (width, _) = self.layout.get_pixel_size()
+        _prefix_widths.put(key, width)
+        return width
+
+    def get_text_pixel_width(self, text, bold=False):
+        width = self.measure_text(text, bold)
+        if width > self.longest_prefix:
+            self.longest_prefix = width
+            self.update_margins()
+        return width
+
+    def get_prefix_width(self, runs):
+        """Returns the width of a prefix given as color.Color.tokenize runs,
+        realigning lines if it is the longest prefix."""
+        bold = bool(runs) and runs[-1][1] is not None and \
+            "*" in runs[-1][1].attrs
+        return self.get_text_pixel_width(''.join(run[0] for run in runs),
+                                         bold)
+
+    def rgb(self, ref):
+        """Returns the RGB string of a color reference of a color.Style, in
+        the current variant of the palette, or None for the default color."""
+        return self.palette.hex(ref)
+
+    def measure_prefixes(self, prefixes):
+        """Measures prefixes, such as the nicks in the nicklist, in advance
+        so that text is aligned before they are displayed."""
+        width = max((self.measure_text(prefix) for prefix in prefixes),
+                    default=0)
+        if width > self.longest_prefix:
+            self.longest_prefix = width
+            self.update_margins()
+
+    def on_style_updated(self):
+        """Must be called when the font or theme of the view has changed."""
+        self.layout.context_changed()
+        _prefix_widths.clear()
+
+    def reset_state(self):
+        """Forgets the previous lines, so that the next line is displayed as
+        the first one."""
+        self.last_prefix = None
+        self.last_message_type = None
+        self.d_previous = datetime.datetime.fromtimestamp(0)
+
+    def get_state(self):
+        """Returns what the display of the next line depends on, to be
+        restored by set_state when the lines after it are removed."""
+        return (self.last_prefix, self.last_message_type, self.d_previous)
+
+    def set_state(self, state):
+        (self.last_prefix, self.last_message_type, self.d_previous) = state
+
+    def get_message_type(self, tags_array):
+        if "irc_privmsg" in tags_array:
+            return MessageType.CHAT_MESSAGE
+        else:
+            return MessageType.SERVER_MESSAGE
+
+
+class ChatTextBuffer(Gtk.TextBuffer, ChatBase):
     """Textbuffer to store buffer text."""
+    __gsignals__ = {
+        'fold-activated': (GObject.SIGNAL_RUN_LAST, None, (int,))
+    }
 
     def __init__(self, config, layout=None):
-        Gtk.TextBuffer.__init__(self)
+        Gtk.TextBuffer.__init__(self, tag_table=shared_tag_table())
         self.config = config
         self.layout = layout
         self.last_prefix = None
         self.last_message_type = None
         self.longest_prefix = 0
-        self.indent_tag_list = []
+        # Margin tags aligning text after prefixes, see get_margin_tag
+        self.margin_tags = {}
+        # URLs displayed, as (start, end, url) character offsets counted
+        # from the first character ever inserted, i.e. offsets in the buffer
+        # plus trimmed_chars, the number of characters trimmed since.
+        self.urls = []
+        self.trimmed_chars = 0
+        # Summary lines of folds, as (start, end, fold) like urls
+        self.folds = []
         self.d_previous = datetime.datetime.fromtimestamp(0)
 
-        # We need the color class that convert formatting codes in network
-        # data to codes that the parser functions in this class can handle
+        # We need the color class that splits network data into runs of
+        # text with their styles
         self._color = color.Color(config.color_options(), False)
+        self.palette = shared_palette(self._color)
+
+        # Text tags used for formatting, shared with all other buffers
+        tag_table = self.get_tag_table()
+        tag_table.register_buffer(self)
+        self.time_tag = tag_table.time_tag
+        self.url_tag = tag_table.url_tag
+        self.fold_tag = tag_table.fold_tag
+        self.found_tag = tag_table.found_tag
+        # Mark with right gravity, staying after inserted text
+        self.end_mark = self.create_mark(None, self.get_end_iter(), False)
+        # Start of the lines removed by remove_marked, and the state then
+        self.tail_mark = self.create_mark(None, self.get_end_iter(), True)
+        self.tail_state = None
+        # Where display inserts text: the end, except in expand_fold
+        self.insert_mark = self.create_mark(None, self.get_end_iter(), False)
 
-        # Text tags used for formatting
-        self.time_tag = self.create_tag(
-            justification=Gtk.Justification.RIGHT, weight=Pango.Weight.BOLD)
-        bold_tag = self.create_tag(weight=Pango.Weight.BOLD)
-        underline_tag = self.create_tag(underline=Pango.Underline.SINGLE)
-        italic_tag = self.create_tag(style=Pango.Style.ITALIC)
-        reverse_tag = self.create_tag()  # reverse video is not implemented
-        self.attr_tag = {"*": bold_tag, "_": underline_tag,
-                         "/": italic_tag, "!": reverse_tag}
-        self.url_tag = self.create_tag(underline=Pango.Underline.SINGLE)
+    def release_tags(self):
+        """Removes the tags owned by this buffer from the shared tag table.
+        Must be called when the buffer is no longer used."""
+        tag_table = self.get_tag_table()
+        for tag in self.margin_tags.values():
+            tag_table.remove(tag)
+        self.margin_tags = {}
+
+    def clear(self):
+        """Removes all lines."""
+        self.trimmed_chars += self.get_char_count()
+        self.urls = []
+        self.folds = []
+        self.delete(*self.get_bounds())
+        self.release_tags()
+        self.reset_state()
+
+    def trim_to(self, position):
+        """Removes the text, with its tags, before position, as returned by
+        get_end_position when a line was displayed. Returns True if text was
+        removed."""
+        offset = min(position - self.trimmed_chars, self.get_char_count())
+        if offset <= 0:
+            return False
+        self.trimmed_chars += offset
+        self.delete(self.get_start_iter(), self.get_iter_at_offset(offset))
+        # URLs are recorded in order, drop those of the removed lines
+        for ranges in (self.urls, self.folds):
+            del ranges[:bisect.bisect_left(ranges, (self.trimmed_chars,))]
+        return True
+
+    def get_end_position(self):
+        """Returns the position of the next line displayed, its offset
+        counted as those of urls."""
+        return self.trimmed_chars + self.get_char_count()
+
+    def mark_tail(self):
+        """Marks the end of the text: the lines displayed from now on can be
+        removed by remove_marked."""
+        self.move_mark(self.tail_mark, self.get_end_iter())
+        self.tail_state = self.get_state()
+
+    def remove_marked(self):
+        """Removes the lines displayed since mark_tail."""
+        start = self.get_iter_at_mark(self.tail_mark)
+        offset = self.trimmed_chars + start.get_offset()
+        self.delete(start, self.get_end_iter())
+        for ranges in (self.urls, self.folds):
+            del ranges[bisect.bisect_left(ranges, (offset,)):]
+        self.set_state(self.tail_state)
+
+    def display_fold(self, time, summary, fold):
+        """Displays the summary line of a fold, which expands when clicked.
+        fold is the number of the first line folded."""
+        start = self.get_char_count()
+        self.display(time, FOLD_PREFIX, summary, ())
+        self.apply_tag(self.fold_tag, self.get_iter_at_offset(start),
+                       self.get_end_iter())
+        self.folds.append((self.trimmed_chars + start,
+                           self.trimmed_chars + self.get_char_count(), fold))
+
+    def expand_fold(self, start, end, lines):
+        """Replaces the summary line of a fold, from position start to end,
+        by the lines folded, (date, prefix, message, tags_array) tuples.
+        The ranges after it are shifted. Returns the positions of the lines
+        and the position of their end."""
+        tail = {}
+        for name in ("urls", "folds"):
+            ranges = getattr(self, name)
+            tail[name] = ranges[bisect.bisect_left(ranges, (end,)):]
+            del ranges[bisect.bisect_left(ranges, (start,)):]
+        self.delete(self.get_iter_at_offset(start - self.trimmed_chars),
+                    self.get_iter_at_offset(end - self.trimmed_chars))
+        self.move_mark(self.insert_mark,
+                       self.get_iter_at_offset(start - self.trimmed_chars))
+        state = self.get_state()
+        # Folded lines are server messages, displayed as after a line with
+        # another prefix
+        self.set_state((None, MessageType.SERVER_MESSAGE, self.d_previous))
+        positions = []
+        for line in lines:
+            positions.append(self.trimmed_chars + self._get_insert_iter()
+                             .get_offset())
+            self.display(*line)
+        new_end = self.trimmed_chars + self._get_insert_iter().get_offset()
+        self.set_state(state)
+        self.move_mark(self.insert_mark, self.get_end_iter())
+        delta = new_end - end
+        for (name, ranges) in tail.items():
+            getattr(self, name).extend((range_start + delta,
+                                        range_end + delta, value)
+                                       for (range_start, range_end, value)
+                                       in ranges)
+        return (positions, new_end)
+
+    def _get_insert_iter(self):
+        return self.get_iter_at_mark(self.insert_mark)
+
+    @staticmethod
+    def _get_range_at(ranges, offset):
+        index = bisect.bisect_right(ranges, (offset, sys.maxsize)) - 1
+        if index >= 0 and offset < ranges[index][1]:
+            return ranges[index][2]
+        return None
+
+    def get_url_at(self, offset):
+        """Returns the URL displayed at a character offset, or None."""
+        return self._get_range_at(self.urls, offset + self.trimmed_chars)
+
+    def get_fold_at(self, offset):
+        """Returns the fold whose summary line is displayed at a character
+        offset, or None."""
+        return self._get_range_at(self.folds, offset + self.trimmed_chars)
+
+    def get_margin_tag(self, width=None, spaced=False):
+        """Returns the tag aligning a line whose prefix is width pixels wide,
+        and that has extra space above if spaced is True. With width None,
+        returns the tag aligning a line without prefix with the text of
+        other lines. Widths are rounded to MARGIN_TAG_STEP pixels, there is
+        one tag per rounded width, shared by all lines with that width.
+        """
+        if width is not None:
+            width = MARGIN_TAG_STEP*round(width/MARGIN_TAG_STEP)
+        key = (width, spaced)
+        tag = self.margin_tags.get(key)
+        if tag is None:
+            tag = self.create_tag()
+            if width is not None:
+                tag.props.indent = -width
+            if spaced:
+                tag.props.pixels_above_lines = PREFIX_SPACING
+            self.margin_tags[key] = tag
+            self._set_left_margin(key, tag)
+        return tag
+
+    def _set_left_margin(self, key, tag):
+        margin = self.longest_prefix + int(self.config.get('look',
+                                                           'margin_size'))
+        if key[0] is not None:
+            margin -= key[0]
+        tag.props.left_margin = margin
+
+    def update_margins(self):
+        """Realigns all lines after the longest prefix has changed. Costs one
+        property change per margin tag, not per line. The tags no longer
+        applied to any line, e.g. since their lines were trimmed, are
+        released."""
+        tag_table = self.get_tag_table()
+        for (key, tag) in list(self.margin_tags.items()):
+            start = self.get_start_iter()
+            if start.has_tag(tag) or start.forward_to_tag_toggle(tag):
+                self._set_left_margin(key, tag)
+            else:
+                tag_table.remove(tag)
+                del self.margin_tags[key]
 
     def display(self, time, prefix, text, tags_array):
         """Adds text to the buffer."""
         message_type = self.get_message_type(tags_array)
-        prefix = self._color.convert(prefix)
-        text = self._color.convert(text)
+        prefix = prefix or ""
         has_prefix = False
         if time == 0:
             d = datetime.datetime.now()
@@ -75,7 +592,7 @@ class ChatTextBuffer(Gtk.TextBuffer):
             d = datetime.datetime.fromtimestamp(float(time))
         delta = d-self.d_previous
         if delta.total_seconds() >= 5*60 and message_type != MessageType.SERVER_MESSAGE and prefix != self.last_prefix:
-            self.insert_with_tags(self.get_end_iter(), d.strftime(
+            self.insert_with_tags(self._get_insert_iter(), d.strftime(
                 self.config.get('look', 'buffer_time_format')) + "\n",
                 self.time_tag)
             self.last_message_type = MessageType.TIME_STAMP
@@ -94,118 +611,883 @@ class ChatTextBuffer(Gtk.TextBuffer):
             self._display_with_colors(
                 text, indent="no_prefix" if has_prefix == False else "text", msg_type=message_type)
             if text[-1] != "\n":
-                self.insert(self.get_end_iter(), "\n")
+                self.insert(self._get_insert_iter(), "\n")
         else:
-            self.insert(self.get_end_iter(), "\n")
+            self.insert(self._get_insert_iter(), "\n")
         self.last_message_type = message_type
 
     def _display_with_colors(self, string, indent=False, msg_type=MessageType.CHAT_MESSAGE):
-        indent_tag = self.create_tag()
-        self.indent_tag_list.append(indent_tag)
-        items = string.split('\x01')
-        color_tag = self.create_tag()
-        attr_list = []
-        stripped_items = []
-        # The way split works, the first item will be
-        # either '' or not preceded by \x01
-        if len(items[0]) > 0:
-            self.insert_with_tags(self.get_end_iter(), items[0], indent_tag)
-            stripped_items.append(items[0])
-        for item in items[1:]:
-            if item.startswith('('):
-                pos = item.find(')')
-                if pos >= 2:
-                    action = item[1]
-                    code = item[2:pos]
-                    if action == '+':
-                        # set attribute
-                        attr_list.append(self.attr_tag[code[0]])
-                    elif action == '-':
-                        if self.attr_tag[code[0]] in attr_list:
-                            attr_list.remove(self.attr_tag[code[0]])
-                    else:
-                        # reset attributes and color
-                        if code == 'r':
-                            color_tag = self.create_tag()
-                            attr_list = []
-                        else:
-                            # set attributes + color
-                            while code.startswith(('*', '!', '/', '_', '|',
-                                                   'r')):
-                                if code[0] == 'r':
-                                    color_tag = self.create_tag()
-                                    attr_list = []
-                                elif code[0] in self.attr_tag:
-                                    attr_list.append(self.attr_tag[code[0]])
-                                code = code[1:]
-                            if code:
-                                if action == "F":
-                                    if code != "$":
-                                        rgba = Gdk.RGBA()
-                                        rgba.parse(code)
-                                        color_tag = self.create_tag(
-                                            foreground_rgba=rgba)
-                                elif action == "B":
-                                    if code != "$":
-                                        rgba = Gdk.RGBA()
-                                        rgba.parse(code)
-                                        color_tag.props.background_rgba = rgba
-                    item = item[pos+1:]
-            if len(item) > 0:
-                self.insert_with_tags(
-                    self.get_end_iter(), item, color_tag, *attr_list, indent_tag)
-                stripped_items.append(item)
+        tag_table = self.get_tag_table()
+        styled_runs = self._color.tokenize(string)
+        # List of (text, style tag) to insert
+        runs = [(text, None if style is None else
+                 tag_table.get_style_tag(style, self.palette))
+                for (text, style) in styled_runs]
+        stripped_items = ''.join(run[0] for run in runs)
         if indent == "prefix":
-            text = ''.join(stripped_items)
-            width = self.get_text_pixel_width(
-                text, True if self.attr_tag["*"] in attr_list else False)
-            indent_tag.props.indent = -width
-            indent_tag.props.left_margin = self.longest_prefix - \
-                width+int(self.config.get('look', 'margin_size'))
-            if self.last_message_type != MessageType.TIME_STAMP and (msg_type == MessageType.CHAT_MESSAGE or msg_type != self.last_message_type):
-                indent_tag.props.pixels_above_lines = 10
-        elif indent == "no_prefix":
-            indent_tag.props.left_margin = self.longest_prefix + \
-                int(self.config.get('look', 'margin_size'))
-        if indent in ("no_prefix", "text"):
-            stripped_items = ''.join(stripped_items)
+            width = self.get_prefix_width(styled_runs)
+            spaced = self.last_message_type != MessageType.TIME_STAMP and (
+                msg_type == MessageType.CHAT_MESSAGE or
+                msg_type != self.last_message_type)
+            margin_tag = self.get_margin_tag(width, spaced)
+        else:
+            # Text following a prefix takes its paragraph properties from the
+            # prefix, this tag aligns continuation lines of the message.
+            margin_tag = self.get_margin_tag()
+        for (text, style_tag) in runs:
+            if style_tag is None:
+                self.insert_with_tags(self._get_insert_iter(), text, margin_tag)
+            else:
+                self.insert_with_tags(
+                    self._get_insert_iter(), text, style_tag, margin_tag)
+        # Most text has no URL, skip the regular expression then
+        if indent in ("no_prefix", "text") and "://" in stripped_items:
+            offset = self._get_insert_iter().get_offset() - \
+                len(stripped_items)
             for url_match in URL_PATTERN.finditer(stripped_items):
-                span = url_match.span()
-                start = self.get_end_iter()
-                start.backward_chars(len(stripped_items)-span[0])
-                end = self.get_end_iter()
-                end.backward_chars(len(stripped_items)-span[1])
-                tag = self.create_tag()
-                tag.connect("event", self.on_url_clicked, url_match[0])
-                self.apply_tag(tag, start, end)
-                self.apply_tag(self.url_tag, start, end)
-
-    def on_url_clicked(self, tag, source_object, event, text_iter, arg):
-        if not event.type == Gdk.EventType.BUTTON_PRESS:
+                (start, end) = url_match.span()
+                self.apply_tag(self.url_tag,
+                               self.get_iter_at_offset(offset + start),
+                               self.get_iter_at_offset(offset + end))
+                self.urls.append((self.trimmed_chars + offset + start,
+                                  self.trimmed_chars + offset + end,
+                                  url_match[0]))
+
+
+# A line of ChatLines. fold is the number of the first line folded if the
+# line is the summary line of a fold, None otherwise.
+ChatLine = collections.namedtuple(
+    'ChatLine', ('date', 'prefix', 'width', 'message', 'flags', 'fold'))
+
+
+class ChatLines(GObject.GObject, ChatBase):
+    """Lines of a chat buffer, displayed by a ChatView. Lines are kept as
+    received: their colors are parsed and they are laid out only when
+    the view draws them. Only what depends on the previous lines, such as
+    whether the prefix is shown, is decided when a line is added.
+    """
+    __gsignals__ = {
+        'lines-added': (GObject.SIGNAL_RUN_LAST, None, (int,)),
+        'lines-removed': (GObject.SIGNAL_RUN_LAST, None, (int,)),
+        'tail-removed': (GObject.SIGNAL_RUN_LAST, None, (int,)),
+        'lines-replaced': (GObject.SIGNAL_RUN_LAST, None, (int, int, int)),
+        'margins-changed': (GObject.SIGNAL_RUN_LAST, None, tuple()),
+        'fold-activated': (GObject.SIGNAL_RUN_LAST, None, (int,))
+    }
+
+    def __init__(self, config, layout=None):
+        GObject.GObject.__init__(self)
+        self.config = config
+        self.layout = layout
+        self.lines = []
+        # Number of lines removed so far. Line numbers, first + index, stay
+        # the same when older lines are removed.
+        self.first = 0
+        self.last_prefix = None
+        self.last_message_type = None
+        self.longest_prefix = 0
+        self.d_previous = datetime.datetime.fromtimestamp(0)
+        # Number of the first line removed by remove_marked, and the state
+        self.tail_number = 0
+        self.tail_state = None
+        self._color = color.Color(config.color_options(), False)
+        self.palette = shared_palette(self._color)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        return self.lines[index]
+
+    def get_line_count(self):
+        return len(self.lines)
+
+    def display(self, time, prefix, text, tags_array, fold=None):
+        """Adds a line, the summary line of a fold if fold is not None."""
+        self.lines.append(self._make_line(time, prefix, text, tags_array,
+                                          fold))
+        self.emit("lines-added", 1)
+
+    def _make_line(self, time, prefix, text, tags_array, fold=None):
+        message_type = self.get_message_type(tags_array)
+        prefix = prefix or ""
+        flags = 0
+        if time == 0:
+            d = datetime.datetime.now()
+        else:
+            d = datetime.datetime.fromtimestamp(float(time))
+        delta = d-self.d_previous
+        if delta.total_seconds() >= 5*60 and message_type != MessageType.SERVER_MESSAGE and prefix != self.last_prefix:
+            flags |= LINE_TIME
+            self.last_message_type = MessageType.TIME_STAMP
+            self.d_previous = d
+        shown_prefix = None
+        width = 0
+        if prefix is not None and prefix != self.last_prefix:
+            if message_type == MessageType.SERVER_MESSAGE:
+                prefix = prefix.replace("-->", "\u27F6")
+                prefix = prefix.replace("<--", "\u27F5")
+                prefix = prefix.replace("--", "\u2014")
+            self.last_prefix = prefix
+            shown_prefix = prefix + " "
+            width = self.get_prefix_width(self._color.tokenize(shown_prefix))
+            if self.last_message_type != MessageType.TIME_STAMP and (
+                    message_type == MessageType.CHAT_MESSAGE or
+                    message_type != self.last_message_type):
+                flags |= LINE_SPACED
+        self.last_message_type = message_type
+        return ChatLine(d.timestamp(), shown_prefix, width, text or "",
+                        flags, fold)
+
+    def get_end_position(self):
+        """Returns the position of the next line added, its line number."""
+        return self.first + len(self.lines)
+
+    def mark_tail(self):
+        """Marks the end of the lines: the lines added from now on can be
+        removed by remove_marked."""
+        self.tail_number = self.first + len(self.lines)
+        self.tail_state = self.get_state()
+
+    def remove_marked(self):
+        """Removes the lines added since mark_tail."""
+        count = self.first + len(self.lines) - max(self.tail_number,
+                                                   self.first)
+        if count > 0:
+            del self.lines[-count:]
+            self.emit("tail-removed", count)
+        self.set_state(self.tail_state)
+
+    def display_fold(self, time, summary, fold):
+        """Adds the summary line of a fold, fold being the number of the
+        first line folded."""
+        self.display(time, FOLD_PREFIX, summary, (), fold)
+
+    def expand_fold(self, start, end, lines):
+        """Replaces the summary line of a fold, from line number start to
+        end, by the lines folded, as ChatTextBuffer.expand_fold. The lines
+        after it are renumbered. Returns the numbers of the lines and the
+        number of the line after them."""
+        state = self.get_state()
+        self.set_state((None, MessageType.SERVER_MESSAGE, self.d_previous))
+        new = [self._make_line(*line) for line in lines]
+        self.set_state(state)
+        self.lines[start - self.first:end - self.first] = new
+        delta = len(new) - (end - start)
+        if self.tail_number >= end:
+            self.tail_number += delta
+        self.emit("lines-replaced", start, end - start, len(new))
+        return (list(range(start, start + len(new))), end + delta)
+
+    def get_runs(self, line):
+        """Returns the runs of text of a line, as color.Color.tokenize, and
+        the offset of the message in the text of the line."""
+        runs = []
+        if line.prefix is not None:
+            runs = self._color.tokenize(line.prefix)
+        start = sum(len(run[0]) for run in runs)
+        message = line.message
+        if message.endswith("\n"):
+            message = message[:-1]
+        return (runs + self._color.tokenize(message), start)
+
+    def update_margins(self):
+        self.emit("margins-changed")
+
+    def release_tags(self):
+        """Nothing to release, lines have no tags."""
+
+    def clear(self):
+        """Removes all lines."""
+        count = len(self.lines)
+        self.lines = []
+        self.first += count
+        self.reset_state()
+        self.emit("lines-removed", count)
+
+    def trim_to(self, position):
+        """Removes the lines before position, a line number as returned by
+        get_end_position, as ChatTextBuffer.trim_to. Returns True if lines
+        were removed."""
+        count = min(position - self.first, len(self.lines))
+        if count <= 0:
+            return False
+        del self.lines[:count]
+        self.first += count
+        self.emit("lines-removed", count)
+        return True
+
+
+class LineHeights():
+    """Heights of the lines of a ChatView, with the sum of every block of
+    HEIGHT_BLOCK lines, to find the line at an offset without adding up the
+    heights of all lines above it."""
+
+    def __init__(self):
+        self.heights = []
+        self.blocks = []
+        self.total = 0
+
+    def __len__(self):
+        return len(self.heights)
+
+    def __getitem__(self, index):
+        return self.heights[index]
+
+    def reset(self, heights):
+        """Replaces all heights."""
+        self.heights = heights
+        self.blocks = [sum(heights[i:i+HEIGHT_BLOCK])
+                       for i in range(0, len(heights), HEIGHT_BLOCK)]
+        self.total = sum(self.blocks)
+
+    def append(self, height):
+        if len(self.heights) % HEIGHT_BLOCK == 0:
+            self.blocks.append(0)
+        self.heights.append(height)
+        self.blocks[-1] += height
+        self.total += height
+
+    def set(self, index, height):
+        delta = height - self.heights[index]
+        if delta:
+            self.heights[index] = height
+            self.blocks[index // HEIGHT_BLOCK] += delta
+            self.total += delta
+
+    def remove_head(self, count):
+        """Removes the heights of the first count lines."""
+        self.reset(self.heights[count:])
+
+    def remove_tail(self, count):
+        """Removes the heights of the last count lines."""
+        for _ in range(count):
+            height = self.heights.pop()
+            self.blocks[-1] -= height
+            self.total -= height
+            if len(self.heights) % HEIGHT_BLOCK == 0:
+                self.blocks.pop()
+
+    def top(self, index):
+        """Returns the offset of the top of line index."""
+        block = index // HEIGHT_BLOCK
+        return sum(self.blocks[:block]) + \
+            sum(self.heights[block*HEIGHT_BLOCK:index])
+
+    def find(self, offset):
+        """Returns (index, offset of its top) of the line at offset, or the
+        number of lines and the total height if offset is past the end."""
+        top = 0
+        for (block, block_height) in enumerate(self.blocks):
+            if top + block_height > offset:
+                index = block * HEIGHT_BLOCK
+                for height in self.heights[index:index+HEIGHT_BLOCK]:
+                    if top + height > offset:
+                        return (index, top)
+                    top += height
+                    index += 1
+            top += block_height
+        return (len(self.heights), top)
+
+
+# A line of a ChatView as laid out: the layout of its time stamp if any,
+# the position of the layout of the text, the height of the line, the text
+# and its URLs as (start, end, url) character offsets.
+LaidOutLine = collections.namedtuple(
+    'LaidOutLine', ('time', 'x', 'y', 'layout', 'height', 'text', 'urls'))
+
+
+class ChatView(Gtk.DrawingArea, Gtk.Scrollable):
+    """Chat view for a ChatLines model, an alternative to Gtk.TextView for
+    long scrollbacks. Only the lines in the viewport, and VIEW_MARGIN_LINES
+    lines around it, are laid out. The height of other lines is estimated
+    from their length and refined when they are laid out, so memory and
+    layout costs do not grow with the scrollback. Lines are selected with
+    the mouse and URLs open on click, as in the text view.
+
+    When the width changes, only the lines in the viewport are laid out
+    again at once. The heights of the others are estimated again once the
+    width has settled, from the bottom up, in idle time.
+    """
+    hadjustment = GObject.Property(type=Gtk.Adjustment)
+    vadjustment = GObject.Property(type=Gtk.Adjustment)
+    hscroll_policy = GObject.Property(type=Gtk.ScrollablePolicy,
+                                      default=Gtk.ScrollablePolicy.MINIMUM)
+    vscroll_policy = GObject.Property(type=Gtk.ScrollablePolicy,
+                                      default=Gtk.ScrollablePolicy.MINIMUM)
+
+    def __init__(self, config):
+        Gtk.DrawingArea.__init__(self)
+        self.config = config
+        self.margin_size = int(config.get('look', 'margin_size'))
+        self.lines = None
+        self.line_handlers = []
+        self.heights = LineHeights()
+        # Laid out lines, keyed by line number (see ChatLines.first)
+        self.layouts = {}
+        self.layout_width = 0
+        # Line numbers [start, end) whose heights were estimated for another
+        # width, and the source estimating them again
+        self.stale = (0, 0)
+        self.relayout_source = None
+        self.char_width = 8
+        self.line_height = 16
+        self.span_attributes = {}
+        self.selected_colors = ("#ffffff", "#4a90d9")
+        # Pattern of the text highlighted in the lines of highlight_lines,
+        # see set_highlight
+        self.highlight = None
+        self.highlight_lines = frozenset()
+        # Selection as (anchor, cursor), both (line number, offset)
+        self.selection = None
+        self.pressed = None
+        self.adjustment = None
+        self.adjustment_handler = None
+        self.detached_anchor = None
+        self.get_style_context().add_class(Gtk.STYLE_CLASS_VIEW)
+        self.add_events(Gdk.EventMask.BUTTON_PRESS_MASK |
+                        Gdk.EventMask.BUTTON_RELEASE_MASK |
+                        Gdk.EventMask.POINTER_MOTION_MASK)
+        self.connect("notify::vadjustment", self.on_vadjustment_changed)
+        self.pointer_cursor = Gdk.Cursor.new_from_name(
+            Gdk.Display.get_default(), "pointer")
+        self.text_cursor = Gdk.Cursor.new_from_name(
+            Gdk.Display.get_default(), "text")
+
+    def set_buffer(self, lines):
+        """Sets the ChatLines displayed. Can be set to None meanwhile many
+        lines are added, so that their heights are estimated at once."""
+        if self.lines is not None:
+            self.detached_anchor = self._get_anchor()
+            for handler in self.line_handlers:
+                self.lines.disconnect(handler)
+            self.line_handlers = []
+        self.lines = lines
+        self.layouts = {}
+        self._estimate_heights()
+        if lines is not None:
+            self.line_handlers = [
+                lines.connect("lines-added", self.on_lines_added),
+                lines.connect("lines-removed", self.on_lines_removed),
+                lines.connect("tail-removed", self.on_tail_removed),
+                lines.connect("lines-replaced", self.on_lines_replaced),
+                lines.connect("margins-changed", self.on_margins_changed)]
+            self._set_anchor(self.detached_anchor)
+        self.queue_draw()
+
+    def set_monospace(self, monospace):
+        """Uses a monospace font, as Gtk.TextView.set_monospace."""
+        if monospace:
+            self.get_style_context().add_class(Gtk.STYLE_CLASS_MONOSPACE)
+        else:
+            self.get_style_context().remove_class(Gtk.STYLE_CLASS_MONOSPACE)
+
+    def on_vadjustment_changed(self, *args):
+        if self.adjustment_handler is not None:
+            self.adjustment.disconnect(self.adjustment_handler)
+            self.adjustment_handler = None
+        self.adjustment = self.props.vadjustment
+        if self.adjustment is not None:
+            self.adjustment_handler = self.adjustment.connect(
+                "value-changed", self.on_value_changed)
+            self._set_anchor(None)
+
+    def on_value_changed(self, adjustment):
+        self.queue_draw()
+
+    def on_lines_added(self, lines, count):
+        anchor = self._get_anchor()
+        for line in lines.lines[-count:]:
+            self.heights.append(self._estimate_height(line))
+        self._set_anchor(anchor)
+        self.queue_draw()
+
+    def on_lines_removed(self, lines, count):
+        anchor = self._get_anchor()
+        self.heights.remove_head(count)
+        self.layouts = {number: laid_out
+                        for (number, laid_out) in self.layouts.items()
+                        if number >= lines.first}
+        if self.selection is not None and \
+                min(self.selection)[0] < lines.first:
+            self.selection = None
+        self._set_anchor(anchor)
+        self.queue_draw()
+
+    def on_tail_removed(self, lines, count):
+        anchor = self._get_anchor()
+        self.heights.remove_tail(count)
+        end = lines.first + len(lines)
+        self.layouts = {number: laid_out
+                        for (number, laid_out) in self.layouts.items()
+                        if number < end}
+        self.stale = (self.stale[0], min(self.stale[1], end))
+        if self.selection is not None and max(self.selection)[0] >= end:
+            self.selection = None
+        self._set_anchor(anchor)
+        self.queue_draw()
+
+    def on_lines_replaced(self, lines, start, removed, added):
+        anchor = self._get_anchor()
+        end = start + removed
+        delta = added - removed
+        if anchor is not None and anchor[0] >= start:
+            # A line replaced keeps the top of the viewport on the first new
+            anchor = (anchor[0] + delta, anchor[1]) if anchor[0] >= end \
+                else (start, 0)
+        index = start - lines.first
+        heights = self.heights.heights
+        self.heights.reset(
+            heights[:index] +
+            [self._estimate_height(line)
+             for line in lines.lines[index:index + added]] +
+            heights[index + removed:])
+        self.layouts = {number + delta if number >= end else number: laid_out
+                        for (number, laid_out) in self.layouts.items()
+                        if not start <= number < end}
+        if self.stale[1] > start:
+            (stale_start, stale_end) = self.stale
+            if stale_start >= start:
+                stale_start = max(start, stale_start + delta)
+            self.stale = (stale_start, max(start, stale_end + delta))
+        self.selection = None
+        self._set_anchor(anchor)
+        self.queue_draw()
+
+    def on_margins_changed(self, lines):
+        self.layouts = {}
+        self.queue_draw()
+
+    def _get_anchor(self):
+        """Returns the position of the top of the viewport, as (line number,
+        offset in the line), or None if the view shows the bottom."""
+        adj = self.adjustment
+        if adj is None or self.lines is None or \
+                adj.get_value() + adj.get_page_size() >= adj.get_upper():
+            return None
+        (index, top) = self.heights.find(adj.get_value())
+        return (self.lines.first + index, adj.get_value() - top)
+
+    def _set_anchor(self, anchor):
+        """Updates the adjustment after heights have changed, so that the
+        viewport starts at anchor, as returned by _get_anchor."""
+        adj = self.adjustment
+        if adj is None or self.lines is None:
             return
-        if not event.button.button == 1:
+        page = self.get_allocated_height()
+        upper = max(self.heights.total, page)
+        if anchor is None:
+            value = upper - page
+        else:
+            index = anchor[0] - self.lines.first
+            value = self.heights.top(index) + anchor[1] if index >= 0 else 0
+        value = max(0, min(value, upper - page))
+        adj.configure(value, 0, upper, self.line_height, page * 0.9, page)
+
+    def _estimate_height(self, line):
+        """Returns the height of a line from the length of its text, color
+        codes included."""
+        length = len(line.message)
+        if line.prefix is not None:
+            length += len(line.prefix)
+        width = self.layout_width - 2 * self.margin_size - \
+            self.lines.longest_prefix
+        rows = 1
+        if width > 0:
+            rows += length * self.char_width // width
+        height = rows * self.line_height
+        if line.flags & LINE_TIME:
+            height += self.line_height
+        if line.flags & LINE_SPACED:
+            height += PREFIX_SPACING
+        return height
+
+    def _estimate_heights(self):
+        self._set_relayout(None)
+        self.stale = (0, 0)
+        if self.lines is None:
+            self.heights.reset([])
+        else:
+            self.heights.reset([self._estimate_height(line)
+                                for line in self.lines.lines])
+
+    def _set_relayout(self, source):
+        if self.relayout_source is not None:
+            GLib.source_remove(self.relayout_source)
+        self.relayout_source = source
+
+    def on_relayout_timeout(self):
+        """Starts estimating the stale heights again, once the width has
+        not changed for RESIZE_SETTLE_MS."""
+        self.relayout_source = GLib.idle_add(self.on_relayout_idle)
+        return GLib.SOURCE_REMOVE
+
+    def on_relayout_idle(self):
+        """Estimates the heights of the last RELAYOUT_CHUNK_LINES stale
+        lines for the current width."""
+        if self.lines is None:
+            self.relayout_source = None
+            return GLib.SOURCE_REMOVE
+        anchor = self._get_anchor()
+        first = self.lines.first
+        (start, end) = (max(self.stale[0], first), self.stale[1])
+        chunk_start = max(start, end - RELAYOUT_CHUNK_LINES)
+        for number in range(chunk_start, end):
+            # Laid out lines already have their height for this width
+            if number not in self.layouts:
+                self.heights.set(number - first, self._estimate_height(
+                    self.lines.lines[number - first]))
+        self.stale = (start, chunk_start)
+        self._set_anchor(anchor)
+        if chunk_start > start:
+            return GLib.SOURCE_CONTINUE
+        self.relayout_source = None
+        return GLib.SOURCE_REMOVE
+
+    def _update_style(self):
+        metrics = self.get_pango_context().get_metrics(None, None)
+        self.char_width = max(
+            1, metrics.get_approximate_char_width() // Pango.SCALE)
+        self.line_height = max(
+            1, (metrics.get_ascent() + metrics.get_descent()) // Pango.SCALE)
+        context = self.get_style_context()
+        colors = []
+        for name in ("theme_selected_fg_color", "theme_selected_bg_color"):
+            (found, rgba) = context.lookup_color(name)
+            colors.append("#{:02x}{:02x}{:02x}".format(
+                int(rgba.red*255), int(rgba.green*255), int(rgba.blue*255))
+                if found else None)
+        if None not in colors:
+            self.selected_colors = tuple(colors)
+        self.span_attributes = {}
+
+    def do_style_updated(self):
+        Gtk.DrawingArea.do_style_updated(self)
+        anchor = self._get_anchor()
+        self._update_style()
+        self.layouts = {}
+        self._estimate_heights()
+        self._set_anchor(anchor)
+        self.queue_draw()
+
+    def do_size_allocate(self, allocation):
+        anchor = self._get_anchor()
+        Gtk.DrawingArea.do_size_allocate(self, allocation)
+        if allocation.width != self.layout_width:
+            resized = self.layout_width > 0
+            self.layout_width = allocation.width
+            self.layouts = {}
+            if self.lines is not None and resized:
+                # Estimated with the previous width until the width settles
+                self.stale = (self.lines.first,
+                              self.lines.first + len(self.lines))
+                self._set_relayout(GLib.timeout_add(
+                    RESIZE_SETTLE_MS, self.on_relayout_timeout))
+            else:
+                self._estimate_heights()
+        self._set_anchor(anchor)
+
+    def _get_span_attributes(self, style, url, selected, found=False):
+        """Returns the attributes of a Pango markup span for a color.Style."""
+        key = (style, url, selected, found)
+        attributes = self.span_attributes.get(key)
+        if attributes is not None:
+            return attributes
+        attributes = []
+        if style is not None:
+            (foreground, background, attrs) = style
+            if foreground is not None and self.lines.rgb(foreground):
+                attributes.append('foreground="{}"'.format(
+                    self.lines.rgb(foreground)))
+            if background is not None and self.lines.rgb(background):
+                attributes.append('background="{}"'.format(
+                    self.lines.rgb(background)))
+            if "*" in attrs:
+                attributes.append('weight="bold"')
+            if "_" in attrs:
+                attributes.append('underline="single"')
+            if "/" in attrs:
+                attributes.append('style="italic"')
+        if url and (style is None or "_" not in style[2]):
+            attributes.append('underline="single"')
+        if selected or found:
+            attributes = [attribute for attribute in attributes
+                          if not attribute.startswith(("foreground",
+                                                       "background"))]
+            attributes.append('foreground="{}" background="{}"'.format(
+                *(self.selected_colors if selected else FOUND_COLORS)))
+        attributes = " ".join(attributes)
+        self.span_attributes[key] = attributes
+        return attributes
+
+    def _get_markup(self, runs, urls, selected, found=()):
+        """Returns Pango markup for runs of text, with urls underlined and
+        the selected (start, end) offsets, if any, and the found ones
+        highlighted."""
+        cuts = set()
+        for (start, end, _) in urls:
+            cuts.update((start, end))
+        if selected is not None:
+            cuts.update(selected)
+        for bounds in found:
+            cuts.update(bounds)
+        markup = []
+        offset = 0
+        for (text, style) in runs:
+            end = offset + len(text)
+            bounds = [offset] + sorted(cut for cut in cuts
+                                       if offset < cut < end) + [end]
+            for (start, stop) in zip(bounds, bounds[1:]):
+                in_url = any(url[0] <= start < url[1] for url in urls)
+                in_selection = selected is not None and \
+                    selected[0] <= start < selected[1]
+                in_found = any(bounds[0] <= start < bounds[1]
+                               for bounds in found)
+                attributes = self._get_span_attributes(style, in_url,
+                                                       in_selection, in_found)
+                piece = GLib.markup_escape_text(text[start-offset:stop-offset])
+                if attributes:
+                    markup.append("<span {}>{}</span>".format(attributes,
+                                                              piece))
+                else:
+                    markup.append(piece)
+            offset = end
+        return "".join(markup)
+
+    def set_highlight(self, pattern, numbers):
+        """Highlights the text matching pattern, a compiled regular
+        expression or None, in the messages of the lines of numbers. Only
+        the lines laid out, around the viewport, are searched."""
+        self.highlight = pattern
+        self.highlight_lines = frozenset(numbers)
+        self.layouts = {}
+        self.queue_draw()
+
+    def scroll_to_line(self, number):
+        """Scrolls so that line number is in the middle of the viewport."""
+        if self.lines is None or self.adjustment is None:
+            return
+        index = number - self.lines.first
+        if not 0 <= index < len(self.lines):
             return
-        Gtk.show_uri_on_window(None, arg, Gdk.CURRENT_TIME)
+        adj = self.adjustment
+        value = self.heights.top(index) + \
+            (self.heights[index] - adj.get_page_size()) / 2
+        adj.set_value(max(0, min(value,
+                                 adj.get_upper() - adj.get_page_size())))
 
-    def get_text_pixel_width(self, text, bold=False):
-        self.layout.set_text(text, -1)
-        self.layout.set_attributes(None)
-        if bold:
-            # workaround to get an attribute list in pygobject:
-            attr_list = Pango.parse_markup("<b>"+text+"</b>", -1, "0")[1]
-            self.layout.set_attributes(attr_list)
-        (width, _) = self.layout.get_pixel_size()
-        if width > self.longest_prefix:
-            for tag in self.indent_tag_list:
-                tag.props.left_margin += width-self.longest_prefix
-            self.longest_prefix = width
-        return width
+    def _get_selected_range(self, number, length):
+        """Returns the (start, end) offsets selected in a line, or None."""
+        if self.selection is None:
+            return None
+        (start, end) = sorted(self.selection)
+        if not start[0] <= number <= end[0]:
+            return None
+        return (start[1] if number == start[0] else 0,
+                end[1] if number == end[0] else length)
 
-    def get_message_type(self, tags_array):
-        if "irc_privmsg" in tags_array:
-            return MessageType.CHAT_MESSAGE
+    def _layout_line(self, index):
+        """Returns the LaidOutLine of line index, laying it out if needed."""
+        number = self.lines.first + index
+        laid_out = self.layouts.get(number)
+        if laid_out is not None:
+            return laid_out
+        line = self.lines[index]
+        width = self.layout_width
+        y = 0
+        time_layout = None
+        if line.flags & LINE_TIME:
+            time_layout = self.create_pango_layout(None)
+            time_layout.set_markup("<b>{}</b>".format(GLib.markup_escape_text(
+                datetime.datetime.fromtimestamp(line.date).strftime(
+                    self.config.get('look', 'buffer_time_format')))), -1)
+            time_layout.set_width(
+                max(1, width - self.margin_size) * Pango.SCALE)
+            time_layout.set_alignment(Pango.Alignment.RIGHT)
+            y += time_layout.get_pixel_size()[1]
+        x = self.lines.longest_prefix + self.margin_size
+        layout = self.create_pango_layout(None)
+        layout.set_wrap(Pango.WrapMode.WORD_CHAR)
+        if line.prefix is not None:
+            x -= line.width
+            # Hanging indent aligning wrapped text after the prefix
+            layout.set_indent(-line.width * Pango.SCALE)
+            if line.flags & LINE_SPACED:
+                y += PREFIX_SPACING
+        layout.set_width(max(1, width - x - self.margin_size) * Pango.SCALE)
+        (runs, start) = self.lines.get_runs(line)
+        text = ''.join(run[0] for run in runs)
+        urls = []
+        if "://" in text:
+            urls = [(match.start(), match.end(), match[0])
+                    for match in URL_PATTERN.finditer(text, start)]
+        found = ()
+        if self.highlight is not None and number in self.highlight_lines:
+            found = [match.span()
+                     for match in self.highlight.finditer(text, start)]
+        markup = self._get_markup(
+            runs, urls, self._get_selected_range(number, len(text)), found)
+        if line.fold is not None:
+            markup = "<i>{}</i>".format(markup)
+        layout.set_markup(markup, -1)
+        laid_out = LaidOutLine(time_layout, x, y, layout,
+                               y + layout.get_pixel_size()[1], text, urls)
+        self.layouts[number] = laid_out
+        return laid_out
+
+    def do_draw(self, cr):
+        context = self.get_style_context()
+        height = self.get_allocated_height()
+        Gtk.render_background(context, cr, 0, 0, self.get_allocated_width(),
+                              height)
+        adj = self.adjustment
+        if self.lines is None or adj is None or not self.lines.lines:
+            return False
+        value = adj.get_value()
+        at_bottom = value + adj.get_page_size() >= adj.get_upper()
+        total = self.heights.total
+        (first, top) = self.heights.find(value)
+        Gdk.cairo_set_source_rgba(cr, context.get_color(context.get_state()))
+        layouts = {}
+        # Lines above the viewport, laid out in advance for scrolling up
+        for index in range(max(0, first - VIEW_MARGIN_LINES), first):
+            laid_out = self._layout_line(index)
+            layouts[self.lines.first + index] = laid_out
+            self.heights.set(index, laid_out.height)
+        y = top - value
+        index = first
+        after = 0
+        while index < len(self.lines) and after < VIEW_MARGIN_LINES:
+            laid_out = self._layout_line(index)
+            layouts[self.lines.first + index] = laid_out
+            self.heights.set(index, laid_out.height)
+            if y < height:
+                if laid_out.time is not None:
+                    cr.move_to(0, y)
+                    PangoCairo.show_layout(cr, laid_out.time)
+                cr.move_to(laid_out.x, y + laid_out.y)
+                PangoCairo.show_layout(cr, laid_out.layout)
+            else:
+                after += 1
+            y += laid_out.height
+            index += 1
+        self.layouts = layouts
+        if self.heights.total != total:
+            # Keep the first visible line in place, or the bottom in view
+            self._set_anchor(None if at_bottom else
+                             (self.lines.first + first, value - top))
+        return False
+
+    def _get_position(self, x, y):
+        """Returns the position of the character at window coordinates as
+        (line number, offset, LaidOutLine), or None if there are no lines."""
+        if self.lines is None or not self.lines.lines or \
+                self.adjustment is None:
+            return None
+        offset = self.adjustment.get_value() + y
+        (index, top) = self.heights.find(offset)
+        if index >= len(self.lines):
+            index = len(self.lines) - 1
+            laid_out = self._layout_line(index)
+            return (self.lines.first + index, len(laid_out.text), laid_out)
+        laid_out = self._layout_line(index)
+        if offset - top < laid_out.y:
+            return (self.lines.first + index, 0, laid_out)
+        (_, byte_index, trailing) = laid_out.layout.xy_to_index(
+            int((x - laid_out.x) * Pango.SCALE),
+            int((offset - top - laid_out.y) * Pango.SCALE))
+        char_index = len(laid_out.text.encode()[:byte_index].decode(
+            "utf-8", "ignore"))
+        return (self.lines.first + index, char_index + trailing, laid_out)
+
+    @staticmethod
+    def _get_url(position):
+        """Returns the URL at a position, or None."""
+        for (start, end, url) in position[2].urls:
+            if start <= position[1] < end:
+                return url
+        return None
+
+    def _get_fold(self, position):
+        """Returns the fold whose summary line is at a position, or None."""
+        index = position[0] - self.lines.first
+        if 0 <= index < len(self.lines):
+            return self.lines[index].fold
+        return None
+
+    def _set_selection(self, selection):
+        if selection is not None and selection[0] == selection[1]:
+            selection = None
+        if selection != self.selection:
+            self.selection = selection
+            self.layouts = {}
+            self.queue_draw()
+
+    def get_selected_text(self):
+        """Returns the selected text, or None if nothing is selected."""
+        if self.selection is None or self.lines is None:
+            return None
+        (start, end) = sorted(self.selection)
+        texts = []
+        for number in range(max(start[0], self.lines.first),
+                            min(end[0] + 1, self.lines.first + len(self.lines))):
+            (runs, _) = self.lines.get_runs(
+                self.lines[number - self.lines.first])
+            text = ''.join(run[0] for run in runs)
+            selected = self._get_selected_range(number, len(text))
+            texts.append(text[selected[0]:selected[1]])
+        return "\n".join(texts)
+
+    def copy_clipboard(self):
+        """Copies the selected text to the clipboard. Returns False if
+        nothing is selected."""
+        text = self.get_selected_text()
+        if text is None:
+            return False
+        Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD).set_text(text, -1)
+        return True
+
+    def do_button_press_event(self, event):
+        if event.button != 1 or event.type != Gdk.EventType.BUTTON_PRESS:
+            return False
+        position = self._get_position(event.x, event.y)
+        self.pressed = position[:2] if position is not None else None
+        self._set_selection(None)
+        return True
+
+    def do_motion_notify_event(self, event):
+        position = self._get_position(event.x, event.y)
+        if position is None:
+            return False
+        if self.pressed is not None and \
+                event.state & Gdk.ModifierType.BUTTON1_MASK:
+            self._set_selection((self.pressed, position[:2]))
+        if self._get_url(position) is not None or \
+                self._get_fold(position) is not None:
+            self.get_window().set_cursor(self.pointer_cursor)
         else:
-            return MessageType.SERVER_MESSAGE
+            self.get_window().set_cursor(self.text_cursor)
+        return False
+
+    def do_button_release_event(self, event):
+        if event.button != 1 or self.pressed is None:
+            return False
+        pressed = self.pressed
+        self.pressed = None
+        if self.selection is not None:
+            # As in a text view, the selection is the primary selection
+            Gtk.Clipboard.get(Gdk.SELECTION_PRIMARY).set_text(
+                self.get_selected_text(), -1)
+            return True
+        position = self._get_position(event.x, event.y)
+        if position is not None and position[:2] == pressed:
+            url = self._get_url(position)
+            fold = self._get_fold(position)
+            if url is not None:
+                Gtk.show_uri_on_window(None, url, Gdk.CURRENT_TIME)
+            elif fold is not None:
+                self.lines.emit("fold-activated", fold)
+        return True
 
 
 class BufferWidget(Gtk.Box):
@@ -213,15 +1495,67 @@ class BufferWidget(Gtk.Box):
         Gtk.Box.__init__(self)
         self.config = config
         self.set_orientation(Gtk.Orientation.VERTICAL)
-        horizontal_box = Gtk.Box(Gtk.Orientation.HORIZONTAL)
-        self.pack_start(horizontal_box, True, True, 0)
         self.active = False
 
         # Scrolling:
         self.autoscroll = True
+        self.scroll_tick = None
+
+        # Resizing, see track_resize
+        self.allocated_width = 0
+        self.resize_settle = None
+        self.resize_tick = None
+        self.resize_frame_time = None
+        self.resize_worst_frame = 0
+        # Longest frame, in milliseconds, during the last resize
+        self.worst_resize_frame = None
+
+        # Nick completion in the entry
+        self.completions = None
+        self.completions_word_offset = None
+
+        # Chat view widget, a TextView or a ChatView, None until the widgets
+        # are built, see build_widgets
+        self.textview = None
+
+    def build_widgets(self):
+        """Builds the child widgets. Until then the box is empty."""
+        # Find bar, shown with Ctrl+F
+        self.find_entry = Gtk.SearchEntry()
+        self.find_entry.set_width_chars(30)
+        self.find_previous_button = Gtk.Button.new_from_icon_name(
+            "go-up-symbolic", Gtk.IconSize.BUTTON)
+        self.find_next_button = Gtk.Button.new_from_icon_name(
+            "go-down-symbolic", Gtk.IconSize.BUTTON)
+        self.find_label = Gtk.Label()
+        find_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        find_box.pack_start(self.find_entry, False, False, 0)
+        find_box.pack_start(self.find_previous_button, False, False, 0)
+        find_box.pack_start(self.find_next_button, False, False, 0)
+        find_box.pack_start(self.find_label, False, False, 0)
+        self.find_bar = Gtk.SearchBar()
+        self.find_bar.add(find_box)
+        self.find_bar.connect_entry(self.find_entry)
+        self.find_bar.set_show_close_button(True)
+        self.pack_start(self.find_bar, False, False, 0)
+
+        horizontal_box = Gtk.Box(Gtk.Orientation.HORIZONTAL)
+        self.pack_start(horizontal_box, True, True, 0)
+        self.autoscroll = True
+        self.allocated_width = 0
 
-        # TextView widget
-        self.textview = Gtk.TextView()
+        # Chat view widget
+        if self.config.get('look', 'chat_view') == 'virtual':
+            self.textview = ChatView(self.config)
+        else:
+            self.textview = Gtk.TextView()
+            self.textview.set_cursor_visible(False)
+            self.textview.set_editable(False)
+            self.textview.set_can_focus(False)
+            self.textview.set_wrap_mode(Gtk.WrapMode.WORD_CHAR)
+            self.textview.set_right_margin(int(self.config.get(
+                'look', 'margin_size')))
+            self.textview.connect("event", self.on_event)
         self.scrolledwindow = Gtk.ScrolledWindow()
         self.scrolledwindow.set_hexpand(True)
         self.scrolledwindow.set_vexpand(True)
@@ -232,23 +1566,14 @@ class BufferWidget(Gtk.Box):
         vscroll = self.scrolledwindow.get_vscrollbar()
         vscroll.connect("change-value", self.on_changed_value)
         self.textview.connect("size-allocate", self.on_size_allocate)
-        self.textview.set_cursor_visible(False)
-        self.textview.set_editable(False)
-        self.textview.set_can_focus(False)
-        self.textview.set_wrap_mode(Gtk.WrapMode.WORD_CHAR)
-        self.textview.set_right_margin(int(self.config.get('look',
-                                                           'margin_size')))
         self.scrolledwindow.add(self.textview)
         horizontal_box.pack_start(self.scrolledwindow, True, True, 0)
         self.adjustment = self.textview.get_vadjustment()
-        self.textview.connect("event", self.on_event)
 
         # Entry widget
         self.entry = Gtk.Entry()
         self.entry.connect("key-press-event", self.on_key_press)
         self.pack_start(self.entry, False, False, 0)
-        self.completions = None
-        self.completions_word_offset = None
 
         # Nicklist widget
         nicklist_renderer = Gtk.CellRendererText()
@@ -271,6 +1596,35 @@ class BufferWidget(Gtk.Box):
         self.text_cursor = Gdk.Cursor.new_from_name(
             Gdk.Display.get_default(), "text")
 
+    def destroy_widgets(self):
+        """Destroys the child widgets, built again by build_widgets."""
+        if self.resize_settle is not None:
+            GLib.source_remove(self.resize_settle)
+            self.resize_settle = None
+            self.resize_tick = None
+        self.scroll_tick = None
+        for child in self.get_children():
+            child.destroy()
+        self.textview = None
+        self.scrolledwindow = None
+        self.adjustment = None
+        self.entry = None
+        self.nick_display_widget = None
+        self.nicklist_window = None
+        self.find_entry = None
+        self.find_previous_button = None
+        self.find_next_button = None
+        self.find_label = None
+        self.find_bar = None
+        self.pointer_cursor = None
+        self.text_cursor = None
+        self.completions = None
+        self.completions_word_offset = None
+
+    def is_built(self):
+        """Returns True if the child widgets are built."""
+        return self.textview is not None
+
     def on_event(self, source, event):
         """ Handler for mouse movement events. """
         if event.type != Gdk.EventType.MOTION_NOTIFY:
@@ -279,7 +1633,8 @@ class BufferWidget(Gtk.Box):
         coords = self.textview.window_to_buffer_coords(
             Gtk.TextWindowType.TEXT, event.x, event.y)
         text_iter = self.textview.get_iter_at_location(*coords)
-        if text_iter[0] and text_iter[1].has_tag(self.get_url_tag()):
+        if text_iter[0] and (text_iter[1].has_tag(self.get_url_tag()) or
+                             text_iter[1].has_tag(self.get_fold_tag())):
             win.set_cursor(self.pointer_cursor)
         else:
             win.set_cursor(self.text_cursor)
@@ -342,8 +1697,43 @@ class BufferWidget(Gtk.Box):
         Needed to fix autoscroll that in some situations
         seemed to jump to bottom before widget had finished
         rendering, causing autoscroll to malfunction."""
+        if allocation.width != self.allocated_width:
+            if self.allocated_width:
+                self.track_resize()
+            self.allocated_width = allocation.width
         self.scrollbottom()
 
+    def track_resize(self):
+        """Measures the longest frame while the width of the chat view
+        changes, until it has not changed for RESIZE_SETTLE_MS."""
+        if self.resize_settle is not None:
+            GLib.source_remove(self.resize_settle)
+        else:
+            self.resize_frame_time = None
+            self.resize_worst_frame = 0
+            self.resize_tick = self.textview.add_tick_callback(
+                self.on_resize_tick)
+        self.resize_settle = GLib.timeout_add(RESIZE_SETTLE_MS,
+                                              self.on_resize_settled)
+
+    def on_resize_tick(self, widget, frame_clock):
+        frame_time = frame_clock.get_frame_time()
+        if self.resize_frame_time is not None:
+            self.resize_worst_frame = max(self.resize_worst_frame,
+                                          frame_time - self.resize_frame_time)
+        self.resize_frame_time = frame_time
+        return GLib.SOURCE_CONTINUE
+
+    def on_resize_settled(self):
+        self.resize_settle = None
+        self.textview.remove_tick_callback(self.resize_tick)
+        self.resize_tick = None
+        self.worst_resize_frame = self.resize_worst_frame / 1000
+        if self.config.get('look', 'debug') == 'on':
+            print("Resize: worst frame {:.1f} ms.".format(
+                self.worst_resize_frame))
+        return GLib.SOURCE_REMOVE
+
     def on_scroll_child(self, source_event, scroll, horizontal):
         """This callback is called when scrolling with up/down/pgup/pgdown."""
         if scroll in (Gtk.ScrollType.STEP_BACKWARD,
@@ -359,21 +1749,66 @@ class BufferWidget(Gtk.Box):
                 self.autoscroll = False
 
     def scrollbottom(self):
-        """Scrolls to bottom if autoscroll is True."""
+        """Scrolls to bottom if autoscroll is True. Scrolling is done at most
+        once per frame, from the frame clock, however often this is called.
+        """
         if not self.active:
             return
         if not self.autoscroll:
             return
-        # Make sure widget is properly updated before trying to scroll it:
-        while Gtk.events_pending():
-            Gtk.main_iteration()
-        adj = self.scrolledwindow.get_vadjustment()
-        adj.set_value(adj.get_upper()-adj.get_page_size())
+        if self.scroll_tick is None:
+            self.scroll_tick = self.textview.add_tick_callback(
+                self.on_scroll_tick)
+
+    def on_scroll_tick(self, widget, frame_clock):
+        """Tick callback scrolling to bottom, unless the user has scrolled up
+        since scrollbottom was called."""
+        self.scroll_tick = None
+        if self.active and self.autoscroll:
+            if isinstance(self.textview, Gtk.TextView):
+                # Scrolls once the text view has laid out the new lines
+                self.textview.scroll_to_mark(self.get_end_mark(), 0, True,
+                                             0, 1)
+            else:
+                adj = self.scrolledwindow.get_vadjustment()
+                adj.set_value(adj.get_upper()-adj.get_page_size())
+        return GLib.SOURCE_REMOVE
 
     def get_url_tag(self):
         """Give us the Textview tag for URL:s. Must be implemented by the Buffer class."""
         raise NotImplementedError()
 
+    def get_fold_tag(self):
+        """Give us the Textview tag for the summary lines of folds. Must be
+        implemented by the Buffer class."""
+        raise NotImplementedError()
+
+    def get_end_mark(self):
+        """Give us a Textview mark staying at the end of the text. Must be
+        implemented by the Buffer class."""
+        raise NotImplementedError()
+
+
+class Fold():
+    """Consecutive joins, parts, quits and nick changes of a buffer, shown
+    as a single summary line. A fold is identified by the number of its
+    first line."""
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.counts = [0] * len(FOLDED_TAGS)
+
+    def add(self, number, kind):
+        """Adds line number, of a kind as returned by get_fold_kind."""
+        self.end = number + 1
+        self.counts[kind] += 1
+
+    def summary(self):
+        """Returns the text of the summary line."""
+        return ", ".join(fmt.format(count) for ((_, fmt), count)
+                         in zip(FOLDED_TAGS, self.counts) if count)
+
 
 class Buffer(BufferWidget):
     """A WeeChat buffer that holds buffer data."""
@@ -384,16 +1819,20 @@ class Buffer(BufferWidget):
                                tuple())
     }
 
-    def __init__(self, config, data={}):
+    def __init__(self, config, data={}, search_index=None):
         BufferWidget.__init__(self, config)
         self.data = data
+        # search.SearchIndex of the lines of all buffers, used by the find bar
+        self.search_index = search_index
         self.nicklist = {}
-        self.entry.connect("activate", self.on_send_message)
-        self.nicklist_data = Gtk.ListStore(str)
-        self.chat = ChatTextBuffer(
-            config, layout=self.textview.create_pango_layout())
-        self.textview.set_buffer(self.chat)
-        self.nick_display_widget.set_model(self.nicklist_data)
+        # Prefixes of the nicks added or updated since the last
+        # nicklist_refresh, measured by it
+        self.nicklist_new_prefixes = []
+        # Chat model and nicklist model, None until the widgets are built,
+        # see build
+        self.chat = None
+        self.nicklist_data = None
+        self.connect("destroy", self.on_destroy)
         green = Gdk.RGBA(0, 0.7, 0, 1)
         orange = Gdk.RGBA(1, 0.5, 0.2, 1)
         blue = Gdk.RGBA(0.2, 0.2, 0.7, 1)
@@ -402,10 +1841,172 @@ class Buffer(BufferWidget):
         self.notify_values = {"default": 0,
                               "low": 1, "message": 2, "mention": 3}
         self.notify_level = "default"
+        # Lines of the buffer. The chat view displays the stored lines up to
+        # projected, the number of the first line not displayed yet.
+        self.lines = LineStore()
+        self.projected = 0
+        # Date of the last line restored by restore_lines, and the messages
+        # of the lines restored at that date, see skip_restored
+        self.resume_date = None
+        self.resume_messages = set()
+        # Monotonic time at which the buffer was last shown or hidden
+        self.last_viewed = time.monotonic()
+        # Fold of the last lines displayed if any, and the folds expanded
+        self.fold_lines = config.get('look', 'fold_server_messages') == 'on'
+        self.fold = None
+        self.expanded_folds = set()
+        # Positions in the chat model of the stored lines displayed, from
+        # line number positions_first, see get_position
+        self.positions = array.array('q')
+        self.positions_first = 0
+        # Find bar state: the numbers of the stored lines matching, the
+        # index of the current one, the (position, end position) of the
+        # matching lines displayed, -1 for the end of the chat model, and
+        # the pattern of the text highlighted
+        self.find_matches = []
+        self.find_current = None
+        self.find_positions = []
+        self.find_pattern = None
+        self.highlight_source = None
+        # Part of the text view with found text highlighted, as absolute
+        # (start, end) offsets
+        self.highlighted = None
+
+    def build(self):
+        """Builds the widgets and the chat model of the buffer, when it is
+        first shown. Until then its lines are only stored, they are
+        displayed by the next flush_deferred."""
+        if self.is_built():
+            return
+        self.build_widgets()
+        if not self.data.get('full_name', '').startswith("irc"):
+            self.textview.set_monospace(True)
+        self.entry.connect("activate", self.on_send_message)
+        self.nicklist_data = Gtk.ListStore(str)
+        if isinstance(self.textview, ChatView):
+            self.chat = ChatLines(
+                self.config, layout=self.textview.create_pango_layout())
+        else:
+            self.chat = ChatTextBuffer(
+                self.config, layout=self.textview.create_pango_layout())
+        self.textview.set_buffer(self.chat)
+        self.chat.connect("fold-activated", self.on_fold_activated)
+        self.textview.connect("style-updated", self.on_style_updated)
+        self.nick_display_widget.set_model(self.nicklist_data)
+        self.find_entry.connect("search-changed", self.on_find_changed)
+        self.find_entry.connect("activate", self.on_find_previous)
+        self.find_entry.connect("previous-match", self.on_find_previous)
+        self.find_entry.connect("next-match", self.on_find_next)
+        self.find_previous_button.connect("clicked", self.on_find_previous)
+        self.find_next_button.connect("clicked", self.on_find_next)
+        self.find_bar.connect("notify::search-mode-enabled",
+                              self.on_find_mode_changed)
+        self.adjustment.connect("value-changed", self.on_find_scrolled)
+        self.projected = self.lines.first
+        self._reset_display()
+        self.nicklist_refresh(full=True)
+
+    def unbuild(self):
+        """Destroys the widgets and the chat model of a buffer not shown,
+        e.g. after long disuse, keeping its lines. They are built again when
+        it is shown."""
+        if self.active or not self.is_built():
+            return
+        parent = self.get_parent()
+        if parent is not None:
+            parent.remove(self)
+        if self.highlight_source is not None:
+            GLib.source_remove(self.highlight_source)
+            self.highlight_source = None
+        self._reset_find()
+        self.highlighted = None
+        self.chat.release_tags()
+        self.destroy_widgets()
+        self.chat = None
+        self.nicklist_data = None
+        self.projected = self.lines.first
+        self._reset_display()
 
     def get_url_tag(self):
         return self.chat.url_tag
 
+    def get_fold_tag(self):
+        return self.chat.fold_tag
+
+    def get_end_mark(self):
+        return self.chat.end_mark
+
+    def on_fold_activated(self, chat, fold):
+        """Callback for when the summary line of a fold is clicked, displays
+        the lines folded in its place. The lines after it are not displayed
+        again, only their positions shift."""
+        self.expanded_folds.add(fold)
+        start = self.get_position(fold)
+        if start is None:
+            return
+        # The lines folded are at the position of the summary line
+        last = fold
+        while self.get_position(last + 1) == start:
+            last += 1
+        end = self.get_position(last + 1)
+        if end is None:
+            end = self.chat.get_end_position()
+        lines = [self.lines.get(number) for number in range(fold, last + 1)]
+        if None in lines:
+            return
+        mark = self._mark_top()
+        (positions, new_end) = self.chat.expand_fold(start, end, lines)
+        delta = new_end - end
+        for (offset, position) in enumerate(positions):
+            self.positions[fold + offset - self.positions_first] = position
+        for index in range(last + 1 - self.positions_first,
+                           len(self.positions)):
+            self.positions[index] += delta
+        if self.highlighted is not None:
+            self.highlighted = tuple(offset + delta if offset >= end else
+                                     offset for offset in self.highlighted)
+        if self.find_matches:
+            self._set_find_positions()
+            self._update_highlight()
+        self._scroll_to_top(mark)
+
+    def _mark_top(self):
+        """Returns a mark at the top of the visible part of the text view if
+        scrolled up, to keep it in place while the buffer changes, else
+        None. A ChatView keeps its visible lines in place by itself."""
+        if not self.active or self.autoscroll or \
+                not isinstance(self.chat, ChatTextBuffer):
+            return None
+        rect = self.textview.get_visible_rect()
+        (found, top) = self.textview.get_iter_at_location(rect.x, rect.y)
+        if not found:
+            return None
+        return self.chat.create_mark(None, top, True)
+
+    def _scroll_to_top(self, mark, scroll=True):
+        """Scrolls the text view back to a mark from _mark_top, and deletes
+        the mark."""
+        if mark is None:
+            return
+        if scroll:
+            self.textview.scroll_to_mark(mark, 0, True, 0, 0)
+        self.chat.delete_mark(mark)
+
+    def on_style_updated(self, *args):
+        """Callback for when the font or theme of the chat view changes."""
+        self.chat.on_style_updated()
+
+    def on_destroy(self, *args):
+        """Callback for when the widget is destroyed."""
+        if self.chat is not None:
+            self.chat.release_tags()
+        if self.resize_settle is not None:
+            GLib.source_remove(self.resize_settle)
+            self.resize_settle = None
+        if self.highlight_source is not None:
+            GLib.source_remove(self.highlight_source)
+            self.highlight_source = None
+
     def get_theme_fg_color(self):
         styleContext = self.get_style_context()
         (color_is_defined, theme_fg_color) = styleContext.lookup_color("theme_fg_color")
@@ -428,9 +2029,27 @@ class Buffer(BufferWidget):
                 'name': name,
                 'visible': visible,
             })
+            self.nicklist_new_prefixes.append(
+                self._nick_chat_prefix(prefix, name))
 
-    def nicklist_refresh(self):
-        """Refresh nicklist."""
+    @staticmethod
+    def _nick_chat_prefix(prefix, name):
+        """Returns a nick as displayed as prefix of chat lines."""
+        return (prefix + name).lstrip() + " "
+
+    def nicklist_refresh(self, full=False):
+        """Refresh nicklist. Measures the nicks added or updated since the
+        last refresh so that text is aligned before they speak, or all nicks
+        if full, e.g. when a whole nicklist has been received."""
+        prefixes = self.nicklist_new_prefixes
+        self.nicklist_new_prefixes = []
+        if not self.is_built():
+            return
+        if full:
+            prefixes = [self._nick_chat_prefix(nick["prefix"], nick["name"])
+                        for group in self.nicklist.values()
+                        for nick in group['nicks']]
+        self.chat.measure_prefixes(prefixes)
         self.nicklist_data.clear()
         for group in sorted(self.nicklist):
             for nick in sorted(self.nicklist[group]['nicks'],
@@ -481,6 +2100,8 @@ class Buffer(BufferWidget):
                     if nick['name'] == name:
                         nick['prefix'] = prefix
                         nick['visible'] = visible
+                        self.nicklist_new_prefixes.append(
+                            self._nick_chat_prefix(prefix, name))
                         break
 
     def on_send_message(self, source_object):
@@ -511,5 +2132,385 @@ class Buffer(BufferWidget):
         """Return pointer on buffer."""
         return self.data.get("__path", [""])[0]
 
+    def display_line(self, date, prefix, message, tags_array):
+        """Stores a line and displays it, after the stored lines not
+        displayed yet if any."""
+        if not self.is_built():
+            self.defer_line(date, prefix, message, tags_array)
+            return
+        number = self.lines.append(date, prefix, message, tags_array)
+        if self.projected < number:
+            self.flush_deferred()
+            return
+        self.projected = number + 1
+        self._display(number, (date, prefix, message, tags_array))
+
+    def _display(self, number, line):
+        """Displays stored line number, or folds it with the previous lines
+        if it is a join, part, quit or nick change. This is decided from its
+        tags only, folded lines are never rendered."""
+        position = self.chat.get_end_position()
+        kind = get_fold_kind(line[3]) if self.fold_lines else None
+        if kind is None:
+            self.fold = None
+            self._set_position(number, position)
+            self.chat.display(*line)
+            return
+        if self.fold is None or self.fold.end != number:
+            self.fold = Fold(number)
+        fold = self.fold
+        fold.add(number, kind)
+        if fold.start in self.expanded_folds:
+            self._set_position(number, position)
+            self.chat.display(*line)
+        elif fold.end - fold.start == 1:
+            # Displayed as is unless more lines follow
+            self._set_position(number, position)
+            self.chat.mark_tail()
+            self.chat.display(*line)
+        else:
+            # At the position of the summary line
+            start = self.get_position(fold.start)
+            self._set_position(number, position if start is None else start)
+            self.chat.remove_marked()
+            self.chat.display_fold(line[0], fold.summary(), fold.start)
+
+    def _set_position(self, number, position):
+        if number != self.positions_first + len(self.positions):
+            self.positions = array.array('q')
+            self.positions_first = number
+        self.positions.append(position)
+
+    def _trim_positions(self):
+        removed = self.lines.first - self.positions_first
+        if removed > 0:
+            del self.positions[:removed]
+            self.positions_first = self.lines.first
+
+    def _trim_chat(self):
+        """Removes from the chat model the lines displayed before the first
+        stored line, so that the chat model, the LineStore and the positions
+        stay in step. Returns True if lines were removed."""
+        position = self.get_position(self.lines.first)
+        if position is None:
+            if self.lines.first < self.positions_first + len(self.positions):
+                # The first stored line was never displayed, nor any before
+                return False
+            # All the lines displayed were removed from the LineStore
+            position = self.chat.get_end_position()
+        return self.chat.trim_to(position)
+
+    def _reset_display(self):
+        """Forgets what was displayed, once the chat model is cleared."""
+        self.fold = None
+        self.positions = array.array('q')
+        self.positions_first = self.projected
+
+    def get_position(self, number):
+        """Returns the position in the chat model of stored line number, as
+        returned by get_end_position before it was displayed, or None if it
+        is not displayed. Folded lines are at the position of the summary
+        line."""
+        index = number - self.positions_first
+        if 0 <= index < len(self.positions):
+            return self.positions[index]
+        return None
+
+    def defer_line(self, date, prefix, message, tags_array):
+        """Stores a line without displaying it. Stored lines are displayed
+        the next time flush_deferred is called, i.e. when the buffer is shown.
+        """
+        self.lines.append(date, prefix, message, tags_array)
+        if not self.is_built():
+            # Without a chat view, nothing else trims the lines
+            self.lines.trim_head(self.get_max_lines())
+
+    def restore_lines(self, lines):
+        """Takes over the LineStore of a previous buffer of the same name,
+        e.g. one shown from the history cache or before a reconnection. Its
+        lines are displayed when the buffer is shown, and the backlog lines
+        already among them are skipped, see skip_restored."""
+        self.lines = lines
+        self.projected = lines.first
+        self._reset_display()
+        self.resume_messages = set()
+        number = lines.end - 1
+        line = lines.get(number)
+        self.resume_date = None if line is None else line.date
+        while line is not None and line.date == self.resume_date:
+            self.resume_messages.add(line.message)
+            number -= 1
+            line = lines.get(number)
+
+    def skip_restored(self, date, message):
+        """Returns True if a backlog line is older than the lines restored
+        by restore_lines, or is the same as one of the last ones."""
+        if self.resume_date is None:
+            return False
+        return date < self.resume_date or (
+            date == self.resume_date and message in self.resume_messages)
+
+    def pending_lines(self):
+        """Returns the number of stored lines not displayed yet."""
+        return self.lines.end - max(self.projected, self.lines.first)
+
+    def flush_deferred(self):
+        """Displays the stored lines not displayed yet. Returns the number of
+        lines displayed. Unless there are only a few lines, the text buffer
+        is detached from its view meanwhile, so that the view does not
+        invalidate its layout and emit signals for every insertion."""
+        max_lines = self.get_max_lines()
+        # Lines beyond the scrollback limit are never displayed
+        self.lines.trim_head(max_lines)
+        if not self.is_built():
+            return 0
+        self._trim_positions()
+        self.lines.rehydrate()
+        number = max(self.projected, self.lines.first)
+        lines = list(self.lines.lines_from(number))
+        self.projected = self.lines.end
+        if len(lines) < BULK_DISPLAY_MIN:
+            for (offset, line) in enumerate(lines):
+                self._display(number + offset, line)
+            self.trim_scrollback()
+            return len(lines)
+        # A text view reattached to its buffer scrolls back to the top
+        mark = self._mark_top()
+        self.textview.set_buffer(None)
+        try:
+            for (offset, line) in enumerate(lines):
+                self._display(number + offset, line)
+            self._trim_chat()
+        finally:
+            self.textview.set_buffer(self.chat)
+            self._scroll_to_top(mark)
+        return len(lines)
+
+    def display_bulk(self, lines):
+        """Stores and displays a list of (date, prefix, message, tags_array)
+        lines, such as the backlog."""
+        for line in lines:
+            self.lines.append(*line)
+        self.flush_deferred()
+
+    def hibernate(self):
+        """Frees the chat view content of a buffer that is not shown, and
+        compresses its stored lines. Lines received meanwhile are stored
+        compressed too, all are displayed again when the buffer is shown."""
+        if self.active or self.lines.hibernated:
+            return
+        if self.is_built():
+            self.chat.clear()
+        self.projected = self.lines.first
+        self._reset_display()
+        self.lines.hibernate()
+
+    def rerender(self):
+        """Displays all stored lines again, e.g. after colors have changed."""
+        if not self.is_built():
+            return
+        # The line at the top of the text view, to scroll back to it
+        top = None
+        mark = self._mark_top()
+        if mark is not None:
+            position = self.chat.trimmed_chars + \
+                self.chat.get_iter_at_mark(mark).get_offset()
+            self.chat.delete_mark(mark)
+            index = bisect.bisect_right(self.positions, position) - 1
+            if index >= 0:
+                top = self.positions_first + index
+        self.chat.clear()
+        self.projected = self.lines.first
+        self._reset_display()
+        self.flush_deferred()
+        position = self.get_position(top) if top is not None else None
+        if position is not None:
+            self._scroll_to_top(self.chat.create_mark(
+                None, self.chat.get_iter_at_offset(
+                    position - self.chat.trimmed_chars), True))
+
+    def show_find(self):
+        """Shows the find bar."""
+        self.find_bar.set_search_mode(True)
+        self.find_entry.grab_focus()
+
+    def on_find_mode_changed(self, *args):
+        """Callback for when the find bar is shown or hidden."""
+        if not self.find_bar.get_search_mode():
+            self._reset_find()
+            self._update_highlight()
+            self.entry.grab_focus()
+
+    def _reset_find(self):
+        self.find_matches = []
+        self.find_current = None
+        self.find_positions = []
+        self.find_pattern = None
+
+    def on_find_changed(self, entry):
+        """Callback for when the text to find changes. Matching lines are
+        looked up in the search index, the last one is shown."""
+        query = entry.get_text()
+        numbers = []
+        if self.search_index is not None:
+            numbers = [number for (_, number)
+                       in self.search_index.search(query, self.pointer())]
+        # Lines not displayed, e.g. trimmed, are not found
+        self.find_matches = [number for number in numbers
+                             if self.get_position(number) is not None]
+        self.find_current = len(self.find_matches) - 1 \
+            if self.find_matches else None
+        self._set_find_positions()
+        words = [word for token in query.lower().split()
+                 if not token.startswith("nick:")
+                 for word in RE_WORD.findall(token)]
+        self.find_pattern = re.compile(r"\b(?:{})\b".format(
+            "|".join(map(re.escape, words))), re.IGNORECASE) \
+            if words else None
+        self._show_match()
+        self._update_highlight()
+
+    def _set_find_positions(self):
+        positions = {}
+        for number in self.find_matches:
+            end = self.get_position(number + 1)
+            positions[self.get_position(number)] = -1 if end is None else end
+        self.find_positions = sorted(positions.items())
+
+    def on_find_previous(self, *args):
+        """Shows the previous matching line, wrapping around."""
+        if self.find_current is not None:
+            self.find_current = (self.find_current - 1) % \
+                len(self.find_matches)
+            self._show_match()
+
+    def on_find_next(self, *args):
+        """Shows the next matching line, wrapping around."""
+        if self.find_current is not None:
+            self.find_current = (self.find_current + 1) % \
+                len(self.find_matches)
+            self._show_match()
+
+    def _show_match(self):
+        if self.find_current is None:
+            self.find_label.set_text(
+                "Not found" if self.find_entry.get_text() else "")
+            return
+        self.find_label.set_text("{} of {}".format(self.find_current + 1,
+                                                   len(self.find_matches)))
+        position = self.get_position(self.find_matches[self.find_current])
+        self.autoscroll = False
+        if isinstance(self.textview, ChatView):
+            self.textview.scroll_to_line(position)
+            return
+        offset = position - self.chat.trimmed_chars
+        if offset >= 0:
+            self.textview.scroll_to_iter(self.chat.get_iter_at_offset(offset),
+                                         0, True, 0, 0.5)
+
+    def on_find_scrolled(self, *args):
+        """Callback for when the chat view scrolls, highlights the text found
+        in the lines now visible. A ChatView does it as it lays them out."""
+        if self.find_pattern is not None and \
+                not isinstance(self.textview, ChatView):
+            self._update_highlight()
+
+    def _update_highlight(self):
+        if isinstance(self.textview, ChatView):
+            self.textview.set_highlight(
+                self.find_pattern, (position for (position, _)
+                                    in self.find_positions))
+        elif self.highlight_source is None:
+            self.highlight_source = GLib.idle_add(self.highlight_visible)
+
+    def highlight_visible(self):
+        """Highlights the text found in the matching lines of the visible
+        part of the text view, removing the previous highlighting. The rest
+        of the text buffer is not searched."""
+        self.highlight_source = None
+        chat = self.chat
+        if self.highlighted is not None:
+            (start, end) = (max(0, offset - chat.trimmed_chars)
+                            for offset in self.highlighted)
+            chat.remove_tag(chat.found_tag, chat.get_iter_at_offset(start),
+                            chat.get_iter_at_offset(end))
+            self.highlighted = None
+        if self.find_pattern is None or not self.find_positions:
+            return GLib.SOURCE_REMOVE
+        rect = self.textview.get_visible_rect()
+        (_, top) = self.textview.get_iter_at_location(rect.x, rect.y)
+        (_, bottom) = self.textview.get_iter_at_location(
+            rect.x, rect.y + rect.height)
+        bottom.forward_to_line_end()
+        first = chat.trimmed_chars + top.get_offset()
+        last = chat.trimmed_chars + bottom.get_offset()
+        # The matching line starting before the top may still be visible
+        index = max(0, bisect.bisect_right(self.find_positions,
+                                           (first, sys.maxsize)) - 1)
+        for (position, end) in self.find_positions[index:]:
+            if position >= last:
+                break
+            if end <= position:
+                end = chat.get_end_position()
+            (start, end) = (max(position, first) - chat.trimmed_chars,
+                            min(end, last) - chat.trimmed_chars)
+            if start >= end:
+                continue
+            text = chat.get_text(chat.get_iter_at_offset(start),
+                                 chat.get_iter_at_offset(end), True)
+            for match in self.find_pattern.finditer(text):
+                chat.apply_tag(chat.found_tag,
+                               chat.get_iter_at_offset(start + match.start()),
+                               chat.get_iter_at_offset(start + match.end()))
+        self.highlighted = (first, last)
+        return GLib.SOURCE_REMOVE
+
+    def copy_selection(self):
+        """Copies the text selected in the chat view to the clipboard.
+        Returns False if no text is selected."""
+        if isinstance(self.textview, ChatView):
+            return self.textview.copy_clipboard()
+        if not self.chat.get_selection_bounds():
+            return False
+        self.textview.emit("copy-clipboard")
+        return True
+
+    def get_max_lines(self):
+        """Returns the maximum number of lines kept for this buffer, or 0
+        if there is no limit."""
+        local_variables = self.data.get("local_variables") or {}
+        buffer_type = local_variables.get("type")
+        value = None
+        if buffer_type in ("server", "channel", "private"):
+            value = self.config.get("look", "max_lines_" + buffer_type)
+        if not value:
+            value = self.config.get("look", "max_lines")
+        return int(value)
+
+    def trim_scrollback(self):
+        """Removes the oldest lines beyond the scrollback limit, keeping the
+        visible part of the buffer in place if scrolled up."""
+        if not self.is_built():
+            self.lines.trim_head(self.get_max_lines())
+            return
+        mark = self._mark_top()
+        self._trim_lines()
+        self._scroll_to_top(mark, self._trim_chat())
+
+    def _trim_lines(self):
+        """Removes the oldest stored lines beyond the scrollback limit, and
+        their positions."""
+        if self.lines.trim_head(self.get_max_lines()):
+            self._trim_positions()
+            if self.expanded_folds:
+                self.expanded_folds = {fold for fold in self.expanded_folds
+                                       if fold >= self.lines.first}
+
     def clear(self):
-        self.chat.delete(*self.chat.get_bounds())
+        self.lines.clear()
+        self.projected = self.lines.end
+        self.resume_date = None
+        self._reset_display()
+        self.expanded_folds = set()
+        if self.is_built():
+            self.chat.clear()
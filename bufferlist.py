@@ -19,6 +19,7 @@
 #
 
 import re
+import time
 from gi.repository import Gtk, GObject, Gdk
 
 class BufferStore(Gtk.TreeStore):
@@ -147,7 +148,7 @@ class BufferList(GObject.GObject):
 
     def append(self, buf):
         """Appends a buffer to the BufferList. Finds its logical position in and inserts it to the
-        bufferlist widget and adds the buffers' widget to the widget stack.
+        bufferlist widget. Its widget is built and added to the widget stack when first shown.
         """
         self.buffers.append(buf)
         #Find position in the list of buffers
@@ -158,10 +159,6 @@ class BufferList(GObject.GObject):
             parent = self.get_server_row_iter(server)
         self.buffer_store.append(
             parent, (buf.get_name(), buf.colors_for_notify["default"], buf.pointer()))
-        if buf.data.get('full_name').startswith("irc") is False:
-            buf.textview.set_monospace(True)
-        #Add its widget to the stack
-        self.stack.add_named(buf, buf.data["__path"][0])
         self.pointer_to_buffer_map[buf.pointer()] = buf
         buf.connect("notifyLevelChanged", self.on_level_changed)
 
@@ -197,8 +194,13 @@ class BufferList(GObject.GObject):
         if buf.entry.get_selection_bounds():
             buf.entry.emit("copy-clipboard")
             return
-        if buf.chat.get_selection_bounds():
-            buf.textview.emit("copy-clipboard")
+        buf.copy_selection()
+
+    def on_find(self, *args):
+        """Callback for the find action."""
+        buf = self.active_buffer()
+        if buf is not None:
+            buf.show_find()
 
     def show(self, bufptr):
         """ Initiates a buffer switch by emitting the bufferSwitched signal. """
@@ -209,8 +211,12 @@ class BufferList(GObject.GObject):
         active_buf = self.active_buffer()
         if active_buf is not None:
             active_buf.active = False
+            active_buf.last_viewed = time.monotonic()
         buf = self.get_buffer_from_pointer(bufptr)
         self.pointer_to_buffer_map["active"] = buf
+        buf.build()
+        if buf.get_parent() is None:
+            self.stack.add_named(buf, buf.pointer())
         buf.show_all()
         self.stack.set_visible_child(buf)
         if len(buf.nick_display_widget.get_model())==0:
@@ -222,6 +228,8 @@ class BufferList(GObject.GObject):
             self.tree.expand_to_path(path)
         self.tree.get_selection().select_path(path)
         buf.active = True
+        buf.last_viewed = time.monotonic()
+        buf.flush_deferred()
         buf.scrollbottom()
 
     def remove(self, bufptr):
@@ -0,0 +1,44 @@
+import collections
+
+
+class LRUCache():
+    """Mapping with a maximum size, discarding the least recently used entry
+    when full. Counts hits and misses so its size can be tuned."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """Returns the value cached for key, or default."""
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Caches value for key."""
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        """Removes all entries."""
+        self.data.clear()
+
+    def info(self):
+        """Returns a string with the cache statistics."""
+        total = self.hits + self.misses
+        return "{} hits, {} misses ({:.1f}% hits), {}/{} entries".format(
+            self.hits, self.misses, 100*self.hits/total if total else 0,
+            len(self.data), self.maxsize)
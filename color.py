@@ -20,7 +20,9 @@
 # along with QWeeChat.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
 import re
+from cache import LRUCache
 
 RE_COLOR_ATTRS = r'[*!/_|]*'
 RE_COLOR_STD = r'(?:%s\d{2})' % RE_COLOR_ATTRS
@@ -66,6 +68,32 @@ TERMINAL_COLORS = \
     '5858586262626c6c6c7676768080808a8a8a9494949e9e9e' \
     'a8a8a8b2b2b2bcbcbcc6c6c6d0d0d0dadadae4e4e4eeeeee'
 
+# Style of a run of text: foreground and background color references (see
+# Color.rgb) or None for the default color, and a frozenset of attributes:
+# bold ('*'), reverse ('!'), italic ('/') or underline ('_')
+Style = collections.namedtuple('Style', ('foreground', 'background', 'attrs'))
+
+# Color references of the color options follow the 256 terminal colors
+OPTION_COLORS = 256
+
+# Attributes set and removed by \x1A and \x1B codes
+ATTRIBUTE_CODES = {'\x01': '*', '\x02': '!', '\x03': '/', '\x04': '_'}
+
+# In an effect, a color left unchanged
+KEEP = -1
+
+# Number of tokenized strings remembered, see Color.tokenize
+RUNS_CACHE_SIZE = 4096
+
+# Longer strings, such as most messages, are tokenized without caching
+RUNS_CACHE_MAX_LENGTH = 128
+
+# Runs of tokenized strings, keyed by (string, palette version). The
+# palette version identifies the color options the string was tokenized
+# with, as they set the styles of WeeChat colors.
+runs_cache = LRUCache(RUNS_CACHE_SIZE)
+_palette_versions = {}
+
 # WeeChat basic colors (color name, index in terminal colors)
 WEECHAT_BASIC_COLORS = (
     ('default', 0), ('black', 0), ('darkgray', 8), ('red', 1),
@@ -82,6 +110,25 @@ class Color():
     def __init__(self, color_options, debug=False):
         self.color_options = color_options
         self.debug = debug
+        self.palette_version = _palette_versions.setdefault(
+            tuple(color_options), len(_palette_versions))
+        # RGB strings of color references
+        self.rgb_colors = ['#' + self._rgb_color(index)
+                           for index in range(OPTION_COLORS)]
+        # Attributes and color reference of each color option
+        self.options = []
+        for (index, option) in enumerate(color_options):
+            attrs = ''
+            while option.startswith(('*', '!', '/', '_', '|')):
+                attrs += option[0]
+                option = option[1:]
+            self.rgb_colors.append(option)
+            self.options.append((attrs, OPTION_COLORS + index
+                                 if option not in ('', '$') else None))
+        # Effects of color codes on the style, see _get_effect
+        self.effects = {}
+        # Interned styles
+        self.styles = {}
 
     @staticmethod
     def _rgb_color(index):
@@ -192,6 +239,154 @@ class Color():
             group = group.replace(chr(code), '<x%02X>' % code)
         return group
 
+    def rgb(self, ref):
+        """Returns the RGB string of a color reference of a Style."""
+        return self.rgb_colors[ref]
+
+    def _get_effect(self, code):
+        """Returns the effect of a color code on the style, as (reset,
+        attributes added, attributes removed, foreground, background), where
+        the colors are references, None for the default color or KEEP. Codes
+        have the same effect as their conversion by convert."""
+        effect = self.effects.get(code)
+        if effect is not None:
+            return effect
+        state = {'reset': False, 'add': set(), 'remove': set(),
+                 'foreground': KEEP, 'background': KEEP}
+
+        def reset():
+            state.update(reset=True, add=set(), remove=set(),
+                         foreground=None, background=None)
+
+        def add(attrs):
+            attrs = set(attrs) - {'|'}
+            state['add'] |= attrs
+            state['remove'] -= attrs
+
+        def set_color(fg_bg, ref):
+            if fg_bg == 'F':
+                state.update(foreground=ref, background=None)
+            else:
+                state['background'] = ref
+
+        def color_attr(fg_bg, color):
+            extended = color.startswith('@')
+            if extended:
+                color = color[1:]
+            attrs = ''
+            while color.startswith(('*', '!', '/', '_', '|')):
+                attrs += color[0]
+                color = color[1:]
+            index = int(color)
+            if extended:
+                if index < OPTION_COLORS:
+                    add(attrs)
+                    set_color(fg_bg, index)
+            elif index < len(WEECHAT_BASIC_COLORS):
+                add(attrs)
+                if index != 0:
+                    set_color(fg_bg, WEECHAT_BASIC_COLORS[index][1])
+
+        if code[0] == '\x1C' or code == '\x19\x1C':
+            reset()
+        elif code[0] == '\x1A':
+            if code[1] in ATTRIBUTE_CODES:
+                add(ATTRIBUTE_CODES[code[1]])
+        elif code[0] == '\x1B':
+            if code[1] in ATTRIBUTE_CODES:
+                state['remove'].add(ATTRIBUTE_CODES[code[1]])
+                state['add'].discard(ATTRIBUTE_CODES[code[1]])
+        elif code[1] in ('F', 'B'):
+            color_attr(code[1], code[2:])
+        elif code[1] == '*':
+            items = code[2:].split(',')
+            color_attr('F', items[0])
+            if len(items) > 1:
+                color_attr('B', items[1])
+        elif code[1:].isdigit():
+            index = int(code[1:])
+            if index in (1, 13):
+                reset()
+            elif index == 15:
+                reset()
+                add('*')
+            elif index < len(self.options):
+                reset()
+                (attrs, ref) = self.options[index]
+                add(attrs)
+                if ref is not None:
+                    set_color('F', ref)
+        # other codes (bar, emphasis, ncurses pair) are ignored
+        effect = (state['reset'], frozenset(state['add']),
+                  frozenset(state['remove']), state['foreground'],
+                  state['background'])
+        self.effects[code] = effect
+        return effect
+
+    def tokenize(self, text):
+        """Splits text received from the server into runs of text with the
+        same style, in one pass. Returns a list of (text, style), where
+        style is an interned Style, or None for the default style. The runs
+        of short colored strings, such as prefixes, are cached in runs_cache
+        and must not be modified."""
+        if not text:
+            return []
+        if len(text) > RUNS_CACHE_MAX_LENGTH:
+            return self._tokenize(text)
+        if "\x19" not in text and "\x1A" not in text and \
+                "\x1B" not in text and "\x1C" not in text:
+            # Plain text, most messages, is not worth caching
+            return [(text, None)]
+        key = (text, self.palette_version)
+        runs = runs_cache.get(key)
+        if runs is None:
+            runs = self._tokenize(text)
+            runs_cache.put(key, runs)
+        return runs
+
+    def _tokenize(self, text):
+        runs = []
+        # Text of the current run, split by color codes not changing style
+        pieces = []
+        foreground = None
+        background = None
+        attrs = frozenset()
+        style = None
+        pos = 0
+        for match in RE_COLOR.finditer(text):
+            start = match.start()
+            if start > pos:
+                pieces.append(text[pos:start])
+            pos = match.end()
+            (reset, add, remove, fg, bg) = self._get_effect(match.group(0))
+            if reset:
+                foreground = None
+                background = None
+                attrs = frozenset()
+            if add or remove:
+                attrs = (attrs - remove) | add
+            if fg != KEEP:
+                foreground = fg
+            if bg != KEEP:
+                background = bg
+            key = (foreground, background, attrs)
+            try:
+                new_style = self.styles[key]
+            except KeyError:
+                new_style = Style(*key) if foreground is not None or \
+                    background is not None or attrs else None
+                self.styles[key] = new_style
+            if new_style is not style:
+                if pieces:
+                    runs.append((''.join(pieces), style))
+                    pieces = []
+                style = new_style
+        if pos < len(text):
+            pieces.append(text[pos:])
+        if pieces:
+            runs.append((''.join(pieces), style))
+        return runs
+
     def convert(self, text):
         """Converts the formatting received from the server to a simpler one,
            using RGB values and single character style indicators. """
@@ -25,17 +25,35 @@ import os
 
 CONFIG_DEFAULT_RELAY_LINES = 50
 
-CONFIG_DEFAULT_SECTIONS = ('relay', 'look', 'color')
+CONFIG_DEFAULT_SECTIONS = ('relay', 'look', 'color', 'proxy')
 CONFIG_DEFAULT_OPTIONS = (('relay.server', ''),
                           ('relay.port', ''),
                           ('relay.ssl', 'on'),
                           ('relay.password', ''),
                           ('relay.autoconnect', 'off'),
                           ('relay.lines', str(CONFIG_DEFAULT_RELAY_LINES)),
+                          ('relay.network_process', 'off'),
+                          ('relay.network_backend', 'gio'),
                           ('look.debug', 'off'),
                           ('look.statusbar', 'off'),
                           ('look.buffer_time_format', '%H:%M'),
-                          ('look.margin_size', 10))
+                          ('look.margin_size', 10),
+                          ('look.chat_view', 'text'),
+                          ('look.overload_protection', 'on'),
+                          ('look.background_mode', 'hidden'),
+                          ('look.max_lines', '10000'),
+                          ('look.max_lines_server', ''),
+                          ('look.max_lines_channel', ''),
+                          ('look.max_lines_private', ''),
+                          ('look.color_cache_size', '4096'),
+                          ('look.hibernate_after', '900'),
+                          ('look.free_widgets_after', '0'),
+                          ('look.fold_server_messages', 'on'),
+                          ('look.search_index_size', '2000000'),
+                          ('look.history_lines', '1000'),
+                          ('proxy.address', '127.0.0.1'),
+                          ('proxy.port', '9009'),
+                          ('proxy.lines', '200'))
 
 # Default colors for WeeChat color options (option name, #rgb value)
 CONFIG_DEFAULT_COLOR_OPTIONS = (
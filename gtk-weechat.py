@@ -17,24 +17,42 @@
 # You should have received a copy of the GNU General Public License
 # along with QWeeChat.  If not, see <http://www.gnu.org/licenses/>.
 #
+import time
+# Start of the process, for --startup-profile
+STARTUP_START = time.perf_counter()
+# pylint: disable=wrong-import-position
+import collections
 import copy
 import traceback
 import os
 import sys
 import gi
 gi.require_version('Gtk', '3.0')
+gi.require_version('PangoCairo', '1.0')
 from gi.repository import Gtk, Gio, GLib, Gdk
 from state import State
 from connection import ConnectionSettings
 from bufferlist import BufferList
 from config import GTKWeechatConfig
+import buffer
 from buffer import Buffer
+from overload import OverloadController
+from search import SearchIndex
+from history import HistoryCache
+import color
 import protocol
-from network import Network, ConnectionStatus
+from network import Network, AsyncioNetwork, ConnectionStatus
+from netprocess import NetworkProcess
+from startup import StartupProfile
 if sys.version_info < (3,):
     sys.exit("Requires Python version 3.0 or higher. (Version {}.{} detected)".format(
         *sys.version_info))
 
+# Phases of startup, printed with --startup-profile once initialized
+STARTUP_PROFILE = "--startup-profile" in sys.argv
+PROFILE = StartupProfile(STARTUP_START)
+PROFILE.mark("imports")
+
 
 CONFIG_DIR = GLib.get_user_config_dir()
 if not CONFIG_DIR:
@@ -44,6 +62,7 @@ else:
     CONFIG_DIR = os.path.join(CONFIG_DIR, 'gtk-weechat')
     os.makedirs(CONFIG_DIR, mode=0o0755, exist_ok=True)
 CONFIG_FILENAME = '%s/gtk-weechat.conf' % CONFIG_DIR
+HISTORY_FILENAME = '%s/history.sqlite3' % CONFIG_DIR
 
 CSS_STYLE_DIR = os.path.dirname(os.path.realpath(__file__))
 for dir in GLib.get_system_data_dirs():
@@ -53,6 +72,16 @@ for dir in GLib.get_system_data_dirs():
 if os.path.exists(user_data_dir := os.path.join(GLib.get_user_data_dir(),
                                                 'gtk-weechat', 'css')):
     CSS_STYLE_DIR = user_data_dir
+PROFILE.mark("config and style directories")
+
+# Hotlist polling intervals, in seconds, when the window is focused and
+# when it is not. Polling is paused while the window is hidden.
+HOTLIST_INTERVAL = 60
+HOTLIST_INTERVAL_UNFOCUSED = 300
+
+# Longest interval, in seconds, between checks for buffers to hibernate or
+# whose widgets to free
+HIBERNATE_INTERVAL = 60
 
 
 class MainWindow(Gtk.ApplicationWindow):
@@ -62,9 +91,15 @@ class MainWindow(Gtk.ApplicationWindow):
         Gtk.ApplicationWindow.__init__(self, *args, **kwargs)
         self.set_default_size(950, 700)
         self.connect("delete-event", self.on_delete_event)
+        self.connect("window-state-event", self.on_visibility_changed)
+        self.connect("map-event", self.on_visibility_changed)
+        self.connect("unmap-event", self.on_visibility_changed)
+        self.connect("notify::is-active", self.on_visibility_changed)
 
         # Get the settings from the config file
         self.config = config
+        color.runs_cache.maxsize = int(
+            self.config.get('look', 'color_cache_size'))
 
         # Set up a list of buffer objects, holding data for every buffer
         self.buffers = BufferList()
@@ -72,6 +107,52 @@ class MainWindow(Gtk.ApplicationWindow):
         self.buffers.connect_after(
             "bufferSwitched", self.after_buffer_switched)
 
+        # Decides when background buffers should only record lines
+        self.overload = OverloadController()
+
+        # Full-text index of the lines of all buffers
+        self.search = SearchIndex(
+            int(self.config.get('look', 'search_index_size')))
+
+        # Buffers and lines of the last session, and the buffers whose lines
+        # restored from it are not indexed yet, see load_history
+        self.history = None
+        history_lines = int(self.config.get('look', 'history_lines'))
+        if history_lines > 0:
+            self.history = HistoryCache(HISTORY_FILENAME, history_lines)
+        self.unindexed = collections.OrderedDict()
+        self.index_source = None
+
+        # In background mode no buffer renders, see update_background_mode
+        self.background = False
+        self.background_cpu_start = None
+        self.background_wall_start = None
+        self.hotlist_timer = None
+        self.hotlist_interval = None
+
+        # Connection settings dialog and dark mode style provider for
+        # non-standard themes, created when idle after the first frame or
+        # when first needed
+        self.connection_settings = None
+        self.dark_fallback_provider = None
+
+        # Set up the network module, and start connecting while the window
+        # is built. Messages are only parsed once the main loop runs.
+        if self.config.get("relay", "network_process") == "on":
+            self.net = NetworkProcess(self.config)
+            self.net.connect("messageDecoded", self._network_weechat_decoded)
+        else:
+            if self.config.get("relay", "network_backend") == "asyncio":
+                self.net = AsyncioNetwork(self.config)
+            else:
+                self.net = Network(self.config)
+            self.net.connect("messageFromWeechat", self._network_weechat_msg)
+        autoconnect = self.net.check_settings() is True and \
+            self.config.get("relay", "autoconnect") == "on"
+        if autoconnect and self.net.connect_weechat() is False:
+            print("Failed to connect.")
+        PROFILE.mark("network started")
+
         # Set up GTK box
         box_horizontal = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL,
                                  spacing=0)
@@ -130,13 +211,10 @@ class MainWindow(Gtk.ApplicationWindow):
         # Make everything visible (All is hidden by default in GTK 3)
         self.show_all()
 
-        # Set up the network module
-        self.net = Network(self.config)
-        self.net.connect("messageFromWeechat", self._network_weechat_msg)
+        # Follow the connection now that the menu exists
         self.net.connect("connectionChanged", self._connection_changed)
-
-        # Connect to connection settings signals
-        CONNECTION_SETTINGS.connect("connect", self.on_settings_connect)
+        self._connection_changed()
+        PROFILE.mark("main window widgets")
 
         # Set up actions
         action = Gio.SimpleAction.new("buffer_next", None)
@@ -148,6 +226,9 @@ class MainWindow(Gtk.ApplicationWindow):
         action = Gio.SimpleAction.new("copy_to_clipboard", None)
         action.connect("activate", self.buffers.on_copy_to_clipboard)
         self.add_action(action)
+        action = Gio.SimpleAction.new("find", None)
+        action.connect("activate", self.buffers.on_find)
+        self.add_action(action)
         action = Gio.SimpleAction.new("buffer_expand", None)
         action.connect("activate", self.on_buffer_expand)
         self.add_action(action)
@@ -155,31 +236,79 @@ class MainWindow(Gtk.ApplicationWindow):
         action.connect("activate", self.on_buffer_collapse)
         self.add_action(action)
 
-        # Autoconnect if necessary
-        if self.net.check_settings() is True and \
-                self.config.get("relay", "autoconnect") == "on":
-            if self.net.connect_weechat() is False:
-                print("Failed to connect.")
-            else:
-                self.menuitem_connect.set_sensitive(False)
-                self.menuitem_disconnect.set_sensitive(True)
-        else:
-            CONNECTION_SETTINGS.display()
+        # Show the buffers of the last session until WeeChat lists them
+        if self.history is not None:
+            self.load_history()
+            PROFILE.mark("history loaded")
+
+        # Ask for connection settings if not connecting
+        if not autoconnect:
+            self.get_connection_settings().display()
 
         # Enable darkmode if enabled before
-        self.dark_fallback_provider = Gtk.CssProvider()
-        self.dark_fallback_provider.load_from_path(
-            "{}/dark_fallback.css".format(CSS_STYLE_DIR))
         if STATE.get_dark():
             menuitem_darkmode.set_active(True)
 
-        # Sync our local hotlist with the weechat server
-        GLib.timeout_add_seconds(60, self.request_hotlist)
+        # The rest is initialized once the first frame is drawn
+        self.first_draw_handler = self.connect_after(
+            "draw", self.on_first_draw)
+        PROFILE.mark("main window")
+
+    def on_first_draw(self, *args):
+        """Callback for when the window is first drawn."""
+        self.disconnect(self.first_draw_handler)
+        PROFILE.mark("first frame")
+        GLib.idle_add(self.on_startup_idle)
+        return False
+
+    def on_startup_idle(self):
+        """Initializes what is not needed for the first frame."""
+        self.get_connection_settings()
+        self.get_dark_fallback_provider()
+
+        # Sync our local hotlist with the weechat server, unless already
+        # started or paused by update_background_mode
+        if self.hotlist_interval is None and not self.background:
+            self.set_hotlist_interval(HOTLIST_INTERVAL)
+
+        # Hibernate the buffers not viewed for a while, and free their
+        # widgets after a longer while
+        hibernate_after = int(self.config.get('look', 'hibernate_after'))
+        free_widgets_after = int(self.config.get('look', 'free_widgets_after'))
+        delays = [delay for delay in (hibernate_after, free_widgets_after)
+                  if delay > 0]
+        if delays:
+            GLib.timeout_add_seconds(
+                min(delays + [HIBERNATE_INTERVAL]),
+                self.hibernate_buffers, hibernate_after, free_widgets_after)
+        PROFILE.mark("deferred initialization")
+        if STARTUP_PROFILE:
+            PROFILE.report()
+        return GLib.SOURCE_REMOVE
+
+    def get_connection_settings(self):
+        """Returns the connection settings dialog, creating it if needed."""
+        if self.connection_settings is None:
+            self.connection_settings = ConnectionSettings(self.config)
+            self.connection_settings.connect(
+                "connect", self.on_settings_connect)
+        return self.connection_settings
+
+    def get_dark_fallback_provider(self):
+        """Returns the dark mode style provider for non-standard themes,
+        loading it if needed."""
+        if self.dark_fallback_provider is None:
+            self.dark_fallback_provider = Gtk.CssProvider()
+            self.dark_fallback_provider.load_from_path(
+                "{}/dark_fallback.css".format(CSS_STYLE_DIR))
+        return self.dark_fallback_provider
 
     def on_darkmode_toggled(self, source_object):
         """Callback for when the menubutton Dark is toggled. """
         settings = Gtk.Settings().get_default()
         dark = source_object.get_active()
+        # Before the theme changes, so that restyled views get the new colors
+        buffer.set_dark_colors(dark)
         if settings.props.gtk_theme_name == "Adwaita":
             if dark:
                 settings.props.gtk_application_prefer_dark_theme = True
@@ -191,8 +320,9 @@ class MainWindow(Gtk.ApplicationWindow):
             screen = Gdk.Screen().get_default()
             if dark:
                 style_context.add_provider_for_screen(
-                    screen, self.dark_fallback_provider, Gtk.STYLE_PROVIDER_PRIORITY_USER)
-            else:
+                    screen, self.get_dark_fallback_provider(),
+                    Gtk.STYLE_PROVIDER_PRIORITY_USER)
+            elif self.dark_fallback_provider is not None:
                 style_context.remove_provider_for_screen(
                     screen, self.dark_fallback_provider)
         for buf in self.buffers:
@@ -207,6 +337,116 @@ class MainWindow(Gtk.ApplicationWindow):
                 "(hotlist) hdata hotlist:gui_hotlist(*)\n")
         return True
 
+    def hibernate_buffers(self, hibernate_after, free_widgets_after):
+        """Hibernates the buffers not shown for hibernate_after seconds, and
+        frees the widgets of those not shown for free_widgets_after seconds,
+        if not 0."""
+        now = time.monotonic()
+        for buf in self.buffers:
+            if buf.active:
+                continue
+            if free_widgets_after > 0 and buf.is_built() and \
+                    now - buf.last_viewed >= free_widgets_after:
+                buf.unbuild()
+                if self.config.get('look', 'debug') == 'on':
+                    print("Freed the widgets of {}.".format(buf.get_name()))
+            if hibernate_after <= 0 or buf.lines.hibernated or \
+                    now - buf.last_viewed < hibernate_after:
+                continue
+            buf.hibernate()
+            if self.config.get('look', 'debug') == 'on':
+                print("Hibernated {}: {} lines in {} bytes.".format(
+                    buf.get_name(), len(buf.lines),
+                    buf.lines.compressed_size()))
+        return True
+
+    def set_hotlist_interval(self, seconds):
+        """(Re)starts hotlist polling every given number of seconds.
+        Polling is stopped if seconds is None."""
+        if seconds == self.hotlist_interval:
+            return
+        self.hotlist_interval = seconds
+        if self.hotlist_timer is not None:
+            GLib.source_remove(self.hotlist_timer)
+            self.hotlist_timer = None
+        if seconds is not None:
+            self.hotlist_timer = GLib.timeout_add_seconds(
+                seconds, self.request_hotlist)
+
+    def on_visibility_changed(self, *args):
+        """Callback for changes in window state, mapping and focus."""
+        self.update_background_mode()
+        return False
+
+    def update_background_mode(self):
+        """Enters or leaves background mode depending on whether the window
+        is visible and focused. While in background mode no lines are
+        rendered, only recorded, and hotlist polling is paused.
+        """
+        mode = self.config.get('look', 'background_mode')
+        gdk_window = self.get_window()
+        hidden = not self.get_mapped() or gdk_window is None or \
+            gdk_window.get_state() & (Gdk.WindowState.ICONIFIED |
+                                      Gdk.WindowState.WITHDRAWN)
+        focused = self.is_active()
+        background = (mode in ('hidden', 'unfocused') and hidden) or \
+            (mode == 'unfocused' and not focused)
+        if background and not self.background:
+            self.background = True
+            self.background_cpu_start = time.process_time()
+            self.background_wall_start = time.monotonic()
+            self.set_hotlist_interval(None)
+        elif not background and self.background:
+            self.background = False
+            if self.config.get('look', 'debug') == 'on':
+                print("Background for {:.1f} s, used {:.3f} s of CPU.".format(
+                    time.monotonic()-self.background_wall_start,
+                    time.process_time()-self.background_cpu_start))
+            # Catch up with a single batched render of the active buffer,
+            # other buffers are rendered when they are shown.
+            active_buf = self.buffers.active_buffer()
+            if active_buf is not None:
+                active_buf.flush_deferred()
+                active_buf.scrollbottom()
+            self.request_hotlist()
+        if not self.background:
+            self.set_hotlist_interval(
+                HOTLIST_INTERVAL if focused else HOTLIST_INTERVAL_UNFOCUSED)
+
+    def load_history(self):
+        """Shows the buffers and lines of the last session from the history
+        cache. They are replaced by those listed by WeeChat once connected,
+        keeping the lines, see _parse_listbuffers."""
+        for (data, lines) in self.history.load():
+            buf = Buffer(self.config, data, self.search)
+            self.buffers.append(buf)
+            buf.connect("messageToWeechat", self.on_send_message)
+            for line in lines:
+                buf.defer_line(*line)
+            if lines:
+                self.unindexed[buf] = None
+        if self.buffers.get_buffer_from_pointer(STATE.get_active_node()):
+            self.buffers.show(STATE.get_active_node())
+        self.expand_buffers()
+        if self.unindexed:
+            self.index_source = GLib.idle_add(self.on_index_idle)
+
+    def index_restored(self, buf):
+        """Adds the lines of a buffer restored from the history cache to
+        the search index, before any line received."""
+        self.unindexed.pop(buf, None)
+        for (offset, line) in enumerate(buf.lines):
+            self.search.add(buf.pointer(), buf.lines.first + offset, line)
+
+    def on_index_idle(self):
+        """Indexes the lines restored of one buffer at a time, when idle."""
+        if self.unindexed:
+            self.index_restored(next(iter(self.unindexed)))
+        if self.unindexed:
+            return True
+        self.index_source = None
+        return False
+
     def on_delete_event(self, *args):
         """Callback function to save buffer state when window is closed."""
         self.save_expanded_buffers()
@@ -227,7 +467,7 @@ class MainWindow(Gtk.ApplicationWindow):
     def on_settings_connect(self, *args):
         """Callback for the menubutton connect."""
         if self.net.check_settings() is False:
-            CONNECTION_SETTINGS.display()
+            self.get_connection_settings().display()
             return
         if self.net.connection_status in (ConnectionStatus.NOT_CONNECTED,
                                           ConnectionStatus.CONNECTION_LOST):
@@ -264,13 +504,15 @@ class MainWindow(Gtk.ApplicationWindow):
 
     def on_connect_clicked(self, *args):
         """Callback function for when the connect button is clicked."""
-        CONNECTION_SETTINGS.display()
+        self.get_connection_settings().display()
 
     def on_disconnect_clicked(self, *args):
         """Callback function for when the disconnect button is clicked."""
         print("Disonnecting")
         self.net.disconnect_weechat()
         self.buffers.clear()
+        self.search.clear()
+        self.unindexed.clear()
         self.update_headerbar()
 
     def on_send_message(self, source_object, entry):
@@ -300,6 +542,17 @@ class MainWindow(Gtk.ApplicationWindow):
                   % traceback.format_exc())
             self.net.disconnect_weechat()
 
+    def _network_weechat_decoded(self, source_object, message):
+        """Called when a message, decoded by the network process, is
+        received from WeeChat."""
+        # pylint: disable=bare-except
+        try:
+            self.parse_message(message)
+        except:
+            print('Error while parsing message from WeeChat:\n%s'
+                  % traceback.format_exc())
+            self.net.disconnect_weechat()
+
     def parse_message(self, message):
         """Parse a WeeChat message."""
         if message.msgid.startswith('debug'):
@@ -328,14 +581,32 @@ class MainWindow(Gtk.ApplicationWindow):
         for obj in message.objects:
             if obj.objtype != 'hda' or obj.value['path'][-1] != 'buffer':
                 continue
+            # Buffers already shown, from the history cache or before a
+            # reconnection, keep their lines and their lines indexed
+            previous = {buf.data.get("full_name"): buf for buf in self.buffers}
+            unindexed = self.unindexed
+            self.unindexed = collections.OrderedDict()
+            pointers = {}
             self.buffers.clear()
             for item in obj.value['items']:
-                buf = Buffer(self.config, item)
+                buf = Buffer(self.config, item, self.search)
+                old = previous.get(item.get("full_name"))
+                if old is not None:
+                    buf.restore_lines(old.lines)
+                    if old in unindexed:
+                        self.unindexed[buf] = None
+                    else:
+                        pointers[old.pointer()] = buf.pointer()
                 self.buffers.append(buf)
                 buf.connect("messageToWeechat", self.on_send_message)
                 active_node = STATE.get_active_node()
                 if buf.pointer() == active_node:
                     self.buffers.show(buf.pointer())
+            self.search.reassign(pointers)
+            if self.history is not None:
+                self.history.set_buffers(obj.value['items'])
+        if self.unindexed and self.index_source is None:
+            self.index_source = GLib.idle_add(self.on_index_idle)
         self.expand_buffers()
         self.request_hotlist()
 
@@ -361,6 +632,11 @@ class MainWindow(Gtk.ApplicationWindow):
                     else:
                         notify_level = "low"
                 buf = self.buffers.get_buffer_from_pointer(ptrbuf)
+                # The relay cannot send only the lines newer than those
+                # restored, the backlog lines already shown are skipped
+                if buf and message.msgid == 'listlines' and \
+                        buf.skip_restored(item['date'], item['message']):
+                    continue
                 if buf:
                     lines.append(
                         (ptrbuf,
@@ -368,11 +644,56 @@ class MainWindow(Gtk.ApplicationWindow):
                           item['message'], item['tags_array']))
                     )
                     buf.set_notify_level(notify_level)
-            if message.msgid == 'listlines':
+            # The backlog is rendered in bulk, buffer by buffer. It is left
+            # out of the overload accounting: it arrives all at once on every
+            # connection, but is not a rate of incoming lines.
+            bulk = message.msgid == 'listlines'
+            if bulk:
                 lines.reverse()
+            else:
+                self.overload.lines_received(len(lines))
+            protect = self.config.get('look', 'overload_protection') == 'on'
+            active_buf = self.buffers.active_buffer()
+            rendered_bufs = set()
+            bulk_lines = {}
+            # Numbers the lines will have in the LineStore of their buffer
+            numbers = {}
             for line in lines:
-                self.buffers.get_buffer_from_pointer(line[0]).chat.display(*line[1])
-                self.buffers.get_buffer_from_pointer(line[0]).scrollbottom()
+                buf = self.buffers.get_buffer_from_pointer(line[0])
+                if buf in self.unindexed:
+                    self.index_restored(buf)
+                number = numbers.get(buf, buf.lines.end)
+                numbers[buf] = number + 1
+                self.search.add(line[0], number, line[1])
+                if self.history is not None:
+                    self.history.add_line(buf.data["full_name"], line[1])
+                # Under overload only the active buffer stays live, the
+                # others record their lines until they are shown again.
+                # A buffer that already has lines not rendered keeps deferring
+                # so that lines are rendered in order.
+                # In background mode no buffer renders at all.
+                if self.background or (buf is not active_buf and (
+                        buf.pending_lines() or
+                        (protect and self.overload.is_saturated()))):
+                    buf.defer_line(*line[1])
+                    if not bulk:
+                        self.overload.lines_deferred(1)
+                    continue
+                if bulk:
+                    bulk_lines.setdefault(buf, []).append(line[1])
+                    continue
+                start = time.perf_counter()
+                buf.display_line(*line[1])
+                self.overload.lines_rendered(1, time.perf_counter()-start)
+                buf.scrollbottom()
+                rendered_bufs.add(buf)
+            for (buf, buf_lines) in bulk_lines.items():
+                buf.display_bulk(buf_lines)
+                buf.scrollbottom()
+            for buf in rendered_bufs:
+                buf.trim_scrollback()
+            for buf in numbers:
+                self.search.trim(buf.pointer(), buf.lines.first)
             # Trying not to freeze GUI on e.g. /list:
             while Gtk.events_pending():
                 Gtk.main_iteration()
@@ -398,7 +719,7 @@ class MainWindow(Gtk.ApplicationWindow):
                         group, item['group'], item['prefix'], item['name'],
                         item['visible'])
         for buf in buffer_refresh:
-            buf.nicklist_refresh()
+            buf.nicklist_refresh(full=True)
 
     def _parse_nicklist_diff(self, message):
         """Parse a WeeChat message with a buffer nicklist diff."""
@@ -436,9 +757,11 @@ class MainWindow(Gtk.ApplicationWindow):
             if obj.objtype != 'hda' or obj.value['path'][-1] != 'buffer':
                 continue
             for item in obj.value['items']:
-                buf = Buffer(self.config, item)
+                buf = Buffer(self.config, item, self.search)
                 self.buffers.append(buf)
                 buf.connect("messageToWeechat", self.on_send_message)
+                if self.history is not None:
+                    self.history.set_buffer(item)
                 self.buffers.show(buf.pointer())
                 while Gtk.events_pending():
                     Gtk.main_iteration()
@@ -455,6 +778,7 @@ class MainWindow(Gtk.ApplicationWindow):
                 buf = self.buffers.get_buffer_from_pointer(bufptr)
                 if buf is None:
                     continue
+                full_name = buf.data["full_name"]
                 if message.msgid == '_buffer_type_changed':
                     buf.data['type'] = item['type']
                 elif message.msgid in ('_buffer_moved', '_buffer_merged',
@@ -470,11 +794,26 @@ class MainWindow(Gtk.ApplicationWindow):
                     self.update_headerbar()
                 elif message.msgid == '_buffer_cleared':
                     buf.clear()
+                    self.search.remove(bufptr)
+                    self.unindexed.pop(buf, None)
+                    if self.history is not None:
+                        self.history.clear_lines(full_name)
+                    continue
                 elif message.msgid.startswith('_buffer_localvar_'):
                     buf.data['local_variables'] = \
                         item['local_variables']
                 elif message.msgid == '_buffer_closing':
                     self.buffers.remove(bufptr)
+                    self.search.remove(bufptr)
+                    self.unindexed.pop(buf, None)
+                    if self.history is not None:
+                        self.history.remove_buffer(full_name)
+                    continue
+                if self.history is not None:
+                    if full_name != buf.data["full_name"]:
+                        self.history.rename_buffer(full_name, buf.data)
+                    else:
+                        self.history.set_buffer(buf.data)
 
     def _parse_hotlist(self, message):
         """Parse a WeeChat hotlist."""
@@ -503,7 +842,8 @@ class MainWindow(Gtk.ApplicationWindow):
 
     def on_buffer_switched(self, source_object, bufptr):
         """ Called right before another buffer is switched to. """
-        if self.buffers.active_buffer():
+        if self.buffers.active_buffer() and \
+                self.net.connection_status == ConnectionStatus.CONNECTED:
             cmd = "input {name} /buffer set hotlist -1\n".format(
                 name=self.buffers.active_buffer().data["full_name"])
             self.net.send_to_weechat(cmd)
@@ -572,23 +912,37 @@ class Application(Gtk.Application):
         self.set_accels_for_action("win.buffer_expand", ["<Alt>Right"])
         self.set_accels_for_action("win.buffer_collapse", ["<Alt>Left"])
         self.set_accels_for_action("win.copy_to_clipboard", ["<Control>c"])
+        self.set_accels_for_action("win.find", ["<Control>f"])
 
     def do_activate(self):
         if not self.window:
             self.window = MainWindow(self.config, title="Gtk-Weechat", application=self)
         self.window.present()
 
+    def do_shutdown(self):
+        if self.window:
+            self.window.net.shutdown()
+            if self.window.history is not None:
+                self.window.history.close()
+        if self.config.get('look', 'debug') == 'on':
+            # To tune look.color_cache_size
+            print("Color cache: {}.".format(color.runs_cache.info()))
+            if self.window:
+                print("Search index: {}.".format(self.window.search.info()))
+        Gtk.Application.do_shutdown(self)
+
     def on_quit(self, *args):
         """Callback for the quit action."""
         self.window.save_expanded_buffers()
         self.quit()
 
 
-# Start the application
-config = GTKWeechatConfig(CONFIG_FILENAME)
-CONNECTION_SETTINGS = ConnectionSettings(config)
-STATE = State("data.pickle")
-STATE.load_from_file()
-APP = Application(config)
-APP.run()
-STATE.dump_to_file()
+# Start the application (not when imported by the network process)
+if __name__ == "__main__":
+    config = GTKWeechatConfig(CONFIG_FILENAME)
+    STATE = State("data.pickle")
+    STATE.load_from_file()
+    PROFILE.mark("state loaded")
+    APP = Application(config)
+    APP.run()
+    STATE.dump_to_file()
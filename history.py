@@ -0,0 +1,164 @@
+import json
+import queue
+import sqlite3
+import threading
+
+# Number of queued writes committed together at most
+WRITE_BATCH = 1000
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS buffers ("
+    "full_name TEXT PRIMARY KEY, position INTEGER, data TEXT)",
+    "CREATE TABLE IF NOT EXISTS lines ("
+    "id INTEGER PRIMARY KEY, full_name TEXT, date INTEGER, prefix TEXT, "
+    "message TEXT, tags TEXT)",
+    "CREATE INDEX IF NOT EXISTS lines_buffer ON lines (full_name, id)",
+)
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=30)
+    for statement in _SCHEMA:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+
+class HistoryCache():
+    """SQLite store of the buffers and of their last max_lines lines, as
+    last received, to display them at startup before the relay answers.
+    Writes are queued and done by a thread, in batches, so receiving lines
+    never waits for the disk."""
+
+    def __init__(self, path, max_lines):
+        self.path = path
+        self.max_lines = max_lines
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="history",
+                                       daemon=True)
+        self.thread.start()
+
+    def load(self):
+        """Returns the buffers cached, in order, as (buffer data, lines)
+        where lines are (date, prefix, message, tags_array) tuples."""
+        connection = _connect(self.path)
+        try:
+            lines = {}
+            for (full_name, date, prefix, message, tags) in connection.execute(
+                    "SELECT full_name, date, prefix, message, tags FROM lines "
+                    "ORDER BY id"):
+                lines.setdefault(full_name, []).append(
+                    (date, prefix, message, tags.split(",") if tags else []))
+            return [(json.loads(data), lines.get(full_name, []))
+                    for (full_name, data) in connection.execute(
+                        "SELECT full_name, data FROM buffers "
+                        "ORDER BY position")]
+        finally:
+            connection.close()
+
+    def set_buffers(self, buffers):
+        """Replaces the buffers cached by the list of buffer data, e.g. from
+        a listbuffers message. Lines of buffers no longer listed are
+        removed."""
+        self.queue.put(("buffers", [(data["full_name"], json.dumps(data))
+                                    for data in buffers]))
+
+    def set_buffer(self, data):
+        """Adds or updates the data of a buffer."""
+        self.queue.put(("buffer", data["full_name"], json.dumps(data)))
+
+    def rename_buffer(self, old_name, data):
+        """Renames a buffer and updates its data."""
+        self.queue.put(("rename", old_name, data["full_name"],
+                        json.dumps(data)))
+
+    def remove_buffer(self, full_name):
+        """Removes a buffer and its lines."""
+        self.queue.put(("remove", full_name))
+
+    def clear_lines(self, full_name):
+        """Removes the lines of a buffer."""
+        self.queue.put(("clear", full_name))
+
+    def add_line(self, full_name, line):
+        """Adds a (date, prefix, message, tags_array) line to a buffer."""
+        (date, prefix, message, tags_array) = line
+        self.queue.put(("line", full_name, date, prefix, message,
+                        ",".join(tags_array or ())))
+
+    def close(self):
+        """Writes the queued changes and stops the writing thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        connection = _connect(self.path)
+        running = True
+        while running:
+            operations = [self.queue.get()]
+            while len(operations) < WRITE_BATCH:
+                try:
+                    operations.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in operations:
+                operations = operations[:operations.index(None)]
+                running = False
+            try:
+                self._write(connection, operations)
+            except sqlite3.Error as err:
+                print("Error writing the history cache: {}".format(err))
+                connection.rollback()
+        connection.close()
+
+    def _write(self, connection, operations):
+        touched = set()
+        with connection:
+            for operation in operations:
+                kind = operation[0]
+                if kind == "line":
+                    connection.execute(
+                        "INSERT INTO lines (full_name, date, prefix, message, "
+                        "tags) VALUES (?, ?, ?, ?, ?)", operation[1:])
+                    touched.add(operation[1])
+                elif kind == "buffers":
+                    connection.execute("DELETE FROM buffers")
+                    connection.executemany(
+                        "INSERT INTO buffers (full_name, position, data) "
+                        "VALUES (?, ?, ?)",
+                        [(full_name, position, data) for
+                         (position, (full_name, data))
+                         in enumerate(operation[1])])
+                    connection.execute(
+                        "DELETE FROM lines WHERE full_name NOT IN "
+                        "(SELECT full_name FROM buffers)")
+                elif kind == "buffer":
+                    connection.execute(
+                        "INSERT OR REPLACE INTO buffers (full_name, position, "
+                        "data) VALUES (?, COALESCE((SELECT position FROM "
+                        "buffers WHERE full_name = ?), (SELECT "
+                        "COALESCE(MAX(position), -1) + 1 FROM buffers)), ?)",
+                        (operation[1], operation[1], operation[2]))
+                elif kind == "rename":
+                    connection.execute(
+                        "UPDATE buffers SET full_name = ?, data = ? "
+                        "WHERE full_name = ?",
+                        (operation[2], operation[3], operation[1]))
+                    connection.execute(
+                        "UPDATE lines SET full_name = ? WHERE full_name = ?",
+                        (operation[2], operation[1]))
+                elif kind == "remove":
+                    connection.execute("DELETE FROM buffers WHERE full_name = ?",
+                                       (operation[1],))
+                    connection.execute("DELETE FROM lines WHERE full_name = ?",
+                                       (operation[1],))
+                elif kind == "clear":
+                    connection.execute("DELETE FROM lines WHERE full_name = ?",
+                                       (operation[1],))
+            # Only the last max_lines lines of each buffer are kept
+            for full_name in touched:
+                connection.execute(
+                    "DELETE FROM lines WHERE full_name = ? AND id <= "
+                    "(SELECT id FROM lines WHERE full_name = ? "
+                    "ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (full_name, full_name, self.max_lines))
@@ -0,0 +1,194 @@
+import array
+import collections
+import pickle
+import zlib
+
+# Number of interned values below which an intern table is never compacted
+INTERN_COMPACT_MIN = 1024
+
+# Number of lines added to a hibernated store that are compressed together
+HIBERNATE_CHUNK_LINES = 256
+
+# A line as received from WeeChat, in the order of ChatTextBuffer.display
+Line = collections.namedtuple(
+    'Line', ('date', 'prefix', 'message', 'tags_array'))
+
+
+class InternTable():
+    """Table of distinct values, each referenced by its index."""
+
+    def __init__(self):
+        self.values = []
+        self.indexes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def intern(self, value):
+        """Returns the index of value, adding it if needed."""
+        index = self.indexes.get(value)
+        if index is None:
+            index = len(self.values)
+            self.values.append(value)
+            self.indexes[value] = index
+        return index
+
+    def compact(self, references):
+        """Removes the values not referenced by the array of indexes
+        references, which is updated to the new indexes."""
+        remap = {}
+        values = []
+        for index in set(references):
+            remap[index] = len(values)
+            values.append(self.values[index])
+        self.values = values
+        self.indexes = {value: index for (index, value) in enumerate(values)}
+        references[:] = array.array(references.typecode,
+                                    (remap[index] for index in references))
+
+
+class LineStore():
+    """Lines of a buffer as received from WeeChat, independent of how they
+    are displayed. Dates are packed in an array, prefixes and tags are
+    interned and referenced by index, so a line costs a few bytes plus its
+    message. Lines are numbered from the first line ever added, numbers do
+    not change when the oldest lines are removed.
+
+    A hibernated store keeps its lines compressed, by chunks, and compresses
+    the lines added meanwhile once there are HIBERNATE_CHUNK_LINES of them.
+    Accessing a line rehydrates the store.
+    """
+
+    def __init__(self):
+        # Number of the oldest line kept
+        self.first = 0
+        self.hibernated = False
+        # Compressed (count, blob) chunks of the oldest lines, followed by
+        # the lines in the arrays
+        self.chunks = []
+        self.chunked = 0
+        self._reset()
+
+    def _reset(self):
+        self.dates = array.array('q')
+        self.prefixes = array.array('I')
+        self.tags = array.array('I')
+        self.messages = []
+        self.prefix_table = InternTable()
+        self.tags_table = InternTable()
+
+    def __len__(self):
+        return self.chunked + len(self.messages)
+
+    def __getitem__(self, index):
+        self.rehydrate()
+        return self._line(index)
+
+    def _line(self, index):
+        return Line(self.dates[index],
+                    self.prefix_table[self.prefixes[index]],
+                    self.messages[index],
+                    self.tags_table[self.tags[index]])
+
+    def __iter__(self):
+        return self.lines_from(self.first)
+
+    @property
+    def end(self):
+        """Number of the next line added."""
+        return self.first + len(self)
+
+    def get(self, number):
+        """Returns line number, or None if it was removed or never added."""
+        if not self.first <= number < self.end:
+            return None
+        return self[number - self.first]
+
+    def lines_from(self, number):
+        """Iterates over the lines from line number to the last one."""
+        self.rehydrate()
+        for index in range(max(0, number - self.first), len(self.messages)):
+            yield self._line(index)
+
+    def append(self, date, prefix, message, tags_array):
+        """Adds a line. Returns its number."""
+        self.dates.append(date or 0)
+        self.prefixes.append(self.prefix_table.intern(prefix))
+        self.tags.append(self.tags_table.intern(tuple(tags_array or ())))
+        self.messages.append(message)
+        if self.hibernated and len(self.messages) >= HIBERNATE_CHUNK_LINES:
+            self._compress()
+        return self.end - 1
+
+    def _compress(self):
+        """Moves the lines of the arrays to a compressed chunk."""
+        if not self.messages:
+            return
+        lines = [tuple(self._line(index))
+                 for index in range(len(self.messages))]
+        self.chunks.append((len(lines), zlib.compress(
+            pickle.dumps(lines, pickle.HIGHEST_PROTOCOL))))
+        self.chunked += len(lines)
+        self._reset()
+
+    def hibernate(self):
+        """Compresses all lines, freeing the arrays and intern tables."""
+        self.hibernated = True
+        self._compress()
+
+    def rehydrate(self):
+        """Decompresses the lines of a hibernated store."""
+        if not self.hibernated:
+            return
+        self.hibernated = False
+        lines = []
+        for (_, blob) in self.chunks:
+            lines.extend(pickle.loads(zlib.decompress(blob)))
+        lines.extend(self._line(index) for index in range(len(self.messages)))
+        self.chunks = []
+        self.chunked = 0
+        self._reset()
+        for line in lines:
+            self.append(*line)
+
+    def compressed_size(self):
+        """Returns the number of bytes of the compressed chunks."""
+        return sum(len(blob) for (_, blob) in self.chunks)
+
+    def trim_head(self, max_lines):
+        """Removes the oldest lines so that at most max_lines lines remain,
+        once there are a tenth more lines than max_lines, as the chat views
+        do. Compressed lines are removed by whole chunks. Returns the number
+        of lines removed."""
+        count = len(self)
+        if max_lines <= 0 or count <= max_lines + max(1, max_lines // 10):
+            return 0
+        removed = count - max_lines
+        dropped = 0
+        while self.chunks and dropped + self.chunks[0][0] <= removed:
+            dropped += self.chunks.pop(0)[0]
+        self.chunked -= dropped
+        self.first += dropped
+        if self.chunks:
+            return dropped
+        removed -= dropped
+        del self.dates[:removed]
+        del self.prefixes[:removed]
+        del self.tags[:removed]
+        del self.messages[:removed]
+        self.first += removed
+        for (table, references) in ((self.prefix_table, self.prefixes),
+                                    (self.tags_table, self.tags)):
+            if len(table) > max(INTERN_COMPACT_MIN, len(references)):
+                table.compact(references)
+        return dropped + removed
+
+    def clear(self):
+        """Removes all lines."""
+        self.first = self.end
+        self.chunks = []
+        self.chunked = 0
+        self._reset()
@@ -0,0 +1,349 @@
+import multiprocessing
+import pickle
+import struct
+import time
+import traceback
+from multiprocessing import shared_memory
+from gi.repository import GLib, GObject
+import protocol
+from network import Network, ConnectionStatus
+
+# Size of the shared memory ring buffer carrying decoded messages
+RING_SIZE = 8 * 1024 * 1024
+
+_RING_HEADER = struct.Struct('<QQ')  # write position, read position
+_CHUNK_HEADER = struct.Struct('<I')  # chunk length, high bit: more chunks
+_CHUNK_MORE = 0x80000000
+
+# Relay settings passed on to the network process
+_RELAY_OPTIONS = ('server', 'port', 'ssl', 'password', 'lines')
+
+
+class SharedRing():
+    """Single producer, single consumer ring buffer of byte records in
+    shared memory. Positions are ever increasing byte counters, stored in
+    the header, so that the producer and the consumer each only write
+    their own position. Records larger than the free space are split into
+    chunks.
+    """
+
+    def __init__(self, name=None, size=RING_SIZE):
+        self.size = size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=_RING_HEADER.size+size)
+            self.shm.buf[:_RING_HEADER.size] = _RING_HEADER.pack(0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self._partial = []
+
+    def _get_write_pos(self):
+        return struct.unpack_from('<Q', self.shm.buf, 0)[0]
+
+    def _set_write_pos(self, pos):
+        struct.pack_into('<Q', self.shm.buf, 0, pos)
+
+    def _get_read_pos(self):
+        return struct.unpack_from('<Q', self.shm.buf, 8)[0]
+
+    def _set_read_pos(self, pos):
+        struct.pack_into('<Q', self.shm.buf, 8, pos)
+
+    def _copy_in(self, pos, data):
+        start = pos % self.size
+        first = min(len(data), self.size-start)
+        offset = _RING_HEADER.size
+        self.shm.buf[offset+start:offset+start+first] = data[:first]
+        if first < len(data):
+            self.shm.buf[offset:offset+len(data)-first] = data[first:]
+
+    def _copy_out(self, pos, length):
+        start = pos % self.size
+        first = min(length, self.size-start)
+        offset = _RING_HEADER.size
+        data = bytes(self.shm.buf[offset+start:offset+start+first])
+        if first < length:
+            data += bytes(self.shm.buf[offset:offset+length-first])
+        return data
+
+    def write(self, record, wait, doorbell):
+        """Writes a record. Calls wait() while the ring is full, and
+        doorbell() when the consumer has read everything before this write
+        and may therefore be waiting for new data.
+        """
+        view = memoryview(record)
+        while True:
+            write_pos = self._get_write_pos()
+            free = self.size - (write_pos-self._get_read_pos())
+            if free <= _CHUNK_HEADER.size:
+                wait()
+                continue
+            length = min(len(view), free-_CHUNK_HEADER.size)
+            more = length < len(view)
+            self._copy_in(write_pos, _CHUNK_HEADER.pack(
+                length | (_CHUNK_MORE if more else 0)))
+            self._copy_in(write_pos+_CHUNK_HEADER.size, view[:length])
+            self._set_write_pos(write_pos+_CHUNK_HEADER.size+length)
+            if self._get_read_pos() == write_pos:
+                doorbell()
+            view = view[length:]
+            if not more:
+                return
+
+    def read(self):
+        """Returns the list of complete records available in the ring."""
+        records = []
+        read_pos = self._get_read_pos()
+        while True:
+            write_pos = self._get_write_pos()
+            if read_pos == write_pos:
+                break
+            while read_pos < write_pos:
+                header = _CHUNK_HEADER.unpack(
+                    self._copy_out(read_pos, _CHUNK_HEADER.size))[0]
+                length = header & ~_CHUNK_MORE
+                self._partial.append(self._copy_out(
+                    read_pos+_CHUNK_HEADER.size, length))
+                read_pos += _CHUNK_HEADER.size+length
+                if not header & _CHUNK_MORE:
+                    records.append(b''.join(self._partial))
+                    self._partial = []
+            self._set_read_pos(read_pos)
+        return records
+
+    def close(self, unlink=False):
+        """Releases the shared memory, and removes it if unlink is True."""
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class _WorkerConfig():
+    """Read only stand-in for the configuration in the network process."""
+
+    def __init__(self, relay_settings):
+        self.relay_settings = relay_settings
+
+    def get(self, section, option):
+        if section != "relay":
+            return None
+        return self.relay_settings.get(option)
+
+
+class _Worker():
+    """Runs in the network process: owns the connection, reassembles and
+    decodes messages and passes them on through the shared ring."""
+
+    def __init__(self, ring_name, ring_size, doorbell, commands):
+        self.ring = SharedRing(ring_name, ring_size)
+        self.doorbell = doorbell
+        self.commands = commands
+        self.loop = GLib.MainLoop()
+        self.net = None
+        self.settings = {}
+        GLib.io_add_watch(commands.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IOCondition.IN | GLib.IOCondition.HUP,
+                          self.on_command)
+
+    def run(self):
+        self.loop.run()
+        self.ring.close()
+
+    def post(self, record):
+        """Passes a record on to the GTK process."""
+        self.ring.write(pickle.dumps(record, pickle.HIGHEST_PROTOCOL),
+                        lambda: time.sleep(0.001),
+                        lambda: self.doorbell.send_bytes(b'\0'))
+
+    def on_command(self, fd, condition):
+        try:
+            while self.commands.poll():
+                command = self.commands.recv()
+                self.run_command(*command)
+        except EOFError:
+            # The GTK process is gone
+            self.loop.quit()
+            return False
+        return True
+
+    def run_command(self, name, *args):
+        # pylint: disable=bare-except
+        try:
+            if name == "connect":
+                self.settings.update(args[0])
+                if self.net is None:
+                    self.net = Network(_WorkerConfig(self.settings))
+                    self.net.connect("messageFromWeechat", self.on_message)
+                    self.net.connect("connectionChanged",
+                                     self.on_connection_changed)
+                self.net.connect_weechat()
+            elif name == "disconnect":
+                if self.net is not None and self.net.socket is not None:
+                    self.net.disconnect_weechat()
+            elif name in ("send", "desync", "sync"):
+                if self.net is None or self.net.socket is None:
+                    return
+                if name == "send":
+                    self.net.send_to_weechat(args[0])
+                elif name == "desync":
+                    self.net.desync_weechat()
+                else:
+                    self.net.sync_weechat()
+            elif name == "quit":
+                self.loop.quit()
+        except:
+            self.post(("error", traceback.format_exc()))
+
+    def on_connection_changed(self, source_object):
+        self.post(("status", self.net.connection_status.value))
+
+    def on_message(self, source_object, message):
+        # pylint: disable=bare-except
+        data = message.get_data()
+        try:
+            if len(data) < 5:
+                raise ValueError(
+                    "length of received message is {} bytes".format(len(data)))
+            decoded = protocol.Protocol().decode(data)
+        except:
+            self.post(("error", traceback.format_exc()))
+            self.net.disconnect_weechat()
+            return
+        self.post(("message", decoded.size, decoded.msgid,
+                   [(obj.objtype, obj.value) for obj in decoded.objects]))
+
+
+def _worker_main(ring_name, ring_size, doorbell, commands):
+    _Worker(ring_name, ring_size, doorbell, commands).run()
+
+
+class NetworkProcess(GObject.GObject):
+    """Network connection running in a separate process. Messages are
+    decoded in that process and delivered already decoded through the
+    messageDecoded signal, so decoding and rendering run in parallel.
+    The interface otherwise mirrors network.Network.
+    """
+    __gsignals__ = {"messageDecoded": (GObject.SIGNAL_RUN_FIRST, None, (object,)),
+                    "connectionChanged": (GObject.SIGNAL_RUN_FIRST, None, ())}
+
+    def __init__(self, config):
+        GObject.GObject.__init__(self)
+        self.config = config
+        self.connection_status = ConnectionStatus.NOT_CONNECTED
+        self.process = None
+        self.ring = None
+        self.doorbell = None
+        self.commands = None
+        self.doorbell_watch = None
+
+    def _start(self):
+        """Starts the network process, unless it is already running."""
+        if self.process is not None and self.process.is_alive():
+            return
+        self.shutdown()
+        # Spawn rather than fork, the GTK process is not fork safe
+        context = multiprocessing.get_context("spawn")
+        self.ring = SharedRing()
+        self.doorbell, doorbell_child = context.Pipe(duplex=False)
+        self.commands, commands_child = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, daemon=True,
+            args=(self.ring.name, self.ring.size, doorbell_child,
+                  commands_child))
+        self.process.start()
+        doorbell_child.close()
+        commands_child.close()
+        self.doorbell_watch = GLib.io_add_watch(
+            self.doorbell.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IOCondition.IN | GLib.IOCondition.HUP, self._on_doorbell)
+
+    def _on_doorbell(self, fd, condition):
+        try:
+            while self.doorbell.poll():
+                self.doorbell.recv_bytes()
+        except EOFError:
+            print("Network process has exited.")
+            self.doorbell_watch = None
+            self._set_status(ConnectionStatus.CONNECTION_LOST)
+            return False
+        for record in self.ring.read():
+            self._handle_record(pickle.loads(record))
+        return True
+
+    def _handle_record(self, record):
+        if record[0] == "message":
+            (size, msgid, objects) = record[1:]
+            weechat_objects = protocol.WeechatObjects()
+            for (objtype, value) in objects:
+                weechat_objects.append(protocol.WeechatObject(objtype, value))
+            self.emit("messageDecoded", protocol.WeechatMessage(
+                size, size, 0, None, msgid, weechat_objects))
+        elif record[0] == "status":
+            self._set_status(ConnectionStatus(record[1]))
+        elif record[0] == "error":
+            print("Error in network process:\n%s" % record[1])
+
+    def _set_status(self, status):
+        self.connection_status = status
+        self.emit("connectionChanged")
+
+    def _command(self, *command):
+        if self.commands is None:
+            return
+        try:
+            self.commands.send(command)
+        except (BrokenPipeError, OSError):
+            print("Network process is not running.")
+
+    def check_settings(self):
+        """ Returns True if settings required to connect are filled in. """
+        return self.config.get("relay", "server") != ""\
+            and self.config.get("relay", "port") != ""
+
+    def connect_weechat(self):
+        """Asks the network process to connect to the WeeChat relay."""
+        if not self.check_settings():
+            return False
+        self._start()
+        self._command("connect", {option: self.config.get("relay", option)
+                                  for option in _RELAY_OPTIONS})
+        if self.connection_status is not ConnectionStatus.RECONNECTING:
+            self._set_status(ConnectionStatus.CONNECTING)
+        return True
+
+    def disconnect_weechat(self):
+        """Disconnect from WeeChat."""
+        self._command("disconnect")
+
+    def send_to_weechat(self, message):
+        """Send a message to WeeChat."""
+        self._command("send", message)
+
+    def desync_weechat(self):
+        """Desynchronize from WeeChat."""
+        self._command("desync")
+
+    def sync_weechat(self):
+        """Synchronize with WeeChat."""
+        self._command("sync")
+
+    def shutdown(self):
+        """Stops the network process and releases the shared memory."""
+        if self.doorbell_watch is not None:
+            GLib.source_remove(self.doorbell_watch)
+            self.doorbell_watch = None
+        if self.process is not None:
+            self._command("quit")
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+        for conn in (self.doorbell, self.commands):
+            if conn is not None:
+                conn.close()
+        self.doorbell = None
+        self.commands = None
+        if self.ring is not None:
+            self.ring.close(unlink=True)
+            self.ring = None
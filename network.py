@@ -18,31 +18,18 @@
 # along with QWeeChat.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import asyncio
 import struct
-from enum import Enum
+import threading
+import queue
 import gi
 from gi.repository import Gio, GLib, GObject
+from protocol import ConnectionStatus, PROTO_INIT_CMD, PROTO_SYNC_CMDS
+from protocol import escape_init_option
+from asyncnetwork import AsyncNetwork
 gi.require_version('Gtk', '3.0')
 
 
-_PROTO_INIT_CMD = 'init password={password},compression={compression}'
-
-_PROTO_SYNC_CMDS = '(listbuffers) hdata buffer:gui_buffers(*) number,full_name,short_name,type,nicklist,title,local_variables\n' \
-    '(listlines) hdata buffer:gui_buffers(*)/own_lines/last_line(-{lines})/'\
-    'data date,displayed,prefix,message,tags_array\n'\
-    '(nicklist) nicklist\n'\
-    'sync\n'
-
-
-class ConnectionStatus(Enum):
-    """Connection status definitions."""
-    NOT_CONNECTED = 1
-    CONNECTING = 2
-    CONNECTED = 3
-    CONNECTION_LOST = 4
-    RECONNECTING = 5
-
-
 class Network(GObject.GObject):
     """Manage network connection."""
     __gsignals__ = {"messageFromWeechat": (GObject.SIGNAL_RUN_FIRST, None, (GLib.Bytes,)),
@@ -108,11 +95,12 @@ class Network(GObject.GObject):
             print("Connected")
             self.connection_status = ConnectionStatus.CONNECTED
             self.emit("connectionChanged")
-            self.send_to_weechat(_PROTO_INIT_CMD.format(
-                password=self.config.get("relay", "password"),
+            self.send_to_weechat(PROTO_INIT_CMD.format(
+                password=escape_init_option(
+                    self.config.get("relay", "password")),
                 compression="on")
                 + "\n")
-            self.send_to_weechat(_PROTO_SYNC_CMDS.format(
+            self.send_to_weechat(PROTO_SYNC_CMDS.format(
                 lines=self.config.get("relay", "lines"))
                 + "\n")
             self.input = self.socket.get_input_stream()
@@ -195,13 +183,22 @@ class Network(GObject.GObject):
         else:
             raise
 
+    def shutdown(self):
+        """Closes the connection before the application exits."""
+        if self.socket is None or not self.socket.is_connected():
+            return
+        self.send_to_weechat("quit\n")
+        self.socket.close()
+        self.socket = None
+        self.cancel_network_reads.cancel()
+
     def desync_weechat(self):
         """Desynchronize from WeeChat."""
         self.send_to_weechat("desync\n")
 
     def sync_weechat(self):
         """Synchronize with WeeChat."""
-        self.send_to_weechat("\n".join(_PROTO_SYNC_CMDS))
+        self.send_to_weechat("\n".join(PROTO_SYNC_CMDS))
 
     def printdebug(self, data):
         for c in data:
@@ -210,3 +207,80 @@ class Network(GObject.GObject):
             else:
                 print(bytes([c]).decode("utf-8"), end='')
         print("\n")
+
+
+class AsyncioNetwork(GObject.GObject):
+    """Manage network connection with the asyncio backend, see
+    asyncnetwork.AsyncNetwork. The asyncio event loop runs in its own
+    thread, events are handed over to the GLib main loop. Has the same
+    interface and signals as Network."""
+    __gsignals__ = {"messageFromWeechat": (GObject.SIGNAL_RUN_FIRST, None, (GLib.Bytes,)),
+                    "connectionChanged": (GObject.SIGNAL_RUN_FIRST, None, ())}
+
+    def __init__(self, config):
+        GObject.GObject.__init__(self)
+        self.config = config
+        self.connection_status = ConnectionStatus.NOT_CONNECTED
+        self.events = queue.SimpleQueue()
+        self.loop = asyncio.new_event_loop()
+        self.backend = AsyncNetwork(config, self._on_frame, self._on_status)
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def _on_frame(self, frame):
+        """Called in the asyncio thread."""
+        self.events.put(("frame", frame))
+        GLib.idle_add(self._dispatch_events, priority=GLib.PRIORITY_DEFAULT)
+
+    def _on_status(self, status):
+        """Called in the asyncio thread."""
+        self.events.put(("status", status))
+        GLib.idle_add(self._dispatch_events, priority=GLib.PRIORITY_DEFAULT)
+
+    def _dispatch_events(self):
+        """Emits the signals for all events queued by the asyncio thread."""
+        while True:
+            try:
+                (event, value) = self.events.get_nowait()
+            except queue.Empty:
+                return False
+            if event == "frame":
+                self.emit("messageFromWeechat", GLib.Bytes(value))
+            else:
+                self.connection_status = value
+                self.emit("connectionChanged")
+
+    def check_settings(self):
+        """ Returns True if settings required to connect are filled in. """
+        return self.backend.check_settings()
+
+    def connect_weechat(self):
+        """Sets up a connection to the WeeChat relay."""
+        if not self.check_settings():
+            return False
+        asyncio.run_coroutine_threadsafe(
+            self.backend.connect_weechat(), self.loop)
+        return True
+
+    def disconnect_weechat(self):
+        """Disconnect from WeeChat."""
+        self.loop.call_soon_threadsafe(self.backend.disconnect_weechat)
+
+    def send_to_weechat(self, message):
+        """Send a message to WeeChat."""
+        self.loop.call_soon_threadsafe(self.backend.send_to_weechat, message)
+
+    def desync_weechat(self):
+        """Desynchronize from WeeChat."""
+        self.loop.call_soon_threadsafe(self.backend.desync_weechat)
+
+    def sync_weechat(self):
+        """Synchronize with WeeChat."""
+        self.loop.call_soon_threadsafe(self.backend.sync_weechat)
+
+    def shutdown(self):
+        """Closes the connection and stops the asyncio thread."""
+        self.loop.call_soon_threadsafe(self.backend.disconnect_weechat)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(1)
@@ -0,0 +1,83 @@
+import collections
+import time
+
+
+class OverloadController():
+    """Watches how many lines are waiting to be rendered and how fast they
+    can be rendered, and decides when background buffers should stop
+    rendering and only record incoming lines.
+    """
+
+    def __init__(self, max_queue=500, busy_enter=0.5, busy_exit=0.2,
+                 window=2.0, hold=5.0):
+        # Lines received but not yet rendered
+        self.queue_depth = 0
+        self.max_queue = max_queue
+        # Fraction of wall time rendering would need at the current rate
+        self.busy_enter = busy_enter
+        self.busy_exit = busy_exit
+        self.window = window
+        self.hold = hold
+        self.saturated = False
+        self._received = collections.deque()
+        # Exponential moving average of seconds spent rendering one line
+        self._line_cost = 0.0
+        self._calm_since = None
+
+    def lines_received(self, count):
+        """Register lines that arrived from the relay."""
+        now = time.monotonic()
+        self.queue_depth += count
+        self._received.append((now, count))
+        self._update(now)
+
+    def lines_rendered(self, count, seconds):
+        """Register lines that were rendered and the time it took."""
+        self.queue_depth = max(0, self.queue_depth - count)
+        if count > 0:
+            cost = seconds / count
+            if self._line_cost == 0.0:
+                self._line_cost = cost
+            else:
+                self._line_cost = 0.8 * self._line_cost + 0.2 * cost
+        self._update(time.monotonic())
+
+    def lines_deferred(self, count):
+        """Register lines that were recorded instead of rendered."""
+        self.queue_depth = max(0, self.queue_depth - count)
+
+    def incoming_rate(self):
+        """Returns the number of lines received per second, averaged over
+        the observation window.
+        """
+        total = sum(count for (_, count) in self._received)
+        return total / self.window
+
+    def busy_fraction(self):
+        """Returns the fraction of wall time needed to render every incoming
+        line at the measured render throughput.
+        """
+        return self.incoming_rate() * self._line_cost
+
+    def is_saturated(self):
+        """Returns True if background buffers should stop rendering."""
+        return self.saturated
+
+    def _update(self, now):
+        while self._received and self._received[0][0] < now - self.window:
+            self._received.popleft()
+        busy = self.busy_fraction()
+        if not self.saturated:
+            if self.queue_depth > self.max_queue or busy > self.busy_enter:
+                self.saturated = True
+                self._calm_since = None
+        elif self.queue_depth <= self.max_queue and busy < self.busy_exit:
+            # Require a calm period before leaving overload mode, so
+            # bursty traffic does not flip the mode back and forth.
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.hold:
+                self.saturated = False
+                self._calm_since = None
+        else:
+            self._calm_since = None
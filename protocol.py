@@ -31,9 +31,66 @@
 #
 
 import collections
+from enum import Enum
 import struct
 import zlib
 
+PROTO_INIT_CMD = 'init password={password},compression={compression}'
+
+PROTO_SYNC_CMDS = '(listbuffers) hdata buffer:gui_buffers(*) number,full_name,short_name,type,nicklist,title,local_variables\n' \
+    '(nicklist) nicklist\n'\
+    '(listlines) hdata buffer:gui_buffers(*)/own_lines/last_line(-{lines})/'\
+    'data date,displayed,prefix,message,tags_array\n'\
+    'sync\n'
+
+
+def escape_init_option(value):
+    """Escapes the commas of a value of the init command, e.g. the
+    password, as WeeChat expects."""
+    return value.replace(',', '\\,')
+
+
+def split_init_options(args):
+    """Returns the list of name=value options of the arguments of an init
+    command, split on the commas not escaped as done by WeeChat."""
+    options = []
+    option = []
+    i = 0
+    while i < len(args):
+        if args[i] == '\\' and args[i+1:i+2] == ',':
+            option.append(',')
+            i += 1
+        elif args[i] == ',':
+            options.append(''.join(option))
+            option = []
+        else:
+            option.append(args[i])
+        i += 1
+    options.append(''.join(option))
+    return [option for option in options if option]
+
+
+def set_compression(frame, compression):
+    """Returns a binary message as sent by WeeChat/relay, compressed with
+    zlib or not as requested, e.g. to forward it to a client that asked for
+    another compression."""
+    if bool(frame[4]) == bool(compression):
+        return frame
+    data = frame[5:]
+    data = zlib.compress(data) if compression else zlib.decompress(data)
+    return struct.pack('>i', len(data) + 5) + \
+        struct.pack('b', 1 if compression else 0) + data
+
+
+class ConnectionStatus(Enum):
+    """Connection status definitions."""
+    NOT_CONNECTED = 1
+    CONNECTING = 2
+    CONNECTED = 3
+    CONNECTION_LOST = 4
+    RECONNECTING = 5
+
+
 if hasattr(collections, 'OrderedDict'):
     # python >= 2.7
     class WeechatDict(collections.OrderedDict):
@@ -338,6 +395,136 @@ class Protocol:
                               uncompressed, msgid, objects)
 
 
+class Encoder:
+    """Encode objects into a binary message, as sent by WeeChat/relay.
+    This is the inverse of Protocol.decode."""
+
+    def __init__(self):
+        self._obj_cb = {
+            'chr': self._obj_char,
+            'int': self._obj_int,
+            'lon': self._obj_long,
+            'str': self._obj_str,
+            'buf': self._obj_buffer,
+            'ptr': self._obj_ptr,
+            'tim': self._obj_time,
+            'htb': self._obj_hashtable,
+            'hda': self._obj_hdata,
+            'inf': self._obj_info,
+            'inl': self._obj_infolist,
+            'arr': self._obj_array,
+        }
+
+    @staticmethod
+    def _guess_type(value):
+        """Type used for values whose type is lost by decoding
+        (hashtable, array and infolist values)."""
+        if isinstance(value, int):
+            return 'int'
+        if isinstance(value, bytes):
+            return 'buf'
+        if isinstance(value, dict):
+            return 'htb'
+        if isinstance(value, list):
+            return 'arr'
+        return 'str'
+
+    def _obj_type(self, objtype):
+        return objtype.encode("utf-8")
+
+    def _obj_char(self, value):
+        return struct.pack('b', value)
+
+    def _obj_int(self, value):
+        return struct.pack('>i', value)
+
+    def _obj_short_str(self, value):
+        """Value as string, length on 1 byte."""
+        data = str(value).encode("utf-8")
+        return struct.pack('B', len(data)) + data
+
+    def _obj_long(self, value):
+        return self._obj_short_str(value)
+
+    def _obj_str(self, value):
+        if value is None:
+            return struct.pack('>i', -1)
+        return self._obj_buffer(value.encode("utf-8"))
+
+    def _obj_buffer(self, value):
+        if value is None:
+            return struct.pack('>i', -1)
+        return struct.pack('>i', len(value)) + value
+
+    def _obj_ptr(self, value):
+        if value is None:
+            value = '0x0'
+        return self._obj_short_str(value[2:] if value.startswith('0x')
+                                   else value)
+
+    def _obj_time(self, value):
+        return self._obj_short_str(value)
+
+    def _obj_hashtable(self, value):
+        items = list(value.items())
+        type_keys = self._guess_type(items[0][0]) if items else 'str'
+        type_values = self._guess_type(items[0][1]) if items else 'str'
+        data = [self._obj_type(type_keys), self._obj_type(type_values),
+                self._obj_int(len(items))]
+        for key, item in items:
+            data.append(self._obj_cb[type_keys](key))
+            data.append(self._obj_cb[type_values](item))
+        return b''.join(data)
+
+    def _obj_hdata(self, value):
+        keys = value['keys']
+        data = [self._obj_str('/'.join(value['path'])),
+                self._obj_str(','.join('%s:%s' % (key, objtype)
+                                       for key, objtype in keys.items())),
+                self._obj_int(len(value['items']))]
+        for item in value['items']:
+            for pointer in item['__path']:
+                data.append(self._obj_ptr(pointer))
+            for key, objtype in keys.items():
+                data.append(self._obj_cb[objtype](item[key]))
+        return b''.join(data)
+
+    def _obj_info(self, value):
+        return self._obj_str(value[0]) + self._obj_str(value[1])
+
+    def _obj_infolist(self, value):
+        data = [self._obj_str(value['name']),
+                self._obj_int(len(value['items']))]
+        for variables in value['items']:
+            data.append(self._obj_int(len(variables)))
+            for name, var_value in variables.items():
+                var_type = self._guess_type(var_value)
+                data.append(self._obj_str(name))
+                data.append(self._obj_type(var_type))
+                data.append(self._obj_cb[var_type](var_value))
+        return b''.join(data)
+
+    def _obj_array(self, value):
+        type_values = self._guess_type(value[0]) if value else 'str'
+        data = [self._obj_type(type_values), self._obj_int(len(value))]
+        for item in value:
+            data.append(self._obj_cb[type_values](item))
+        return b''.join(data)
+
+    def encode(self, msgid, objects, compression=False):
+        """Encode a message with the given id and list of (type, value)
+        objects, and return the binary data."""
+        data = [self._obj_str(msgid)]
+        for objtype, value in objects:
+            data.append(self._obj_type(objtype))
+            data.append(self._obj_cb[objtype](value))
+        data = b''.join(data)
+        if compression:
+            data = zlib.compress(data)
+        return struct.pack('>i', len(data) + 5) + \
+            struct.pack('b', 1 if compression else 0) + data
+
+
 def hex_and_ascii(data, bytes_per_line=10):
     """Convert a QByteArray to hex + ascii output."""
     num_lines = ((len(data) - 1) // bytes_per_line) + 1
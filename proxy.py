@@ -0,0 +1,403 @@
+import asyncio
+import collections
+import os
+import re
+import sys
+from config import GTKWeechatConfig
+from asyncnetwork import AsyncNetwork
+from protocol import ConnectionStatus, PROTO_SYNC_CMDS
+import protocol
+
+# Seconds to wait before reconnecting to WeeChat
+RECONNECT_DELAY = 5
+
+# Messages answered to the initial sync commands, see PROTO_SYNC_CMDS
+_SYNC_IDS = ('listbuffers', 'nicklist', 'listlines')
+
+_LAST_LINES = re.compile(r'/last_line\(-(\d+)\)')
+
+_DEFAULT_LINES_PATH = ['buffer', 'lines', 'line', 'line_data']
+_DEFAULT_LINES_KEYS = (('date', 'tim'), ('displayed', 'chr'),
+                       ('prefix', 'str'), ('message', 'str'),
+                       ('tags_array', 'arr'))
+_DEFAULT_VALUES = {'chr': 0, 'int': 0, 'lon': 0, 'tim': 0, 'str': '',
+                   'ptr': '0x0', 'htb': {}, 'arr': [], 'buf': None}
+
+
+class _ProxyConfig():
+    """Configuration of the upstream connection: the relay settings, except
+    that the number of lines fetched is the number of lines cached."""
+
+    def __init__(self, config):
+        self.config = config
+
+    def get(self, section, option):
+        if (section, option) == ("relay", "lines"):
+            return self.config.get("proxy", "lines")
+        return self.config.get(section, option)
+
+
+class _Client():
+    """A gtk-weechat (or other relay client) connected to the proxy."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.authenticated = False
+        self.compression = False
+        self.synced = False
+
+    def send(self, data):
+        self.writer.write(data)
+
+
+class RelayProxy():
+    """Holds one connection to WeeChat and serves any number of local clients
+    over the relay protocol. Buffers, the last lines of every buffer,
+    nicklists and the hotlist are cached, so that clients are answered
+    without a round trip to WeeChat. Everything else is forwarded.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.max_lines = int(config.get("proxy", "lines"))
+        self.upstream = AsyncNetwork(_ProxyConfig(config),
+                                     self.on_upstream_frame,
+                                     self.on_upstream_status)
+        self.encoder = protocol.Encoder()
+        self.clients = []
+        self.ready = asyncio.Event()
+        self.synced_ids = set()
+        # Cache, filled from the answers to the sync commands and updated
+        # by the events sent by WeeChat
+        self.buffers = collections.OrderedDict()
+        self.buffers_keys = protocol.WeechatDict()
+        self.lines = {}
+        self.lines_path = _DEFAULT_LINES_PATH
+        self.lines_keys = protocol.WeechatDict(_DEFAULT_LINES_KEYS)
+        self.nicklists = {}
+        self.nicklist_path = ['buffer', 'nicklist_item']
+        self.nicklist_keys = protocol.WeechatDict()
+        self.hotlist = None
+        # Requests forwarded to WeeChat: proxy id -> (client, client id)
+        self.pending = {}
+        self.next_id = 0
+
+    async def run(self):
+        """Connects to WeeChat and serves clients until cancelled."""
+        server = await asyncio.start_server(
+            self.on_client, self.config.get("proxy", "address"),
+            int(self.config.get("proxy", "port")))
+        await self.upstream.connect_weechat()
+        async with server:
+            await server.serve_forever()
+
+    def on_upstream_status(self, status):
+        if status in (ConnectionStatus.CONNECTION_LOST,
+                      ConnectionStatus.RECONNECTING):
+            # Keep serving the cache meanwhile
+            self.synced_ids = set()
+            self.upstream.connection_status = ConnectionStatus.RECONNECTING
+            asyncio.get_running_loop().call_later(
+                RECONNECT_DELAY,
+                lambda: asyncio.ensure_future(self.upstream.connect_weechat()))
+        elif status is ConnectionStatus.NOT_CONNECTED:
+            print("Could not connect to WeeChat, retrying in {} seconds.".format(
+                RECONNECT_DELAY))
+            asyncio.get_running_loop().call_later(
+                RECONNECT_DELAY,
+                lambda: asyncio.ensure_future(self.upstream.connect_weechat()))
+
+    def on_upstream_frame(self, frame):
+        message = protocol.Protocol().decode(frame)
+        if message.msgid in self.pending:
+            self._answer_forwarded(message)
+        elif message.msgid in _SYNC_IDS:
+            self._cache_sync_answer(message)
+        elif message.msgid.startswith('_'):
+            self._cache_event(message)
+            if message.msgid == '_upgrade':
+                self.upstream.desync_weechat()
+            elif message.msgid == '_upgrade_ended':
+                self.synced_ids = set()
+                self.upstream.send_to_weechat(PROTO_SYNC_CMDS.format(
+                    lines=self.max_lines))
+            # Clients get the frame with the compression they asked for
+            frames = {}
+            for client in self.clients:
+                if client.synced:
+                    if client.compression not in frames:
+                        frames[client.compression] = protocol.set_compression(
+                            frame, client.compression)
+                    client.send(frames[client.compression])
+
+    def _encode(self, client, msgid, objects):
+        return self.encoder.encode(msgid, objects, client.compression)
+
+    # Cache maintenance
+
+    @staticmethod
+    def _hdata_objects(message, path):
+        for obj in message.objects:
+            if obj.objtype == 'hda' and obj.value['path'] and \
+                    obj.value['path'][-1] == path:
+                yield obj.value
+
+    def _cache_sync_answer(self, message):
+        if message.msgid == 'listbuffers':
+            self.buffers.clear()
+            for hdata in self._hdata_objects(message, 'buffer'):
+                self.buffers_keys = hdata['keys']
+                for item in hdata['items']:
+                    self.buffers[item['__path'][0]] = item
+        elif message.msgid == 'listlines':
+            self.lines = {}
+            for hdata in self._hdata_objects(message, 'line_data'):
+                self.lines_path = hdata['path']
+                self.lines_keys = hdata['keys']
+                # Lines are sent newest first
+                for item in reversed(hdata['items']):
+                    self._add_line(item['__path'][0], item)
+        elif message.msgid == 'nicklist':
+            self.nicklists = {}
+            self._cache_nicklist(message)
+        self.synced_ids.add(message.msgid)
+        if len(self.synced_ids) == len(_SYNC_IDS):
+            if self.ready.is_set():
+                # Resynchronized after an upgrade or a reconnection, the
+                # clients may hold stale pointers: refresh them
+                for client in self.clients:
+                    if client.synced:
+                        self._send_snapshot(client)
+            self.ready.set()
+
+    def _add_line(self, bufptr, item):
+        if bufptr not in self.lines:
+            self.lines[bufptr] = collections.deque(maxlen=self.max_lines)
+        self.lines[bufptr].append(item)
+
+    def _cache_nicklist(self, message):
+        for hdata in self._hdata_objects(message, 'nicklist_item'):
+            self.nicklist_path = hdata['path']
+            self.nicklist_keys = protocol.WeechatDict(
+                (key, objtype) for key, objtype in hdata['keys'].items()
+                if key != '_diff')
+            refreshed = set()
+            for item in hdata['items']:
+                bufptr = item['__path'][0]
+                if bufptr not in refreshed:
+                    self.nicklists[bufptr] = []
+                    refreshed.add(bufptr)
+                self.nicklists[bufptr].append(item)
+
+    def _cache_nicklist_diff(self, message):
+        for hdata in self._hdata_objects(message, 'nicklist_item'):
+            group = None
+            for item in hdata['items']:
+                nicks = self.nicklists.setdefault(item['__path'][0], [])
+                diff = item['_diff']
+                if diff == ord('^'):
+                    group = item['name']
+                    continue
+                same = [i for (i, nick) in enumerate(nicks)
+                        if nick['name'] == item['name'] and
+                        nick['group'] == item['group']]
+                if diff == ord('+'):
+                    # Insert at the end of the parent group
+                    pos = len(nicks)
+                    for (i, nick) in enumerate(nicks):
+                        if nick['group'] and nick['name'] == group:
+                            pos = i+1
+                            while pos < len(nicks) and not nicks[pos]['group']:
+                                pos += 1
+                            break
+                    nicks.insert(pos, item)
+                elif diff == ord('-'):
+                    for i in reversed(same):
+                        del nicks[i]
+                elif diff == ord('*'):
+                    for i in same:
+                        nicks[i] = item
+
+    def _cache_event(self, message):
+        if message.msgid == '_buffer_line_added':
+            for hdata in self._hdata_objects(message, 'line_data'):
+                for item in hdata['items']:
+                    line = {key: item.get(key, _DEFAULT_VALUES[objtype])
+                            for key, objtype in self.lines_keys.items()}
+                    line['__path'] = [item['buffer']] + \
+                        ['0x0'] * (len(self.lines_path)-2) + item['__path']
+                    self._add_line(item['buffer'], line)
+        elif message.msgid in ('_nicklist', 'nicklist'):
+            self._cache_nicklist(message)
+        elif message.msgid == '_nicklist_diff':
+            self._cache_nicklist_diff(message)
+        elif message.msgid.startswith('_buffer_'):
+            for hdata in self._hdata_objects(message, 'buffer'):
+                for item in hdata['items']:
+                    bufptr = item['__path'][0]
+                    if message.msgid == '_buffer_opened':
+                        self.buffers[bufptr] = item
+                    elif message.msgid == '_buffer_closing':
+                        self.buffers.pop(bufptr, None)
+                        self.lines.pop(bufptr, None)
+                        self.nicklists.pop(bufptr, None)
+                    elif message.msgid == '_buffer_cleared':
+                        self.lines.pop(bufptr, None)
+                    elif bufptr in self.buffers:
+                        self.buffers[bufptr].update(item)
+
+    # Answers from the cache
+
+    def _buffers_hdata(self):
+        items = []
+        for buf in self.buffers.values():
+            item = {key: buf.get(key, _DEFAULT_VALUES[objtype])
+                    for key, objtype in self.buffers_keys.items()}
+            item['__path'] = buf['__path']
+            items.append(item)
+        return {'path': ['buffer'], 'keys': self.buffers_keys,
+                'count': len(items), 'items': items}
+
+    def _lines_hdata(self, count):
+        items = []
+        for bufptr in self.buffers:
+            lines = self.lines.get(bufptr, ())
+            items.extend(reversed(list(lines)[-count:]))
+        return {'path': self.lines_path, 'keys': self.lines_keys,
+                'count': len(items), 'items': items}
+
+    def _nicklist_hdata(self):
+        items = []
+        for bufptr in self.buffers:
+            items.extend(self.nicklists.get(bufptr, ()))
+        return {'path': self.nicklist_path, 'keys': self.nicklist_keys,
+                'count': len(items), 'items': items}
+
+    def _send_snapshot(self, client):
+        """Sends what a client receives after its sync commands."""
+        client.send(self._encode(client, 'listbuffers',
+                                 [('hda', self._buffers_hdata())]))
+        client.send(self._encode(client, 'nicklist',
+                                 [('hda', self._nicklist_hdata())]))
+        client.send(self._encode(client, 'listlines',
+                                 [('hda', self._lines_hdata(self.max_lines))]))
+
+    # Clients
+
+    async def on_client(self, reader, writer):
+        client = _Client(reader, writer)
+        self.clients.append(client)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode("utf-8").rstrip('\r\n')
+                if line and not await self.on_client_command(client, line):
+                    break
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.clients.remove(client)
+            for (proxy_id, (pending_client, _)) in list(self.pending.items()):
+                if pending_client is client:
+                    del self.pending[proxy_id]
+            writer.close()
+
+    async def on_client_command(self, client, line):
+        """Handles a command sent by a client. Returns False if the client
+        connection must be closed."""
+        msgid = ''
+        if line.startswith('('):
+            end = line.find(')')
+            msgid = line[1:end]
+            line = line[end+1:].lstrip()
+        (command, _, args) = line.partition(' ')
+        if command == 'init':
+            for option in protocol.split_init_options(args):
+                (name, _, value) = option.partition('=')
+                if name == 'password':
+                    client.authenticated = \
+                        value == self.config.get("relay", "password")
+                elif name == 'compression':
+                    client.compression = value == 'zlib' or value == 'on'
+            return client.authenticated
+        if not client.authenticated or command == 'quit':
+            return False
+        if command == 'sync':
+            client.synced = True
+        elif command == 'desync':
+            client.synced = False
+        elif command == 'input':
+            self.upstream.send_to_weechat(line + '\n')
+        elif command == 'ping':
+            client.send(self._encode(client, '_pong', [('str', args)]))
+        elif command == 'nicklist' and not args:
+            await self.ready.wait()
+            client.send(self._encode(client, msgid,
+                                     [('hda', self._nicklist_hdata())]))
+        elif command == 'hdata' and args.startswith('buffer:gui_buffers(*)'):
+            await self.ready.wait()
+            hdata_path = args.split(' ')[0]
+            last_lines = _LAST_LINES.search(hdata_path)
+            if '/' not in hdata_path:
+                client.send(self._encode(client, msgid,
+                                         [('hda', self._buffers_hdata())]))
+            elif last_lines and hdata_path.endswith('/data'):
+                client.send(self._encode(client, msgid, [(
+                    'hda', self._lines_hdata(int(last_lines.group(1))))]))
+            else:
+                self._forward(client, msgid, line)
+        elif command == 'hdata' and args.startswith('hotlist:') and \
+                self.hotlist is not None:
+            client.send(self._encode(client, msgid, self.hotlist))
+            # Refresh the cache for the next request
+            self._forward(None, msgid, line)
+        else:
+            self._forward(client, msgid, line)
+        return True
+
+    def _forward(self, client, msgid, line):
+        """Sends a client command to WeeChat, the answer is routed back to
+        the client by the proxy id it is tagged with."""
+        self.next_id += 1
+        proxy_id = 'proxy_{}'.format(self.next_id)
+        self.pending[proxy_id] = (client, msgid)
+        self.upstream.send_to_weechat('({}) {}\n'.format(proxy_id, line))
+
+    def _answer_forwarded(self, message):
+        (client, msgid) = self.pending.pop(message.msgid)
+        objects = [(obj.objtype, obj.value) for obj in message.objects]
+        for obj in message.objects:
+            if obj.objtype == 'hda' and obj.value['path'] == ['hotlist']:
+                self.hotlist = objects
+        if client is not None:
+            client.send(self._encode(client, msgid, objects))
+
+
+def main():
+    """Runs the proxy with the given, or the default, configuration file."""
+    if len(sys.argv) > 1:
+        config_filename = sys.argv[1]
+    else:
+        config_dir = os.environ.get("XDG_CONFIG_HOME",
+                                    os.path.expanduser("~/.config"))
+        config_filename = os.path.join(config_dir, "gtk-weechat",
+                                       "gtk-weechat.conf")
+    config = GTKWeechatConfig(config_filename)
+    if not config.get("relay", "server") or not config.get("relay", "port"):
+        sys.exit("Relay server and port must be set in {}".format(
+            config_filename))
+    proxy = RelayProxy(config)
+    print("Serving relay clients on {}:{}".format(
+        config.get("proxy", "address"), config.get("proxy", "port")))
+    try:
+        asyncio.run(proxy.run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
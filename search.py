@@ -0,0 +1,203 @@
+import array
+import bisect
+import re
+import color
+
+# Default number of postings, (word or nick, line) pairs, kept by the index
+SEARCH_INDEX_SIZE = 2000000
+
+# Fraction of the postings of a buffer evicted at once over the budget
+EVICT_FRACTION = 0.1
+
+RE_WORD = re.compile(r"\w+")
+
+
+def words_of(text):
+    """Returns the distinct lowercase words of text, color codes removed."""
+    return set(RE_WORD.findall(color.remove(text).lower()))
+
+
+def nick_of(tags_array):
+    """Returns the lowercase nick of a line from its tags, or None."""
+    for tag in tags_array:
+        if tag.startswith("nick_"):
+            return tag[5:].lower()
+    return None
+
+
+class BufferIndex():
+    """Inverted index of the lines of a buffer: the numbers of the lines,
+    as in its LineStore, containing each word and sent by each nick. Lines
+    older than first are dead, their postings are dropped once they are
+    half of the postings."""
+
+    def __init__(self, first):
+        self.first = first
+        self.end = first
+        self.words = {}
+        self.nicks = {}
+        # Number of postings of each line from first
+        self.counts = array.array('I')
+        self.postings = 0
+        self.dead = 0
+
+    def add(self, number, words, nick):
+        """Indexes line number, numbers being added in increasing order."""
+        if number < self.end:
+            return
+        # Lines skipped, e.g. not received by the index, have no postings
+        self.counts.extend([0] * (number - self.end))
+        for word in words:
+            numbers = self.words.get(word)
+            if numbers is None:
+                numbers = self.words[word] = array.array('q')
+            numbers.append(number)
+        count = len(words)
+        if nick is not None:
+            numbers = self.nicks.get(nick)
+            if numbers is None:
+                numbers = self.nicks[nick] = array.array('q')
+            numbers.append(number)
+            count += 1
+        self.counts.append(count)
+        self.postings += count
+        self.end = number + 1
+
+    def trim(self, first):
+        """Forgets the lines before line number first. Returns the number of
+        postings forgotten."""
+        if first <= self.first:
+            return 0
+        removed = min(first, self.end) - self.first
+        count = sum(self.counts[:removed])
+        del self.counts[:removed]
+        self.first = first
+        self.end = max(self.end, first)
+        self.postings -= count
+        self.dead += count
+        if self.dead > self.postings:
+            self._compact()
+        return count
+
+    def _compact(self):
+        for postings in (self.words, self.nicks):
+            for (key, numbers) in list(postings.items()):
+                start = bisect.bisect_left(numbers, self.first)
+                if start == len(numbers):
+                    del postings[key]
+                elif start:
+                    del numbers[:start]
+        self.dead = 0
+
+    def _live(self, numbers):
+        return numbers[bisect.bisect_left(numbers, self.first):]
+
+    def search(self, words, nick=None):
+        """Returns the numbers of the lines containing all words, sent by
+        nick if not None, in increasing order."""
+        lists = []
+        for word in words:
+            numbers = self.words.get(word)
+            if numbers is None:
+                return []
+            lists.append(numbers)
+        if nick is not None:
+            numbers = self.nicks.get(nick)
+            if numbers is None:
+                return []
+            lists.append(numbers)
+        if not lists:
+            return []
+        lists.sort(key=len)
+        found = self._live(lists[0])
+        for numbers in lists[1:]:
+            if not found:
+                break
+            found = sorted(set(found).intersection(self._live(numbers)))
+        return list(found)
+
+
+class SearchIndex():
+    """Full-text index of the lines of all buffers, fed as lines are
+    received. Finds lines by words, nick and buffer. When there are more
+    than max_postings postings, the oldest lines of the buffer with the
+    most postings are evicted, as the scrollback limit does.
+    """
+
+    def __init__(self, max_postings=SEARCH_INDEX_SIZE):
+        self.max_postings = max_postings
+        self.buffers = {}
+        self.postings = 0
+
+    def add(self, pointer, number, line):
+        """Indexes line number of a buffer, a (date, prefix, message,
+        tags_array) line."""
+        index = self.buffers.get(pointer)
+        if index is None:
+            index = self.buffers[pointer] = BufferIndex(number)
+        before = index.postings
+        index.add(number, words_of(line[2] or ""), nick_of(line[3] or ()))
+        self.postings += index.postings - before
+        if self.postings > self.max_postings:
+            self._evict()
+
+    def _evict(self):
+        while self.postings > self.max_postings:
+            index = max(self.buffers.values(), key=lambda i: i.postings)
+            if not index.postings:
+                break
+            lines = max(1, int((index.end - index.first) * EVICT_FRACTION))
+            self.postings -= index.trim(index.first + lines)
+
+    def trim(self, pointer, first):
+        """Forgets the lines of a buffer before line number first, e.g.
+        those trimmed from its scrollback."""
+        index = self.buffers.get(pointer)
+        if index is not None:
+            self.postings -= index.trim(first)
+
+    def remove(self, pointer):
+        """Forgets all lines of a buffer."""
+        index = self.buffers.pop(pointer, None)
+        if index is not None:
+            self.postings -= index.postings
+
+    def reassign(self, pointers):
+        """Keeps the lines indexed of the buffers whose pointer is a key of
+        the dict pointers, under the pointer it maps to, e.g. when buffers
+        are listed again after a reconnection. Forgets the others."""
+        self.buffers = {pointers[pointer]: index for (pointer, index)
+                        in self.buffers.items() if pointer in pointers}
+        self.postings = sum(index.postings for index in self.buffers.values())
+
+    def clear(self):
+        """Forgets all lines."""
+        self.buffers = {}
+        self.postings = 0
+
+    def search(self, query, pointer=None):
+        """Returns the (buffer pointer, line number) of the lines matching
+        query, in the buffer of pointer or in all buffers, oldest first per
+        buffer. Query words must all be in the line, a word "nick:name" is
+        matched against the nick of the line instead."""
+        words = set()
+        nick = None
+        for word in query.lower().split():
+            if word.startswith("nick:") and len(word) > 5:
+                nick = word[5:]
+            else:
+                words.update(RE_WORD.findall(word))
+        if not words and nick is None:
+            return []
+        if pointer is not None:
+            indexes = [(pointer, self.buffers.get(pointer))]
+        else:
+            indexes = self.buffers.items()
+        return [(ptr, number) for (ptr, index) in indexes if index is not None
+                for number in index.search(words, nick)]
+
+    def info(self):
+        """Returns statistics, to tune look.search_index_size."""
+        return "{} postings in {} buffers, {} words".format(
+            self.postings, len(self.buffers),
+            sum(len(index.words) for index in self.buffers.values()))
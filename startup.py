@@ -0,0 +1,29 @@
+import time
+
+
+class StartupProfile():
+    """Timestamps of the phases of startup, reported by
+    gtk-weechat.py --startup-profile."""
+
+    def __init__(self, start):
+        # time.perf_counter() at the start of the process
+        self.start = start
+        self.phases = []
+        self.reported = False
+
+    def mark(self, phase):
+        """Records the end of a phase of startup."""
+        self.phases.append((phase, time.perf_counter()))
+
+    def report(self):
+        """Prints the time at which each phase ended and its duration, in
+        milliseconds from the start. Only the first call prints."""
+        if self.reported:
+            return
+        self.reported = True
+        print("Startup profile:")
+        previous = self.start
+        for (phase, end) in self.phases:
+            print("{:>9.1f} ms {:>+9.1f} ms  {}".format(
+                (end - self.start)*1000, (end - previous)*1000, phase))
+            previous = end